@@ -0,0 +1,259 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Measures the cost of RF4CE framing and crypto. Runs offline.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import binascii
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from rf4ce import LinkConfig, Rf4ceNode, Rf4ceFrame, Rf4ceConstants
+from rf4ce.rf4ce import Rf4ceAES, address_to_raw
+import huepy as hue
+
+# Python 3 only
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+
+PAYLOAD_SIZES = (1, 10, 50, 100)
+
+FRAME_TYPES = (
+	("data", Rf4ceConstants.FRAME_TYPE_DATA),
+	("command", Rf4ceConstants.FRAME_TYPE_COMMAND),
+	("vendor", Rf4ceConstants.FRAME_TYPE_VENDOR),
+)
+
+KEY = binascii.unhexlify("000102030405060708090a0b0c0d0e0f")
+SOURCE = Rf4ceNode("00:11:22:33:44:55:66:77", 0x1)
+DESTINATION = Rf4ceNode("88:99:aa:bb:cc:dd:ee:ff", 0x2)
+FRAME_CONTROL = 0x25
+FRAME_COUNTER = 0x1234
+
+
+def make_frame(frame_type, ciphered, size):
+	"""Returns a frame of the link with a size bytes payload,
+	command included"""
+	frame = Rf4ceFrame()
+	frame.source = SOURCE
+	frame.destination = DESTINATION
+	frame.frame_type = frame_type
+	frame.frame_ciphered = ciphered
+	frame.frame_counter = FRAME_COUNTER
+	frame.key = KEY
+	payload = bytes(bytearray(i & 0xff for i in range(size)))
+	if frame_type == Rf4ceConstants.FRAME_TYPE_COMMAND:
+		frame.command = 0x01
+		payload = payload[1:]
+	elif frame_type == Rf4ceConstants.FRAME_TYPE_VENDOR:
+		frame.vendor_indentifier = 0x10ef
+	frame.payload = payload
+	return frame
+
+
+def framing_benchmarks():
+	benchmarks = []
+	key = binascii.hexlify(KEY)
+	for type_name, frame_type in FRAME_TYPES:
+		for ciphered in (False, True):
+			for size in PAYLOAD_SIZES:
+				name = "{}/{}/{}".format(type_name, "ciphered" if ciphered else "plain", size)
+				frame = make_frame(frame_type, ciphered, size)
+				data = bytes(frame.pack())
+				benchmarks.append(("pack/" + name, frame.pack))
+
+				def parse(data=data):
+					Rf4ceFrame().parse_from_string(data, SOURCE, DESTINATION, key)
+				benchmarks.append(("parse/" + name, parse))
+	return benchmarks
+
+
+def crypto_benchmarks():
+	benchmarks = []
+	aes = Rf4ceAES(KEY, SOURCE, DESTINATION)
+	for size in PAYLOAD_SIZES:
+		plain_text = b'\x00' * size
+		data = aes.cipher(plain_text, FRAME_CONTROL, FRAME_COUNTER)
+		benchmarks.append(("aes/cipher/{}".format(size),
+			lambda plain_text=plain_text: aes.cipher(plain_text, FRAME_CONTROL, FRAME_COUNTER)))
+		benchmarks.append(("aes/decipher/{}".format(size),
+			lambda data=data: aes.decipher(data, FRAME_CONTROL, FRAME_COUNTER)))
+		benchmarks.append(("aes/gen_auth/{}".format(size),
+			lambda plain_text=plain_text: aes.gen_auth(plain_text, FRAME_CONTROL, FRAME_COUNTER)))
+	benchmarks.append(("aes/init", lambda: Rf4ceAES(KEY, SOURCE, DESTINATION)))
+	benchmarks.append(("address_to_raw", lambda: address_to_raw(SOURCE.get_long_address())))
+	return benchmarks
+
+
+def link_config_benchmarks(directory):
+	link_config = LinkConfig()
+	link_config.dest_panid = 0x1234
+	link_config.source = SOURCE
+	link_config.destination = DESTINATION
+	link_config.key = binascii.hexlify(KEY).decode()
+	link_config.frame_counter = FRAME_COUNTER
+	filename = os.path.join(directory, "link.json")
+	link_config.save(filename)
+	return [
+		("link_config/load", lambda: LinkConfig(filename)),
+		("link_config/save", lambda: link_config.save(filename)),
+	]
+
+
+def time_loops(func, loops):
+	timer = timeit.default_timer
+	start = timer()
+	for i in range(loops):
+		func()
+	return timer() - start
+
+
+def measure_speed(func, min_time, repeat):
+	"""Returns the best ops/s of repeat runs of at least min_time seconds"""
+	loops = 1
+	while True:
+		elapsed = time_loops(func, loops)
+		if elapsed >= min_time:
+			break
+		loops = max(loops * 2, int(loops * min_time / elapsed * 1.1) if elapsed else 0)
+	best = min([elapsed] + [time_loops(func, loops) for i in range(repeat - 1)])
+	return loops / best
+
+
+def count_objects(func, loops=100):
+	"""Returns the number of objects tracked by the garbage collector
+	that an op leaves allocated
+
+	Used without tracemalloc: objects freed within the op, and objects
+	that are not containers, are not counted.
+	"""
+	func()
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		# Resets the count of the youngest generation
+		gc.collect()
+		start = gc.get_count()[0]
+		for i in range(loops):
+			func()
+		return (gc.get_count()[0] - start) / loops
+	finally:
+		if enabled:
+			gc.enable()
+
+
+def measure_allocations(func, loops=100):
+	"""Returns the memory allocated by an op and its unit
+
+	The peak memory allocated, in bytes, with tracemalloc (Python 3),
+	otherwise the objects left allocated.
+	"""
+	if tracemalloc is None:
+		return count_objects(func, loops), "objects"
+	func()
+	tracemalloc.start()
+	try:
+		peak = 0
+		for i in range(loops):
+			if hasattr(tracemalloc, "reset_peak"):
+				tracemalloc.reset_peak()
+			current = tracemalloc.get_traced_memory()[0]
+			func()
+			peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+	finally:
+		tracemalloc.stop()
+	return peak, "bytes"
+
+
+def load_baseline(filename):
+	with open(filename, "r") as f:
+		return json.load(f)["results"]
+
+
+def save_baseline(filename, results):
+	baseline = {
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"results": results,
+	}
+	with open(filename, "w") as f:
+		json.dump(baseline, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", "--filter", help="Only run the benchmarks whose name contains FILTER")
+	parser.add_argument("-t", "--min-time", help="Minimum duration of a run in seconds (default: 0.1)",
+		type=float, default=0.1)
+	parser.add_argument("-r", "--repeat", help="Runs per benchmark, the best one is kept (default: 3)",
+		type=int, default=3)
+	parser.add_argument("-s", "--save", help="Save the results as a JSON baseline")
+	parser.add_argument("-b", "--baseline", help="Compare the results with a JSON baseline")
+	parser.add_argument("--threshold", help="Slowdown from the baseline considered a regression, "
+		"in percent (default: 10)", type=float, default=10.0)
+	args = parser.parse_args()
+
+	baseline = None
+	if args.baseline:
+		try:
+			baseline = load_baseline(args.baseline)
+		except (IOError, ValueError, KeyError) as e:
+			print(hue.bad("Cannot load baseline: {}".format(e)))
+			exit(-1)
+
+	directory = tempfile.mkdtemp()
+	try:
+		benchmarks = framing_benchmarks() + crypto_benchmarks() + link_config_benchmarks(directory)
+		if args.filter:
+			benchmarks = [(name, func) for name, func in benchmarks if args.filter in name]
+
+		if tracemalloc is None:
+			print(hue.info("tracemalloc needs Python 3, counting the objects left allocated "
+				"by each op instead of the bytes allocated"))
+
+		results = {}
+		regressions = []
+		for name, func in benchmarks:
+			ops = measure_speed(func, args.min_time, args.repeat)
+			allocated, unit = measure_allocations(func)
+			results[name] = {"ops": ops, "allocated": allocated, "allocation_unit": unit}
+
+			line = "{:<32} {:>12.0f} ops/s".format(name, ops)
+			if unit == "bytes":
+				line += " {:>8} B/op".format(allocated)
+			else:
+				line += " {:>8.2f} obj/op".format(allocated)
+			if baseline is not None and name in baseline:
+				change = ops / baseline[name]["ops"] - 1
+				line += " {:>+7.1f}%".format(change * 100)
+				if change < -args.threshold / 100:
+					regressions.append(name)
+					line = hue.bad(line)
+			print(line)
+			sys.stdout.flush()
+	finally:
+		shutil.rmtree(directory)
+
+	if args.save:
+		save_baseline(args.save, results)
+		print(hue.info("Baseline saved into {}".format(args.save)))
+
+	if regressions:
+		print(hue.bad("{} benchmarks regressed by more than {:g}%: {}".format(len(regressions),
+			args.threshold, ", ".join(regressions))))
+		exit(1)
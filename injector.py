@@ -9,42 +9,102 @@ from __future__ import (absolute_import,
 from builtins import *
 
 import argparse
+import sys
 import time
+import threading
+import Queue
 from datetime import datetime
 import binascii
 import readline
+import sqlite3
 
-from rf4ce import Dot15d4FCS, Dot15d4Data, Raw, makeFCS
-from rf4ce import LinkConfig, Rf4ceFrame, Rf4ceConstants
+from rf4ce import check_fcs
+from rf4ce import LinkConfig, LinkStore, Rf4ceFrame, Rf4ceConstants
 from rf4ce.radio import TxFlow
+from rf4ce.dot15d4 import parse_header, Dot15d4Constants, Dot15d4Exception
+from rf4ce.dot15d4 import MAC_ACK_WAIT_DURATION
 from rf4ce.packetprocessor import PacketProcessor
+from rf4ce.stats import LatencyHistogram
+from rf4ce.channelscheduler import ChannelScheduler
+from rf4ce.framecounter import FrameCounterIndex, link_id
 import huepy as hue
 
 
+# macAckWaitDuration, plus the PlutoSDR TX and RX buffers at 4 MS/s
+ACK_TIMEOUT = MAC_ACK_WAIT_DURATION + 2 * 0x8000 / 4e6
+
+# Scripted packets wait for their slot in a loop for this long, in seconds
+SPIN_TIME = 0.001
+
+
 class AckProcessor(PacketProcessor):
 
-	"""ACK processor thread
+	"""ACK processor
 
-	Thread processing incomming ACK
+	Processes incomming ACKs in the receiving thread, so its own
+	thread is never started
 	Full-duplex SDR is needed for this to work
 	"""
 
 	def __init__(self):
 		PacketProcessor.__init__(self)
 		self.last_ack = -1
+		self.expected = None
+		self.ack_time = None
+		self.acked = threading.Condition()
+
+	def feed(self, data, channel=None):
+		"""ACKs are handled right away, in the receiving thread"""
+		self.process(data, channel)
 
-	def process(self, data):
-		"""Parses a 802.15.4 ACK and extract the seqnum"""
+	def process(self, data, channel=None):
+		"""Parses a 802.15.4 ACK and extract the seqnum
+
+		Waiters are woken up when the expected seqnum arrives
+		"""
 
 		# Check if the 802.15.4 packet is valid
-		if makeFCS(data[:-2]) != data[-2:]:
+		if not check_fcs(data):
 			print(hue.bad("Received invalid packet"))
 			return
 
-		packet = Dot15d4FCS(data)
+		try:
+			packet = parse_header(data)
+		except Dot15d4Exception:
+			return
+
+		if packet.fcf_frametype == Dot15d4Constants.FRAME_TYPE_ACK:
+			with self.acked:
+				self.last_ack = packet.seqnum
+				if packet.seqnum == self.expected and self.ack_time is None:
+					self.ack_time = time.time()
+					self.acked.notify_all()
+
+	def expect(self, seqnum):
+		"""Starts waiting for the ACK of seqnum, returns the current time
+
+		ACKs received before this call are ignored, so an old
+		ACK using the same seqnum cannot match. The matching ACK is
+		never received before the returned time.
+		"""
+		with self.acked:
+			self.expected = seqnum
+			self.ack_time = None
+			return time.time()
 
-		if packet.fcf_frametype == 2: # ACK
-			self.last_ack = packet.seqnum
+	def wait_ack(self, timeout):
+		"""Waits for the expected ACK
+
+		Returns its arrival time, or None after timeout seconds
+		"""
+		deadline = time.time() + timeout
+		with self.acked:
+			while self.ack_time is None:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return None
+				self.acked.wait(remaining)
+			return self.ack_time
 
 	def get_last_ack(self):
 		"""Returns the seqnum of the last received ACK"""
@@ -65,6 +125,7 @@ class InjectorCmd(object):
 	DELAY = 4
 	CIPHERED = 5
 	HELP = 6
+	EXIT = 7
 
 	def to_int(self, n):
 		if type(n) == int:
@@ -101,10 +162,19 @@ class Injector(object):
 
 	"""Injector util main class"""
 
-	def __init__(self, link_config, channel, sdr_device):
+	def __init__(self, link_config, channel, sdr_device, ack_timeout=ACK_TIMEOUT, miss_budget=3,
+			counters=None):
 		self.link_config = link_config
 		self.sdr_device = sdr_device
 
+		# Frame counters seen on air
+		if counters is None:
+			counters = FrameCounterIndex()
+		self.counters = counters
+		self.link_id = link_id(link_config.dest_panid,
+			"0x{:04x}".format(link_config.source.get_short_address()),
+			"0x{:04x}".format(link_config.destination.get_short_address()))
+
 		# Build a RF4CE data frame based on the link configuration
 		self.rf4ce_frame = Rf4ceFrame()
 		self.rf4ce_frame.source = self.link_config.source
@@ -116,6 +186,8 @@ class Injector(object):
 		else:
 			self.rf4ce_frame.frame_ciphered = False
 		self.rf4ce_frame.frame_counter = self.link_config.frame_counter
+		# Frame counter of the last frame sent
+		self.sent_counter = self.link_config.frame_counter
 
 		self.seqnum = 0
 		
@@ -124,6 +196,10 @@ class Injector(object):
 
 		# Pluto-sdr support full duplex
 		# ACK can be received
+		self.ack_timeout = ack_timeout
+		self.ack_latency = LatencyHistogram("ACK latency")
+		self.ack_failures = 0
+		self.scheduler = ChannelScheduler(self.link_config.channel_stats, miss_budget)
 		if self.sdr_device == "pluto-sdr":
 			self.ack_processor = AckProcessor()
 		else:
@@ -131,69 +207,190 @@ class Injector(object):
 
 		self.tb = TxFlow(channel, self.ack_processor, self.sdr_device)
 
-	def run(self):
+	def run(self, script=None, rate=None):
+		"""Runs the injector
+
+		Commands are read from the prompt, or from the script file
+		object if one is given
+		"""
 		self.log("SRC:({}) -> DST:({})".format(self.link_config.source,
 			self.link_config.destination), hue.info)
 		if not self.link_config.key:
 			self.log("No secured configuration provided. Will only send plaintext packets.", hue.info)
 		self.log("Loading last frame counter: {}".format(self.link_config.frame_counter), hue.info)
-		self.help()
+		highest = self.counters.get_highest(self.link_id)
+		if highest is not None and highest > self.rf4ce_frame.frame_counter:
+			self.log("Frame counter {} seen on air, starting from it".format(highest), hue.info)
+			self.rf4ce_frame.frame_counter = highest
+		if script is None:
+			self.help()
 
 		self.tb.start()
-		if self.ack_processor:
-			self.ack_processor.start()
 
-		# Main loop, iterate through user-supplied commands
+		try:
+			if script is None:
+				self.run_interactive()
+			else:
+				self.run_script(script, rate)
+		finally:
+			self.link_config.frame_counter = self.sent_counter
+			self.log("Saving last frame counter: {}".format(self.link_config.frame_counter), hue.info)
+			self.link_config.save()
+			self.counters.close()
+
+			if self.sdr_device == "pluto-sdr":
+				self.log(repr(self.ack_latency), hue.info)
+				self.log("{} packets not acknowledged".format(self.ack_failures), hue.info)
+				self.log(repr(self.scheduler), hue.info)
+
+			self.tb.stop()
+			self.tb.wait()
+
+	def run_interactive(self):
+		"""Main loop, iterate through user-supplied commands"""
 		for cmd in self.prompt():
 			if cmd.action == InjectorCmd.PACKET:
-				self.seqnum = (self.seqnum + 1) % 255
-				self.rf4ce_frame.frame_counter += 1
-				self.rf4ce_frame.payload = cmd.arg
-				data = self.gen_ieee_packet(self.rf4ce_frame.pack())
+				seqnum, data, frame_counter = self.build_packet(cmd.arg)
 
 				self.log("Transmitting {}".format(binascii.hexlify(data)), hue.info)
+				self.send(seqnum, data, frame_counter)
 
-				if self.sdr_device == "pluto-sdr":
-					self.ack_transmit(data)
-				else:
-					self.tb.transmit(data)
-				
 				time.sleep(self.packet_delay)
 
-			elif cmd.action == InjectorCmd.PROFILE:
-				self.log("Set profile to 0x{:02x}".format(cmd.arg), hue.info)
-				self.rf4ce_frame.profile_indentifier = cmd.arg
-
-			elif cmd.action == InjectorCmd.COUNTER:
-				self.log("Set counter to {}".format(cmd.arg), hue.info)
-				self.rf4ce_frame.frame_counter = cmd.arg
-
-			elif cmd.action == InjectorCmd.DELAY:
-				self.log("Set delay to {}".format(cmd.arg), hue.info)
-				self.packet_delay = cmd.arg
-
-			elif cmd.action == InjectorCmd.CIPHERED:
-				self.log("Set ciphered to {}".format(cmd.arg), hue.info)
-				if cmd.arg:
-					if not link_config.key:
-						self.log("No key provided. Cannot send ciphered packets.", hue.bad)
-					else:
-						self.rf4ce_frame.frame_ciphered = True
-				else:
-					self.rf4ce_frame.frame_ciphered = False
-
 			elif cmd.action == InjectorCmd.HELP:
 				self.help()
 
-		self.link_config.frame_counter = self.rf4ce_frame.frame_counter
-		self.log("Saving last frame counter: {}".format(self.link_config.frame_counter), hue.info)
-		self.link_config.save()
+			else:
+				self.execute(cmd)
+
+	def run_script(self, script, rate=None):
+		"""Runs a script on a timer, at rate packets per second
 
-		if self.sdr_device == "pluto-sdr":
-			self.ack_processor.stop()
+		Frames are built and ciphered ahead of their transmit slot
+		by another thread. Delay commands change the interval between
+		the following packets.
+		"""
+		if rate:
+			self.packet_delay = 1.0 / rate
+		pipeline = Queue.Queue(64)
+		builder = threading.Thread(target=self.build_script, args=(script, pipeline))
+		builder.daemon = True
+		builder.start()
+
+		send_times = []
+		lateness = []
+		deadline = None
+		try:
+			while True:
+				item = pipeline.get()
+				if item is None:
+					break
+				seqnum, data, frame_counter, delay = item
+
+				now = time.time()
+				if deadline is None:
+					deadline = now
+				# Sleeps most of the wait, then spins for precision,
+				# letting the builder thread run
+				if deadline - now > SPIN_TIME:
+					time.sleep(deadline - now - SPIN_TIME)
+				while time.time() < deadline:
+					time.sleep(0)
+
+				send_time = time.time()
+				self.send(seqnum, data, frame_counter)
+				send_times.append(send_time)
+				lateness.append(send_time - deadline)
+
+				# A late packet does not move the following slots,
+				# unless it is more than a slot late
+				deadline = max(deadline + delay, send_time)
+		except KeyboardInterrupt:
+			self.log("Interrupted", hue.bad)
+
+		self.report(send_times, lateness)
+
+	def build_script(self, script, pipeline):
+		"""Builds the frames of a script, feeds them to the pipeline"""
+		try:
+			for cmd in self.read_script(script):
+				if cmd.action == InjectorCmd.PACKET:
+					try:
+						seqnum, data, frame_counter = self.build_packet(cmd.arg)
+					except Dot15d4Exception as e:
+						self.log("Cannot build packet: {}".format(e), hue.bad)
+						continue
+					pipeline.put((seqnum, data, frame_counter, self.packet_delay))
+				elif cmd.action != InjectorCmd.HELP:
+					self.execute(cmd)
+		finally:
+			pipeline.put(None)
+
+	def report(self, send_times, lateness):
+		"""Logs the achieved rate and timing jitter of a script"""
+		count = len(send_times)
+		self.log("Transmitted {} packets".format(count), hue.info)
+		if count < 2:
+			return
+		elapsed = send_times[-1] - send_times[0]
+		intervals = [b - a for a, b in zip(send_times, send_times[1:])]
+		mean = sum(intervals) / len(intervals)
+		jitter = (sum((i - mean) ** 2 for i in intervals) / len(intervals)) ** 0.5
+		self.log("Achieved rate: {:.1f} packets/s".format((count - 1) / elapsed if elapsed else 0),
+			hue.info)
+		self.log("Interval: mean {:.3f} ms, jitter {:.3f} ms".format(mean * 1e3, jitter * 1e3),
+			hue.info)
+		self.log("Lateness: mean {:.3f} ms, max {:.3f} ms".format(
+			sum(lateness) / count * 1e3, max(lateness) * 1e3), hue.info)
+
+	def build_packet(self, payload):
+		"""Builds the next 802.15.4 packet of the link
+
+		Returns its seqnum, data and frame counter
+		"""
+		self.seqnum = (self.seqnum + 1) % 255
+		self.rf4ce_frame.frame_counter += 1
+		self.rf4ce_frame.payload = payload
+		return (self.seqnum, self.gen_ieee_packet(self.rf4ce_frame.pack()),
+			self.rf4ce_frame.frame_counter)
 
-		self.tb.stop()
-		self.tb.wait()
+	def send(self, seqnum, data, frame_counter):
+		"""Transmits a packet, waits for its ACK if possible
+
+		Its frame counter is then saved to the link database, if any,
+		and on exit
+		"""
+		if self.sdr_device == "pluto-sdr":
+			self.ack_transmit(data, seqnum)
+		else:
+			self.tb.transmit(data)
+		self.sent_counter = frame_counter
+		if self.link_config.store is not None:
+			self.link_config.store.update_frame_counter(self.link_config, frame_counter)
+
+	def execute(self, cmd):
+		"""Applies a setting command"""
+		if cmd.action == InjectorCmd.PROFILE:
+			self.log("Set profile to 0x{:02x}".format(cmd.arg), hue.info)
+			self.rf4ce_frame.profile_indentifier = cmd.arg
+
+		elif cmd.action == InjectorCmd.COUNTER:
+			self.log("Set counter to {}".format(cmd.arg), hue.info)
+			self.rf4ce_frame.frame_counter = cmd.arg
+
+		elif cmd.action == InjectorCmd.DELAY:
+			self.log("Set delay to {}".format(cmd.arg), hue.info)
+			self.packet_delay = cmd.arg
+
+		elif cmd.action == InjectorCmd.CIPHERED:
+			self.log("Set ciphered to {}".format(cmd.arg), hue.info)
+			if cmd.arg:
+				if not self.link_config.key:
+					self.log("No key provided. Cannot send ciphered packets.", hue.bad)
+				else:
+					self.rf4ce_frame.frame_ciphered = True
+			else:
+				self.rf4ce_frame.frame_ciphered = False
 
 	def help(self):
 		help_text = """
@@ -230,86 +427,92 @@ class Injector(object):
 			except KeyboardInterrupt:
 				raise StopIteration
 
-			if cmd.startswith("profile"):
-				try:
-					yield InjectorCmd(InjectorCmd.PROFILE, cmd.split()[1])
-				except:
-					self.log("Malformed command", hue.bad)
-					continue
+			for parsed in self.parse_command(cmd):
+				if parsed.action == InjectorCmd.EXIT:
+					raise StopIteration
+				yield parsed
 
-			elif cmd.startswith("counter"):
-				try:
-					yield InjectorCmd(InjectorCmd.COUNTER, cmd.split()[1])
-				except:
-					self.log("Malformed command", hue.bad)
-					continue
+	def read_script(self, script):
+		"""Generates the commands of a script file object
 
-			elif cmd.startswith("delay"):
-				try:
-					yield InjectorCmd(InjectorCmd.DELAY, cmd.split()[1])
-				except:
-					self.log("Malformed command", hue.bad)
-					continue
-
-			elif cmd.startswith("ciphered"):
+		Empty lines and lines starting with # are ignored
+		"""
+		for line in script:
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			for cmd in self.parse_command(line):
+				if cmd.action == InjectorCmd.EXIT:
+					return
+				yield cmd
+
+	def parse_command(self, cmd):
+		"""Returns the list of commands of an input line"""
+		arg_actions = {
+			"profile": InjectorCmd.PROFILE,
+			"counter": InjectorCmd.COUNTER,
+			"delay": InjectorCmd.DELAY,
+			"ciphered": InjectorCmd.CIPHERED,
+		}
+		for name, action in arg_actions.items():
+			if cmd.startswith(name):
 				try:
-					yield InjectorCmd(InjectorCmd.CIPHERED, cmd.split()[1])
+					return [InjectorCmd(action, cmd.split()[1])]
 				except:
 					self.log("Malformed command", hue.bad)
-					continue
+					return []
 
-			elif cmd.startswith("help"):
-				yield InjectorCmd(InjectorCmd.HELP, None)
+		if cmd.startswith("help"):
+			return [InjectorCmd(InjectorCmd.HELP, None)]
 
-			elif cmd.startswith("exit"):
-				raise StopIteration
+		if cmd.startswith("exit"):
+			return [InjectorCmd(InjectorCmd.EXIT, None)]
 
-			else:
-				for packet in cmd.split():
-					try:
-						data = binascii.unhexlify(packet)
-					except:
-						self.log("Malformed command", hue.bad)
-						continue
-					yield InjectorCmd(InjectorCmd.PACKET, data)
+		cmds = []
+		for packet in cmd.split():
+			try:
+				data = binascii.unhexlify(packet)
+			except:
+				self.log("Malformed command", hue.bad)
+				continue
+			cmds.append(InjectorCmd(InjectorCmd.PACKET, data))
+		return cmds
 
 	def gen_ieee_packet(self, data):
-		"""Encapsulates data into a 802.15.4 packet"""
-		packet = Dot15d4FCS() / Dot15d4Data() / Raw(load=data)
-
-		packet.fcf_srcaddrmode = 2
-		packet.fcf_destaddrmode = 2
-
-		packet.fcf_panidcompress = True
-		packet.fcf_ackreq = True
-		packet.seqnum = self.seqnum
+		"""Encapsulates data into a 802.15.4 packet
 
-		packet.dest_panid = self.link_config.dest_panid
-
-		packet.dest_addr = self.link_config.destination.get_short_address()
-		packet.src_addr = self.link_config.source.get_short_address()
-
-		return packet.build()
+		Only the seqnum, the payload and the FCS of the link's
+		prebuilt header template are updated
+		"""
+		return self.link_config.get_header_template().build(self.seqnum, data)
 
-	def ack_transmit(self, data, max_freq_retry=5, max_tx_retry=10):
+	def ack_transmit(self, data, seqnum, max_rounds=5):
 		"""Transmit data with ACK check
 
-		Tries to transmit a packet until a ACK is received
+		Tries to transmit a packet until a ACK is received, on the
+		best channels first. A channel is left after miss_budget
+		attempts without ACK.
 		Full-duplex SDR is needed for this to work
 		"""
-		transmit_success = False
-		for freq_retry in range(max_freq_retry):
-			for tx_retry in range(max_tx_retry):
+		for channel in self.scheduler.schedule(self.tb.get_channel(), max_rounds):
+			if channel != self.tb.get_channel():
+				self.log("Warning: switching to channel {}".format(channel), hue.bad)
+				self.tb.set_channel(channel)
+			for tx_retry in range(self.scheduler.miss_budget):
+				# Each attempt waits for its own ACK
+				sent = self.ack_processor.expect(seqnum)
 				self.tb.transmit(data)
-				time.sleep(0.15)
-				if self.ack_processor.get_last_ack() != self.seqnum:
+				ack_time = self.ack_processor.wait_ack(self.ack_timeout)
+				if ack_time is None:
+					self.scheduler.record(channel)
 					self.log("Warning: no ACK received, retrying", hue.bad)
 				else:
-					self.log("ACK received", hue.good)
-					transmit_success = True
+					latency = ack_time - sent
+					self.scheduler.record(channel, latency)
+					self.ack_latency.add(latency)
+					self.log("ACK received in {:.3f} ms".format(latency * 1e3), hue.good)
 					return True
-			self.log("Warning: switching frequency", hue.bad)
-			self.tb.frequency_switch()
+		self.ack_failures += 1
 		return False
 
 	def log(self, data, format=None):
@@ -322,20 +525,63 @@ class Injector(object):
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("config_file", help="JSON file containing link information")
+	parser.add_argument("config_file", help="JSON file containing link information, "
+		"or link name with --database")
 	parser.add_argument("-c", "--channel", help="RF4CE channel (default: 15)", type=int,
 		choices=[15, 20, 25], default=15)
 	parser.add_argument("-s", "--sdr", help="SDR Device to use (default: pluto-sdr)", 
 		choices=["hackrf", "pluto-sdr"], default="pluto-sdr")
+	parser.add_argument("-S", "--script", help="Run the commands of a script file (- for stdin) "
+		"instead of prompting")
+	parser.add_argument("-r", "--rate", help="Scripted packets per second (default: 1/delay)",
+		type=float)
+	parser.add_argument("-a", "--ack-timeout", help="ACK timeout in ms, for full-duplex SDRs "
+		"(default: {:.1f}, macAckWaitDuration plus the SDR buffers)".format(ACK_TIMEOUT * 1e3),
+		type=float, default=ACK_TIMEOUT * 1e3)
+	parser.add_argument("-m", "--miss-budget", help="Attempts without ACK before switching channel "
+		"(default: 3)", type=int, default=3)
+	parser.add_argument("-D", "--database", help="SQLite link database holding the link")
+	parser.add_argument("--counters", help="Frame counters journal file of the sniffer, the injection "
+		"starts after the highest counter seen on air")
 	args = parser.parse_args()
 
-	try:
-		link_config = LinkConfig(args.config_file)
-	except:
-		print(hue.bad("Cannot load configuration file"))
-		exit(-1)
+	if args.database:
+		try:
+			link_config = LinkStore(args.database).get(args.config_file)
+		except sqlite3.Error as e:
+			print(hue.bad("Cannot load link database: {}".format(e)))
+			exit(-1)
+		if link_config is None:
+			print(hue.bad("No link named '{}' in the database".format(args.config_file)))
+			exit(-1)
+	else:
+		try:
+			link_config = LinkConfig(args.config_file)
+		except:
+			print(hue.bad("Cannot load configuration file"))
+			exit(-1)
 
 	print(link_config)
 
-	injector = Injector(link_config, args.channel, args.sdr)
-	injector.run()
+	script = None
+	if args.script == "-":
+		script = sys.stdin
+	elif args.script:
+		try:
+			script = open(args.script, "r")
+		except IOError as e:
+			print(hue.bad("Cannot open script: {}".format(e)))
+			exit(-1)
+
+	counters = None
+	if args.counters:
+		try:
+			# The journal belongs to the sniffer, it is only read
+			counters = FrameCounterIndex(args.counters, read_only=True)
+		except IOError as e:
+			print(hue.bad("Cannot open frame counters journal: {}".format(e)))
+			exit(-1)
+
+	injector = Injector(link_config, args.channel, args.sdr, args.ack_timeout / 1e3,
+		args.miss_budget, counters)
+	injector.run(script, args.rate)
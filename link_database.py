@@ -0,0 +1,60 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Imports, exports and lists the links of a link database.
+"""
+
+from __future__ import (absolute_import,
+                        print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import sqlite3
+
+from rf4ce import LinkStore
+import huepy as hue
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("database", help="SQLite link database, created if needed")
+	subparsers = parser.add_subparsers(dest="command")
+	import_parser = subparsers.add_parser("import", help="Import JSON link files, "
+		"named after their base name")
+	import_parser.add_argument("files", help="JSON files containing link information", nargs="+")
+	export_parser = subparsers.add_parser("export", help="Export each link to a JSON file")
+	export_parser.add_argument("directory", help="Output directory")
+	subparsers.add_parser("list", help="List the links")
+	args = parser.parse_args()
+
+	try:
+		store = LinkStore(args.database)
+	except sqlite3.Error as e:
+		print(hue.bad("Cannot open link database: {}".format(e)))
+		exit(-1)
+
+	try:
+		if args.command == "import":
+			try:
+				names = store.import_json(args.files)
+			except (IOError, ValueError, KeyError):
+				print(hue.bad("Nothing imported"))
+				exit(-1)
+			print(hue.good("Imported {} links".format(len(names))))
+
+		elif args.command == "export":
+			try:
+				filenames = store.export_json(args.directory)
+			except IOError as e:
+				print(hue.bad("Cannot export links: {}".format(e)))
+				exit(-1)
+			print(hue.good("Exported {} links".format(len(filenames))))
+
+		else:
+			for link_config in store.get_all():
+				print(hue.bold(link_config.name))
+				print(link_config)
+			print(hue.info("{} links".format(len(store))))
+	finally:
+		store.close()
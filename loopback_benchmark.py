@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Measures the full TX -> PHY -> RX path through the virtual SDR.
+"""
+
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import *
+
+import argparse
+import os
+import struct
+import threading
+import time
+
+from rf4ce import check_fcs
+from rf4ce.dot15d4 import Dot15d4DataTemplate
+from rf4ce.packetprocessor import PacketProcessor
+from rf4ce.radio import TxFlow, RxFlow
+from rf4ce.virtualair import ChannelModel, VirtualAir
+import huepy as hue
+
+
+# Frames start with their index
+INDEX = struct.Struct("<I")
+
+
+class LoopbackProcessor(PacketProcessor):
+
+	"""Counts the benchmark frames received intact
+
+	Frames are checked as soon as the PHY outputs them, in the
+	GNU Radio thread.
+	"""
+
+	def __init__(self, frames):
+		PacketProcessor.__init__(self)
+		self.frames = frames
+		self.received = set()
+		self.corrupted = 0
+		self.last_received = None
+		self.last_received_cpu = None
+		self.lock = threading.Lock()
+		self.done = threading.Event()
+
+	def feed(self, data, channel=None):
+		offset = Dot15d4DataTemplate.HEADER_SIZE
+		index = None
+		if check_fcs(data) and len(data) >= offset + INDEX.size:
+			index = INDEX.unpack_from(data, offset)[0]
+		with self.lock:
+			if index is None or index >= len(self.frames) or \
+					bytearray(data) != bytearray(self.frames[index]):
+				self.corrupted += 1
+				return
+			self.received.add(index)
+			self.last_received = time.time()
+			self.last_received_cpu = cpu_time()
+			if len(self.received) == len(self.frames):
+				self.done.set()
+
+
+def make_frames(count, size):
+	template = Dot15d4DataTemplate(0x1234, 0x0001, 0x0002)
+	frames = []
+	for index in range(count):
+		payload = bytearray(INDEX.pack(index)) + bytearray((index + i) & 0xff
+			for i in range(max(size - INDEX.size, 0)))
+		frames.append(template.build(index & 0xff, payload))
+	return frames
+
+
+def cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+
+def run_point(frames, channel, channel_model, idle_timeout):
+	"""Sends the frames through a channel model
+
+	Returns the processor, the elapsed time and the CPU time
+	"""
+	air = VirtualAir()
+	processor = LoopbackProcessor(frames)
+	rx = RxFlow(channel, processor, "virtual", air=air, channel_model=channel_model)
+	tx = TxFlow(channel, None, "virtual", air=air)
+	rx.start()
+	tx.start()
+
+	start = time.time()
+	start_cpu = cpu_time()
+	for frame in frames:
+		tx.transmit(frame)
+
+	# Waits for all the frames, or until they stop coming
+	while not processor.done.wait(0.1):
+		last = processor.last_received or start
+		if time.time() - last > idle_timeout:
+			break
+	end = processor.last_received or time.time()
+	end_cpu = processor.last_received_cpu or cpu_time()
+	elapsed_cpu = end_cpu - start_cpu
+
+	tx.stop()
+	tx.wait()
+	rx.stop()
+	rx.wait()
+	return processor, end - start, elapsed_cpu
+
+
+def parse_snr(value):
+	if value.lower() == "none":
+		return None
+	return float(value)
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-n", "--count", help="Packets sent per SNR (default: 200)",
+		type=int, default=200)
+	parser.add_argument("-l", "--length", help="802.15.4 payload length in bytes (default: 20)",
+		type=int, default=20)
+	parser.add_argument("--snr", help="Comma separated SNRs in dB, none for a noiseless channel "
+		"(default: none,20,10,6,3,0)", default="none,20,10,6,3,0")
+	parser.add_argument("-f", "--frequency-offset", help="Carrier frequency offset in Hz (default: 0)",
+		type=float, default=0.0)
+	parser.add_argument("-c", "--channel", help="RF4CE channel (default: 15)", type=int,
+		choices=[15, 20, 25], default=15)
+	parser.add_argument("--seed", help="Noise generator seed", type=int)
+	parser.add_argument("--idle-timeout", help="Seconds without any packet before giving up "
+		"on the missing ones (default: 2)", type=float, default=2.0)
+	args = parser.parse_args()
+
+	try:
+		snrs = [parse_snr(value) for value in args.snr.split(",")]
+	except ValueError:
+		print(hue.bad("Invalid SNR list '{}'".format(args.snr)))
+		exit(-1)
+
+	frames = make_frames(args.count, args.length)
+	print(hue.info("Sending {} packets of {} bytes on channel {}, frequency offset {:g} Hz".format(
+		args.count, len(frames[0]), args.channel, args.frequency_offset)))
+	print("{:>8} {:>9} {:>9} {:>8} {:>12} {:>12}".format("SNR (dB)", "received", "corrupted",
+		"PER", "packets/s", "CPU/packet"))
+
+	for snr in snrs:
+		channel_model = ChannelModel(snr, args.frequency_offset, seed=args.seed)
+		processor, elapsed, elapsed_cpu = run_point(frames, args.channel, channel_model,
+			args.idle_timeout)
+		received = len(processor.received)
+		per = 1 - received / len(frames)
+		rate = received / elapsed if elapsed > 0 else 0
+		cpu = "{:.3f} ms".format(elapsed_cpu / received * 1e3) if received else "-"
+		print("{:>8} {:>9} {:>9} {:>7.1f}% {:>12.1f} {:>12}".format(
+			"none" if snr is None else "{:g}".format(snr), received, processor.corrupted,
+			per * 100, rate, cpu))
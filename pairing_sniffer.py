@@ -9,14 +9,17 @@ from __future__ import (absolute_import,
 from builtins import *
 
 import argparse
+import os
 from datetime import datetime
 import binascii
-import functools
+import sqlite3
 
-from rf4ce import Dot15d4FCS, Dot15d4Data, Raw, makeFCS
-from rf4ce import LinkConfig, Rf4ceNode, Rf4ceFrame, Rf4ceException, Rf4ceConstants
-from rf4ce.radio import RxFlow
+from rf4ce import check_fcs
+from rf4ce import LinkConfig, LinkStore, Rf4ceNode, Rf4ceFrame, Rf4ceException, Rf4ceConstants
+from rf4ce.dot15d4 import parse_header, Dot15d4Constants, Dot15d4Exception
 from rf4ce.packetprocessor import PacketProcessor
+from rf4ce.pairing import PairingTracker, CMD_PAIR_RESPONSE, CMD_KEY_SEED, KEY_SEED_COUNT
+from rf4ce.pcap import replay, CaptureException
 import struct
 import huepy as hue
 
@@ -25,30 +28,41 @@ class KeyProcessor(PacketProcessor):
 
 	"""Key sniffer processor
 
-	Sniffs a pairing procedure to get all link
-	information, including the AES key
+	Sniffs pairing procedures to get all link information,
+	including the AES key. Concurrent pairings are followed,
+	each link is saved as soon as its key is known, to a JSON
+	file and/or to a link store.
 	"""
 
-	def __init__(self):
+	def __init__(self, output_file, all_links=False, timeout=60.0, store=None):
 		PacketProcessor.__init__(self)
-		self.wait_pair_cmd = True
-		self.key_index = 0
-		self.key_words = [None] * 0x25
-		self.link_config = LinkConfig()
-		self.success = False
-
-	def process(self, data):
+		self.output_file = output_file
+		self.store = store
+		self.all_links = all_links
+		self.tracker = PairingTracker(timeout)
+		self.links = []
+
+	def process(self, data, channel=None, now=None):
+		"""Processes a packet, now is its capture time when replayed"""
 		print(hue.info("Processing packet ..."))
 
+		for session in self.tracker.expire(now):
+			print(hue.bad("Pairing of {} timed out, missing {} key words".format(
+				session.link_config.destination, session.remaining)))
+
 		# Check if the 802.15.4 packet is valid
-		if makeFCS(data[:-2]) != data[-2:]:
+		if not check_fcs(data):
 			print(hue.bad("Invalid packet"))
 			return
 
 		# Parse 802.15.4 packet and extract RF4CE payload
-		packet = Dot15d4FCS(data)
+		try:
+			packet = parse_header(data)
+		except Dot15d4Exception as e:
+			print(hue.bad("Cannot parse 802.15.4 header: {}".format(e)))
+			return
 
-		if packet.fcf_frametype == 2: # ACK
+		if packet.fcf_frametype == Dot15d4Constants.FRAME_TYPE_ACK:
 			return
 
 		# Read source, dest, do not use key
@@ -60,7 +74,7 @@ class KeyProcessor(PacketProcessor):
 			destination = Rf4ceNode(None, packet.dest_addr)
 		key = None
 		
-		rf4ce_payload = bytes(packet[3].fields["load"])
+		rf4ce_payload = packet.get_payload(data)
 		frame = Rf4ceFrame()
 		
 		try:
@@ -69,50 +83,47 @@ class KeyProcessor(PacketProcessor):
 			print(hue.bad("Cannot parse RF4CE frame: {}".format(e)))
 			return
 
+		if frame.frame_type != Rf4ceConstants.FRAME_TYPE_COMMAND:
+			return
+
+		# Both the pairing response and the key seeds are sent
+		# by the target
+		index = (packet.src_panid, packet.src_addr, packet.dest_addr)
+
 		# Start of a key transmission can be detected with 
 		# the pairing response command (0x04)
 		# Short addresses for source and destination are also
 		# provided by this command
-		if self.wait_pair_cmd:
-			if frame.frame_type == Rf4ceConstants.FRAME_TYPE_COMMAND:
-				if frame.command == 0x04:
-					print(hue.good("Key transmission started !"))
-					short_src, short_dest = self.parse_pairing_response(frame.payload)
-					self.link_config.dest_panid = packet.src_panid
-					self.link_config.source = Rf4ceNode(packet.dest_addr, short_src)
-					self.link_config.destination = Rf4ceNode(packet.src_addr, short_dest)
-					self.wait_pair_cmd = False
-		# Here, we are now expecting key seed command frames (0x06)
-		else:
-			if frame.frame_type != Rf4ceConstants.FRAME_TYPE_COMMAND:
-				print(hue.bad("Received unexpected frame type: {}".format(frame)))
+		if frame.command == CMD_PAIR_RESPONSE:
+			short_src, short_dest = self.parse_pairing_response(frame.payload)
+			link_config = LinkConfig()
+			link_config.dest_panid = packet.src_panid
+			link_config.source = Rf4ceNode(packet.dest_addr, short_src)
+			link_config.destination = Rf4ceNode(packet.src_addr, short_dest)
+			self.tracker.start(index, link_config, now)
+			print(hue.good("Key transmission started for {} !".format(link_config.destination)))
+
+		# Key seed command frames (0x06), in any order
+		elif frame.command == CMD_KEY_SEED:
+			payload = bytearray(frame.payload)
+			if not payload:
 				return
-			
-			if frame.command != 0x06:
-				print(hue.bad("Received unexpected command: {}".format(frame)))
+			session, added = self.tracker.add_seed(index, payload[0], payload[1:],
+				frame.frame_counter, now)
+			if session is None:
+				print(hue.bad("Received key word {} of an unknown pairing".format(payload[0])))
 				return
-			
-			if frame.payload[0] == self.key_index - 1:
-				self.key_index -= 1
-				print(hue.info("Key word {} has been sent again".format(self.key_index)))
-			
-			if frame.payload[0] != self.key_index:
-				print(hue.bad("Missed key word {} ! Aborting.".format(self.key_index)))
-				self.stop()
+
+			if not added:
+				print(hue.info("Key word {} has been sent again".format(payload[0])))
 				return
 
-			print(hue.good("Received key word {}".format(self.key_index)))
+			print(hue.good("Received key word {} ({}/{})".format(payload[0],
+				KEY_SEED_COUNT - session.remaining, KEY_SEED_COUNT)))
 
-			self.key_words[self.key_index] = frame.payload[1:]
-			
-			if self.key_index == 0x24:
+			if session.is_complete():
 				print(hue.good("All key words have been received"))
-				self.link_config.key = binascii.hexlify(self.compute_key(self.key_words))
-				self.link_config.frame_counter = frame.frame_counter
-				self.success = True
-				self.stop()
-			else:
-				self.key_index += 1
+				self.save_link(session)
 
 	def parse_pairing_response(self, data):
 		"""Extracts allocated network address and network address
@@ -120,31 +131,82 @@ class KeyProcessor(PacketProcessor):
 		short_src, short_dest = struct.unpack("<HH", data[1:5])
 		return short_src, short_dest
 
-	def xor(self, word1, word2):
-		"""Simple XOR operation between two key words"""
-		return [a ^ b for a, b in zip(word1, word2)]
-
-	def compute_key(self, words):
-		"""Computes the key from all the key words"""
-		seed = functools.reduce(self.xor, words)
-		r = [seed[i*16:(i+1)*16] for i in range(5)]
-		result = functools.reduce(self.xor, r)
-		return bytes(result)
+	def get_filename(self):
+		"""Returns the file of the next link: output_file, then
+		output_file with an increasing index before the extension"""
+		if not self.links:
+			return self.output_file
+		root, ext = os.path.splitext(self.output_file)
+		return "{}.{}{}".format(root, len(self.links), ext)
+
+	def save_link(self, session):
+		link_config = session.link_config
+		link_config.key = binascii.hexlify(session.get_key())
+		print(link_config)
+		if self.output_file:
+			filename = self.get_filename()
+			print(hue.info("Saving link configuration into {}".format(filename)))
+			link_config.save(filename)
+		if self.store is not None:
+			name = self.store.add(link_config)
+			print(hue.info("Saving link configuration into {} as '{}'".format(
+				self.store.filename, name)))
+		self.links.append(link_config)
+		if not self.all_links:
+			self.stop()
 
 
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("output_file", help="output JSON file storing link information")
+	parser.add_argument("output_file", help="output JSON file storing link information", nargs="?")
 	parser.add_argument("-c", "--channel", help="RF4CE channel (default: 15)", type=int,
 		choices=[15, 20, 25], default=15)
 	parser.add_argument("-s", "--sdr", help="SDR Device to use (default: pluto-sdr)", 
 		choices=["hackrf", "pluto-sdr"], default="pluto-sdr")
+	parser.add_argument("-a", "--all", help="Keep sniffing after the first key, save every link",
+		action="store_true")
+	parser.add_argument("-t", "--timeout", help="Drop pairings without any frame for TIMEOUT seconds "
+		"(default: 60)", type=float, default=60.0)
+	parser.add_argument("-p", "--pcap", help="Replay a pcap/pcapng capture file instead of using a SDR")
+	parser.add_argument("-D", "--database", help="Also store the links in a SQLite link database")
 	args = parser.parse_args()
 
+	if not args.output_file and not args.database:
+		parser.error("an output file or a database is required")
+
+	store = None
+	if args.database:
+		try:
+			store = LinkStore(args.database)
+		except sqlite3.Error as e:
+			print(hue.bad("Cannot open link database: {}".format(e)))
+			exit(-1)
+
+	key_processor = KeyProcessor(args.output_file, args.all or bool(args.pcap), args.timeout,
+		store)
+
+	if args.pcap:
+		print(hue.info("Replaying {}".format(args.pcap)))
+
+		def replay_packet(data, timestamp):
+			# Pairings time out on the capture clock, if there is one
+			if timestamp is None:
+				key_processor.tracker.timeout = None
+			key_processor.process(data, now=timestamp)
+
+		try:
+			replay(args.pcap, replay_packet, timestamps=True)
+		except (IOError, CaptureException) as e:
+			print(hue.bad("Cannot read capture file: {}".format(e)))
+			exit(-1)
+		print(hue.info(repr(key_processor.tracker)))
+		exit(0)
+
+	from rf4ce.radio import RxFlow
+
 	print(hue.info("Sniffing on channel {}".format(args.channel)))
 
-	key_processor = KeyProcessor()
 	tb = RxFlow(args.channel, key_processor, args.sdr)
 
 	key_processor.start()
@@ -159,11 +221,7 @@ if __name__ == '__main__':
 	except KeyboardInterrupt:
 		pass
 
-	if key_processor.success:
-		print(key_processor.link_config)
-		print(hue.info("Saving link configuration into {}".format(args.output_file)))
-		key_processor.link_config.save(args.output_file)
-
+	print(hue.info(repr(key_processor.tracker)))
 	print(hue.info("Exiting..."))
 
 	tb.stop()
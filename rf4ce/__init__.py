@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from rf4ce import Rf4ceNode, Rf4ceFrame, Rf4ceConstants, Rf4ceException
+from rf4ce import Rf4ceCipherCache, cipher_cache
 from linkconfig import LinkConfig
+from linkregistry import LinkRegistry
+from linkstore import LinkStore
+from fcs import make_fcs, check_fcs, check_fcs_batch
 
-from scapy.all import Dot15d4FCS, Dot15d4Data, Raw, makeFCS
+from scapy.all import Dot15d4, Dot15d4FCS, Dot15d4Data, Raw
 # Keep scapy from parsing the RF4CE payload
 Dot15d4Data.payload_guess = [({}, Raw)]
 
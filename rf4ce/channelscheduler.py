@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Chooses the RF4CE channel to transmit on.
+"""
+
+import threading
+
+
+CHANNELS = (15, 20, 25)
+
+
+class ChannelScheduler(object):
+
+	"""Orders the RF4CE channels of a link by ACK success
+
+	The success rate and the ACK latency of each channel are
+	exponentially weighted averages, so recent attempts count more.
+	Channels without history get a success rate of 0.5: they are
+	tried before channels that keep missing. The statistics dict is
+	the one of the link configuration, and is saved with it.
+	"""
+
+	PRIOR = 0.5
+
+	def __init__(self, stats=None, miss_budget=3, smoothing=0.2, channels=CHANNELS):
+		if stats is None:
+			stats = {}
+		self.stats = stats
+		self.miss_budget = miss_budget
+		self.smoothing = smoothing
+		self.channels = channels
+		self.lock = threading.Lock()
+
+	def get_channel_stats(self, channel):
+		if channel not in self.stats:
+			self.stats[channel] = {"attempts": 0, "acks": 0, "success": self.PRIOR,
+				"latency": None}
+		return self.stats[channel]
+
+	def record(self, channel, latency=None):
+		"""Records a transmission attempt, latency is None for a miss"""
+		with self.lock:
+			stats = self.get_channel_stats(channel)
+			stats["attempts"] += 1
+			success = 0.0 if latency is None else 1.0
+			stats["success"] += self.smoothing * (success - stats["success"])
+			if latency is not None:
+				stats["acks"] += 1
+				if stats["latency"] is None:
+					stats["latency"] = latency
+				else:
+					stats["latency"] += self.smoothing * (latency - stats["latency"])
+
+	def order(self, current=None):
+		"""Returns the channels, best first
+
+		Ties are broken by latency, then the current channel wins
+		"""
+		with self.lock:
+			def score(channel):
+				stats = self.stats.get(channel, {})
+				latency = stats.get("latency")
+				return (-stats.get("success", self.PRIOR),
+					latency if latency is not None else float("inf"),
+					channel != current)
+			return sorted(self.channels, key=score)
+
+	def schedule(self, current=None, rounds=5):
+		"""Generates the channels to try, best first, for rounds rounds
+
+		The order is updated at the start of each round
+		"""
+		for i in range(rounds):
+			for channel in self.order(current):
+				yield channel
+				current = channel
+
+	def __repr__(self):
+		result = "Channel statistics:"
+		for channel in self.channels:
+			stats = self.stats.get(channel)
+			if not stats or not stats["attempts"]:
+				result += "\n\tChannel {}: no attempts".format(channel)
+				continue
+			latency = "-"
+			if stats["latency"] is not None:
+				latency = "{:.3f} ms".format(stats["latency"] * 1e3)
+			result += "\n\tChannel {}: {}/{} ACKs, success {:.0f}%, latency {}".format(channel,
+				stats["acks"], stats["attempts"], stats["success"] * 100, latency)
+		return result
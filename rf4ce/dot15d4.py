@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight 802.15.4 MAC header parser.
+
+Much faster than a full scapy dissection, which is only needed
+to display every field of a frame.
+"""
+
+import struct
+
+import huepy as hue
+
+from fcs import write_fcs
+
+
+class Dot15d4Constants(object):
+	FRAME_TYPE_BEACON = 0
+	FRAME_TYPE_DATA = 1
+	FRAME_TYPE_ACK = 2
+	FRAME_TYPE_COMMAND = 3
+
+	ADDR_MODE_NONE = 0
+	ADDR_MODE_SHORT = 2
+	ADDR_MODE_LONG = 3
+
+
+FRAME_TYPE_NAMES = {
+	Dot15d4Constants.FRAME_TYPE_BEACON: "BEACON",
+	Dot15d4Constants.FRAME_TYPE_DATA: "DATA",
+	Dot15d4Constants.FRAME_TYPE_ACK: "ACK",
+	Dot15d4Constants.FRAME_TYPE_COMMAND: "COMMAND",
+}
+
+FRAME_CONTROL = struct.Struct("<HB")
+PANID = struct.Struct("<H")
+SHORT_ADDRESS = struct.Struct("<H")
+LONG_ADDRESS = struct.Struct("<Q")
+PANID_SHORT_ADDRESS = struct.Struct("<HH")
+PANID_LONG_ADDRESS = struct.Struct("<HQ")
+
+
+MAX_FRAME_SIZE = 127
+
+# 2.4 GHz O-QPSK PHY, 62.5 ksymbol/s
+SYMBOL_DURATION = 16e-6
+
+# macAckWaitDuration, in seconds
+MAC_ACK_WAIT_DURATION = 54 * SYMBOL_DURATION
+
+
+class Dot15d4Exception(Exception):
+	pass
+
+
+class Dot15d4Header(object):
+
+	"""Describes a 802.15.4 MAC header
+
+	Field names are the ones used by scapy. Long addresses are
+	integers, absent fields are None. When the PAN ID is compressed,
+	src_panid is the destination PAN ID.
+	"""
+
+	__slots__ = ("fcf_frametype", "fcf_security", "fcf_pending", "fcf_ackreq",
+		"fcf_panidcompress", "fcf_destaddrmode", "fcf_framever", "fcf_srcaddrmode",
+		"seqnum", "dest_panid", "dest_addr", "src_panid", "src_addr", "payload_offset")
+
+	def get_payload(self, data):
+		"""Returns the MAC payload of the frame, without the FCS"""
+		return data[self.payload_offset:-2]
+
+	def format_address(self, address, mode):
+		if mode == Dot15d4Constants.ADDR_MODE_LONG:
+			mac = "{:016x}".format(address)
+			return ':'.join(mac[i:i+2] for i in range(0, len(mac), 2))
+		return "0x{:04x}".format(address)
+
+	def to_dict(self):
+		"""Returns the header fields, for structured output"""
+		result = {}
+		result["frame_type"] = FRAME_TYPE_NAMES.get(self.fcf_frametype, "RESERVED").lower()
+		result["seqnum"] = self.seqnum
+		result["security"] = bool(self.fcf_security)
+		result["ackreq"] = bool(self.fcf_ackreq)
+		result["dest_panid"] = self.dest_panid
+		result["src_panid"] = self.src_panid
+		result["dest_addr"] = None
+		result["src_addr"] = None
+		if self.dest_addr is not None:
+			result["dest_addr"] = self.format_address(self.dest_addr, self.fcf_destaddrmode)
+		if self.src_addr is not None:
+			result["src_addr"] = self.format_address(self.src_addr, self.fcf_srcaddrmode)
+		return result
+
+	def __repr__(self):
+		result = "802.15.4 " + hue.lightblue(FRAME_TYPE_NAMES.get(self.fcf_frametype, "RESERVED"))
+		result += " - seq:" + hue.lightblue("0x{:02x}".format(self.seqnum))
+		if self.dest_panid is not None:
+			result += " - panid:" + hue.lightblue("0x{:04x}".format(self.dest_panid))
+		if self.src_addr is not None or self.dest_addr is not None:
+			src = "-"
+			if self.src_addr is not None:
+				src = self.format_address(self.src_addr, self.fcf_srcaddrmode)
+			dest = "-"
+			if self.dest_addr is not None:
+				dest = self.format_address(self.dest_addr, self.fcf_destaddrmode)
+			result += " - ({}) -> ({})".format(src, dest)
+		if self.fcf_security:
+			result += " - secured"
+		if self.fcf_ackreq:
+			result += " - ack requested"
+		return result
+
+
+def parse_header(data):
+	"""Parses the MAC header of a 802.15.4 frame, FCS included"""
+	header = Dot15d4Header()
+	try:
+		fcf, header.seqnum = FRAME_CONTROL.unpack_from(data)
+		header.fcf_frametype = fcf & 0b111
+		header.fcf_security = (fcf >> 3) & 1
+		header.fcf_pending = (fcf >> 4) & 1
+		header.fcf_ackreq = (fcf >> 5) & 1
+		header.fcf_panidcompress = (fcf >> 6) & 1
+		header.fcf_destaddrmode = dest_mode = (fcf >> 10) & 0b11
+		header.fcf_framever = (fcf >> 12) & 0b11
+		header.fcf_srcaddrmode = src_mode = (fcf >> 14) & 0b11
+		if dest_mode == 1 or src_mode == 1:
+			raise Dot15d4Exception("Reserved addressing mode")
+		offset = 3
+
+		if dest_mode == Dot15d4Constants.ADDR_MODE_SHORT:
+			header.dest_panid, header.dest_addr = PANID_SHORT_ADDRESS.unpack_from(data, offset)
+			offset += 4
+		elif dest_mode == Dot15d4Constants.ADDR_MODE_LONG:
+			header.dest_panid, header.dest_addr = PANID_LONG_ADDRESS.unpack_from(data, offset)
+			offset += 10
+		else:
+			header.dest_panid = None
+			header.dest_addr = None
+
+		if src_mode == Dot15d4Constants.ADDR_MODE_NONE:
+			header.src_panid = None
+			header.src_addr = None
+		elif header.fcf_panidcompress:
+			header.src_panid = header.dest_panid
+		else:
+			header.src_panid = PANID.unpack_from(data, offset)[0]
+			offset += 2
+
+		if src_mode == Dot15d4Constants.ADDR_MODE_SHORT:
+			header.src_addr = SHORT_ADDRESS.unpack_from(data, offset)[0]
+			offset += 2
+		elif src_mode == Dot15d4Constants.ADDR_MODE_LONG:
+			header.src_addr = LONG_ADDRESS.unpack_from(data, offset)[0]
+			offset += 8
+	except struct.error:
+		raise Dot15d4Exception("Truncated MAC header")
+
+	if offset > len(data) - 2:
+		raise Dot15d4Exception("Truncated MAC header")
+	header.payload_offset = offset
+	return header
+
+
+class Dot15d4DataTemplate(object):
+
+	"""Prebuilt 802.15.4 data frame
+
+	Short addresses, compressed PAN ID. The header is packed once in
+	a reusable buffer: building a frame only patches the seqnum, the
+	payload and the FCS.
+	"""
+
+	HEADER_SIZE = FRAME_CONTROL.size + PANID_SHORT_ADDRESS.size + SHORT_ADDRESS.size
+
+	def __init__(self, dest_panid, dest_addr, src_addr, ackreq=True):
+		self.dest_panid = dest_panid
+		self.dest_addr = dest_addr
+		self.src_addr = src_addr
+		self.ackreq = ackreq
+
+		fcf = Dot15d4Constants.FRAME_TYPE_DATA
+		fcf |= ackreq << 5
+		fcf |= 1 << 6 # PAN ID compression
+		fcf |= Dot15d4Constants.ADDR_MODE_SHORT << 10
+		fcf |= Dot15d4Constants.ADDR_MODE_SHORT << 14
+
+		self.buffer = bytearray(MAX_FRAME_SIZE)
+		FRAME_CONTROL.pack_into(self.buffer, 0, fcf, 0)
+		PANID_SHORT_ADDRESS.pack_into(self.buffer, FRAME_CONTROL.size, dest_panid, dest_addr)
+		SHORT_ADDRESS.pack_into(self.buffer, FRAME_CONTROL.size + PANID_SHORT_ADDRESS.size,
+			src_addr)
+
+	def get_fields(self):
+		return (self.dest_panid, self.dest_addr, self.src_addr, self.ackreq)
+
+	def build(self, seqnum, payload):
+		"""Returns a frame carrying payload, FCS included"""
+		end = self.HEADER_SIZE + len(payload)
+		if end + 2 > MAX_FRAME_SIZE:
+			raise Dot15d4Exception("Payload too long: {} bytes".format(len(payload)))
+		buffer = self.buffer
+		buffer[2] = seqnum
+		buffer[self.HEADER_SIZE:end] = payload
+		return bytes(buffer[:write_fcs(buffer, end)])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+802.15.4 frame check sequence.
+
+The FCS is a CRC-16/CCITT computed LSB first (also known as
+CRC-16/KERMIT). binascii.crc_hqx implements the MSB first variant of
+the same CRC with a precomputed table in C: bit reversing every input
+byte, and the result, turns one into the other.
+"""
+
+import binascii
+import struct
+
+
+def reverse_bits(byte):
+	"""Reverses the bit order of a byte"""
+	return int("{:08b}".format(byte)[::-1], 2)
+
+
+# Bit reversal table, usable with str.translate
+BIT_REVERSE = bytes(bytearray(reverse_bits(i) for i in range(256)))
+
+
+def make_fcs(data):
+	"""Returns the 2 bytes FCS of a frame"""
+	crc = binascii.crc_hqx(data.translate(BIT_REVERSE), 0)
+	return struct.pack(">H", crc).translate(BIT_REVERSE)
+
+
+def write_fcs(buffer, length):
+	"""Writes the FCS of the first length bytes of a bytearray right after them
+
+	Returns the length of the frame, FCS included
+	"""
+	crc = binascii.crc_hqx(buffer[:length].translate(BIT_REVERSE), 0)
+	buffer[length:length + 2] = struct.pack(">H", crc).translate(BIT_REVERSE)
+	return length + 2
+
+
+def check_fcs(frame):
+	"""Checks the FCS of a frame
+
+	The CRC of a frame followed by its FCS is always 0, so this
+	does not need to split the frame.
+	"""
+	return len(frame) > 2 and binascii.crc_hqx(frame.translate(BIT_REVERSE), 0) == 0
+
+
+def check_fcs_batch(frames):
+	"""Checks the FCS of a list of frames, returns a list of booleans"""
+	crc_hqx = binascii.crc_hqx
+	return [len(frame) > 2 and crc_hqx(frame.translate(BIT_REVERSE), 0) == 0
+		for frame in frames]
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Tracks the RF4CE frame counters of each link.
+"""
+
+import os
+import time
+import threading
+
+
+def link_id(dest_panid, source, destination):
+	"""Returns the index key of a link, from its PAN ID and the
+	addresses of its nodes, as formatted in the 802.15.4 records"""
+	return ("0x{:04x}".format(dest_panid), source, destination)
+
+
+class CounterWindow(object):
+
+	"""Frame counter state of a link
+
+	Bit i of window is set when counter highest - i was seen.
+	"""
+
+	__slots__ = ("highest", "window", "frames", "replays", "gaps", "missed")
+
+	def __init__(self, highest, window=1):
+		self.highest = highest
+		self.window = window
+		self.frames = 0
+		self.replays = 0
+		self.gaps = 0
+		self.missed = 0
+
+
+class FrameCounterIndex(object):
+
+	"""Frame counters of each link, with replay detection
+
+	As in IPsec anti-replay, the highest counter of each link is kept
+	with a bitmap of the WINDOW counters below it, so each update is
+	a few integer operations. A counter already seen in the window
+	is a replay, a counter below the window is stale, a counter more
+	than one above the highest means frames were missed.
+
+	With a journal file, the highest counter of the links that changed
+	are appended every checkpoint_interval seconds, instead of saving
+	every frame. The journal is rewritten once it is mostly made of
+	outdated lines. With read_only, the journal is loaded but never
+	written, so another process can keep writing it.
+	"""
+
+	WINDOW = 64
+
+	NEW = "new"
+	GAP = "gap"
+	LATE = "late"
+	REPLAY = "replay"
+	STALE = "stale"
+
+	# The journal is compacted past this many lines per link
+	COMPACT_RATIO = 8
+
+	def __init__(self, filename=None, checkpoint_interval=1.0, read_only=False):
+		self.filename = filename
+		self.checkpoint_interval = checkpoint_interval
+		self.links = {}
+		self.dirty = set()
+		self.lock = threading.Lock()
+		self.journal = None
+		self.journal_lines = 0
+		self.last_checkpoint = time.time()
+		if filename:
+			self.load()
+			if not read_only:
+				self.journal = open(filename, "a")
+
+	def load(self):
+		"""Reads the journal, the highest counter of each link wins
+
+		A truncated last line is ignored.
+		"""
+		if not os.path.exists(self.filename):
+			return
+		with open(self.filename, "r") as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) != 4:
+					continue
+				try:
+					counter = int(fields[3])
+				except ValueError:
+					continue
+				self.journal_lines += 1
+				link = tuple(fields[:3])
+				entry = self.links.get(link)
+				if entry is None:
+					self.links[link] = CounterWindow(counter)
+				elif counter > entry.highest:
+					entry.highest = counter
+					entry.window = 1
+
+	def update(self, link, counter, now=None):
+		"""Records the counter of a frame of the link
+
+		Returns its status and the number of counters missed before it
+		"""
+		with self.lock:
+			missed = 0
+			entry = self.links.get(link)
+			if entry is None:
+				entry = self.links[link] = CounterWindow(counter)
+				status = self.NEW
+			elif counter > entry.highest:
+				shift = counter - entry.highest
+				if shift < self.WINDOW:
+					entry.window = ((entry.window << shift) | 1) & ((1 << self.WINDOW) - 1)
+				else:
+					entry.window = 1
+				entry.highest = counter
+				missed = shift - 1
+				status = self.GAP if missed else self.NEW
+			elif entry.highest - counter >= self.WINDOW:
+				status = self.STALE
+			else:
+				bit = 1 << (entry.highest - counter)
+				if entry.window & bit:
+					status = self.REPLAY
+				else:
+					entry.window |= bit
+					status = self.LATE
+
+			entry.frames += 1
+			if status in (self.REPLAY, self.STALE):
+				entry.replays += 1
+			elif status == self.GAP:
+				entry.gaps += 1
+				entry.missed += missed
+			if status in (self.NEW, self.GAP):
+				self.dirty.add(link)
+
+			if now is None:
+				now = time.time()
+			if self.journal is not None and now - self.last_checkpoint >= self.checkpoint_interval:
+				self.write_checkpoint(now)
+			return status, missed
+
+	def get_highest(self, link):
+		"""Returns the highest counter seen on the link, or None"""
+		entry = self.links.get(link)
+		if entry is None:
+			return None
+		return entry.highest
+
+	def checkpoint(self):
+		"""Writes the links that changed to the journal"""
+		with self.lock:
+			if self.journal is not None:
+				self.write_checkpoint(time.time())
+
+	def write_checkpoint(self, now):
+		self.last_checkpoint = now
+		if not self.dirty:
+			return
+		if self.journal_lines + len(self.dirty) > self.COMPACT_RATIO * len(self.links):
+			self.compact()
+		else:
+			for link in self.dirty:
+				self.journal.write(self.format_line(link))
+			self.journal_lines += len(self.dirty)
+			self.journal.flush()
+		self.dirty.clear()
+
+	def compact(self):
+		"""Rewrites the journal with a single line per link"""
+		self.journal.close()
+		temp_filename = self.filename + ".tmp"
+		with open(temp_filename, "w") as f:
+			for link in self.links:
+				f.write(self.format_line(link))
+		os.rename(temp_filename, self.filename)
+		self.journal = open(self.filename, "a")
+		self.journal_lines = len(self.links)
+
+	def format_line(self, link):
+		return "{} {} {} {}\n".format(link[0], link[1], link[2], self.links[link].highest)
+
+	def close(self):
+		"""Writes a last checkpoint and closes the journal"""
+		with self.lock:
+			if self.journal is None:
+				return
+			self.write_checkpoint(time.time())
+			self.journal.close()
+			self.journal = None
+
+	def __len__(self):
+		return len(self.links)
+
+	def get_stats(self):
+		"""Returns the counters of all the links"""
+		stats = {"links": len(self.links), "frames": 0, "replays": 0, "gaps": 0, "missed": 0}
+		for entry in self.links.values():
+			stats["frames"] += entry.frames
+			stats["replays"] += entry.replays
+			stats["gaps"] += entry.gaps
+			stats["missed"] += entry.missed
+		return stats
+
+	def __repr__(self):
+		return ("Frame counters: {links} links, {frames} frames, {replays} replayed, "
+			"{gaps} gaps ({missed} counters missed)").format(**self.get_stats())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Identifies the key of ciphered frames matching no link.
+"""
+
+import os
+import signal
+import binascii
+import multiprocessing
+
+from rf4ce import Rf4ceAES, Rf4ceNode, Rf4ceConstants, address_to_raw
+
+
+ZERO_ADDRESS = "00:00:00:00:00:00:00:00"
+
+# Keyring of the worker processes, inherited when they are forked
+worker_keyring = None
+
+
+def init_worker(keyring):
+	global worker_keyring
+	worker_keyring = keyring
+	# Interruptions are handled by the parent process
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def try_chunk(args):
+	return worker_keyring.try_candidates(*args)
+
+
+def get_ciphered_part(data):
+	"""Returns the frame control, frame counter and ciphered payload
+	of a raw RF4CE frame, MIC included"""
+	frame_control = bytearray(data[:1])[0]
+	frame_counter = 0
+	for byte in reversed(bytearray(data[1:5])):
+		frame_counter = (frame_counter << 8) | byte
+	frame_type = frame_control & 0b11
+	if frame_type == Rf4ceConstants.FRAME_TYPE_DATA:
+		payload = data[6:]
+	elif frame_type == Rf4ceConstants.FRAME_TYPE_VENDOR:
+		payload = data[8:]
+	else:
+		payload = data[5:]
+	# The MIC covers the frame control with its reserved bit set,
+	# as rebuilt by Rf4ceFrame.get_frame_control()
+	return frame_control | 1 << 5, frame_counter, bytes(bytearray(payload))
+
+
+class Keyring(object):
+
+	"""Known keys, tried on ciphered frames that match no link
+
+	A key can come with the long addresses of its link, or alone: it
+	is then tried with every known address pair. Both directions of
+	each pair are tried. A candidate is the right one when the 4 bytes
+	MIC of the frame is valid.
+
+	With workers > 0, the candidates of a frame are split between
+	worker processes, forked by start().
+	"""
+
+	def __init__(self, workers=0):
+		self.workers = workers
+		self.keys = []
+		self.address_pairs = []
+		self.candidates = []
+		self.contexts = {}
+		self.pool = None
+		self.pool_pid = None
+
+		self.searches = 0
+		self.trials = 0
+		self.found = 0
+
+	def add(self, key, source=None, destination=None):
+		"""Adds a 16 bytes key, with the nodes of its link if known"""
+		self.keys.append((key, source, destination))
+		if source is not None and destination is not None:
+			self.add_address_pair(source, destination)
+
+	def add_address_pair(self, source, destination):
+		"""Adds the nodes of a link, tried with the keys without addresses"""
+		pair = (source.get_long_address(), destination.get_long_address())
+		if None in pair or pair in [(s.get_long_address(), d.get_long_address())
+				for s, d in self.address_pairs]:
+			return
+		self.address_pairs.append((source, destination))
+
+	def load(self, filename):
+		"""Loads a keyring file
+
+		Each line holds an hexadecimal key, optionally followed by
+		the long source and destination addresses of its link.
+		Empty lines and lines starting with # are ignored.
+		"""
+		with open(filename, "r") as f:
+			for number, line in enumerate(f, 1):
+				fields = line.split()
+				if not fields or fields[0].startswith("#"):
+					continue
+				try:
+					key = binascii.unhexlify(fields[0])
+					addresses = [address_to_raw(address) for address in fields[1:]]
+				except (TypeError, ValueError):
+					key = b''
+					addresses = []
+				if len(key) != 16 or len(fields) not in (1, 3) or \
+						any(len(address) != 8 for address in addresses):
+					raise ValueError("{}:{}: invalid keyring entry".format(filename, number))
+				if len(fields) == 3:
+					self.add(key, Rf4ceNode(fields[1], None), Rf4ceNode(fields[2], None))
+				else:
+					self.add(key)
+
+	def build_candidates(self):
+		"""Lists the (key index, source, destination) to try
+
+		Candidates of a key are contiguous, so they share its
+		cipher context.
+		"""
+		candidates = []
+		for key_index, (key, source, destination) in enumerate(self.keys):
+			if source is not None and destination is not None:
+				pairs = [(source, destination)]
+			else:
+				pairs = self.address_pairs
+			for source, destination in pairs:
+				candidates.append((key_index, source, destination))
+				candidates.append((key_index, destination, source))
+		self.candidates = candidates
+
+	def start(self):
+		"""Builds the candidates and forks the workers"""
+		self.build_candidates()
+		if self.workers:
+			self.pool = multiprocessing.Pool(self.workers, init_worker, (self,))
+			self.pool_pid = os.getpid()
+
+	def stop(self):
+		if self.pool is not None and os.getpid() == self.pool_pid:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def get_context(self, key_index):
+		"""Returns the cipher context of a key, created once"""
+		context = self.contexts.get(key_index)
+		if context is None:
+			key, source, destination = self.keys[key_index]
+			context = Rf4ceAES(key, Rf4ceNode(ZERO_ADDRESS, None), Rf4ceNode(ZERO_ADDRESS, None))
+			self.contexts[key_index] = context
+		return context
+
+	def try_candidates(self, frame_control, frame_counter, payload, start, end):
+		"""Returns the index of the first candidate authenticating the
+		frame, between start and end, or None"""
+		for index in range(start, end):
+			key_index, source, destination = self.candidates[index]
+			context = self.get_context(key_index)
+			# Only the nonce and the MAC header depend on the addresses
+			context.source = source.get_raw_address()
+			context.destination = destination.get_raw_address()
+			if context.check_mic(payload, frame_control, frame_counter):
+				return index
+		return None
+
+	def search(self, data):
+		"""Returns the (key, source, destination) of a raw ciphered
+		RF4CE frame, or None"""
+		if not self.candidates:
+			self.build_candidates()
+		frame_control, frame_counter, payload = get_ciphered_part(data)
+		count = len(self.candidates)
+		self.searches += 1
+
+		# Workers cannot be used from another process
+		if self.pool is not None and os.getpid() == self.pool_pid and count > 1:
+			step = max(1, -(-count // (self.workers * 4)))
+			chunks = [(frame_control, frame_counter, payload, start, min(start + step, count))
+				for start in range(0, count, step)]
+			matches = [index for index in self.pool.map(try_chunk, chunks) if index is not None]
+			index = matches[0] if matches else None
+		else:
+			index = self.try_candidates(frame_control, frame_counter, payload, 0, count)
+
+		self.trials += count if index is None else index + 1
+		if index is None:
+			return None
+		self.found += 1
+		key_index, source, destination = self.candidates[index]
+		return self.keys[key_index][0], source, destination
+
+	def __len__(self):
+		return len(self.keys)
+
+	def get_stats(self):
+		"""Returns the search counters"""
+		return {"keys": len(self.keys), "candidates": len(self.candidates),
+			"searches": self.searches, "trials": self.trials, "found": self.found}
+
+	def __repr__(self):
+		return ("Keyring: {keys} keys, {candidates} candidates, {found}/{searches} frames "
+			"identified, {trials} trials").format(**self.get_stats())
@@ -6,7 +6,21 @@ Describes a RF4CE link.
 import json
 import binascii
 
-from rf4ce import Rf4ceNode
+from rf4ce import Rf4ceNode, cipher_cache
+from dot15d4 import Dot15d4DataTemplate
+
+
+def parse_short_address(value):
+	"""Reads a short address of a JSON link, which can be missing"""
+	if value is None:
+		return None
+	return int(value, 16)
+
+
+def format_short_address(address):
+	if address is None:
+		return None
+	return "0x{:x}".format(address)
 
 
 class LinkConfig(object):
@@ -14,11 +28,17 @@ class LinkConfig(object):
 	"""Stores a RF4CE link information.
 
 	Stored RF4CE link information are:
-	source, destination, key, frame_counter, dest_panid
+	source, destination, key, frame_counter, dest_panid, channel_stats
+
+	Links loaded from a LinkStore are saved back to it.
 	"""
 
 	def __init__(self, config_filename=None):
 		self.config_filename = config_filename
+		self.header_template = None
+		self.store = None
+		self.store_id = None
+		self.name = None
 		if config_filename:
 			self.load()
 		else:
@@ -27,6 +47,7 @@ class LinkConfig(object):
 			self.destination = None
 			self.key = None
 			self.frame_counter = 0
+			self.channel_stats = {}
 
 	def load(self):
 		"""Loads link configuration from supplied JSON file"""
@@ -37,38 +58,73 @@ class LinkConfig(object):
 			raise
 
 		try:
-			json_config = json.load(f)
-			self.dest_panid = int(json_config["dest_panid"], 16)
-			self.source = Rf4ceNode(json_config["full_source"], 
-				int(json_config["short_source"], 16))
-			self.destination = Rf4ceNode(json_config["full_destination"],
-				int(json_config["short_destination"], 16))
-			if "key" in json_config:
-				self.key = json_config["key"]
-			else:
-				self.key = None
-			if "frame_counter" in json_config:
-				self.frame_counter = json_config["frame_counter"]
-			else:
-				self.frame_counter = 0
+			self.from_dict(json.load(f))
 		except (ValueError, KeyError):
 			print("Invalid JSON file")
 			raise
 
+	def from_dict(self, json_config):
+		"""Reads the link from its JSON representation"""
+		self.dest_panid = int(json_config["dest_panid"], 16)
+		self.source = Rf4ceNode(json_config["full_source"], 
+			parse_short_address(json_config.get("short_source")))
+		self.destination = Rf4ceNode(json_config["full_destination"],
+			parse_short_address(json_config.get("short_destination")))
+		if "key" in json_config:
+			self.key = json_config["key"]
+		else:
+			self.key = None
+		if "frame_counter" in json_config:
+			self.frame_counter = json_config["frame_counter"]
+		else:
+			self.frame_counter = 0
+		# ACK statistics of each channel, learned by the injector
+		self.channel_stats = dict((int(channel), stats)
+			for channel, stats in json_config.get("channels", {}).items())
 
-	def save(self, config_filename=None):
-		"""Saves link configuration to supplied JSON file"""
-		if config_filename:
-			self.config_filename = config_filename
+	def to_dict(self):
+		"""Returns the JSON representation of the link"""
 		json_config = {}
 		json_config["full_source"] = self.source.get_long_address()
-		json_config["short_source"] = "0x{:x}".format(self.source.get_short_address())
+		json_config["short_source"] = format_short_address(self.source.get_short_address())
 		json_config["full_destination"] = self.destination.get_long_address()
-		json_config["short_destination"] = "0x{:x}".format(self.destination.get_short_address())
+		json_config["short_destination"] = format_short_address(
+			self.destination.get_short_address())
 		json_config["dest_panid"] = "0x{:x}".format(self.dest_panid)
 		json_config["frame_counter"] = self.frame_counter
 		if self.key:
 			json_config["key"] = self.key
+		if self.channel_stats:
+			json_config["channels"] = dict((str(channel), stats)
+				for channel, stats in self.channel_stats.items())
+		return json_config
+
+	def get_cipher(self):
+		"""Returns the cached cipher context of the link"""
+		if not self.key:
+			return None
+		return cipher_cache.get(binascii.unhexlify(self.key), self.source, self.destination)
+
+	def get_header_template(self):
+		"""Returns the prebuilt header of the link's 802.15.4 data frames
+
+		It is built again if the PAN ID or the addresses change
+		"""
+		fields = (self.dest_panid, self.destination.get_short_address(),
+			self.source.get_short_address(), True)
+		if self.header_template is None or self.header_template.get_fields() != fields:
+			self.header_template = Dot15d4DataTemplate(*fields)
+		return self.header_template
+
+	def save(self, config_filename=None):
+		"""Saves link configuration to supplied JSON file, or to
+		its link store"""
+		if config_filename:
+			self.config_filename = config_filename
+		elif self.store is not None:
+			self.store.save(self)
+			return
+		json_config = self.to_dict()
 		try:
 			f = open(self.config_filename, "wb")
 		except IOError:
@@ -81,6 +137,8 @@ class LinkConfig(object):
 		result = "Link configuration:\n"
 		if self.config_filename:
 			result += "\tLoaded from '{}'\n".format(self.config_filename)
+		elif self.store is not None:
+			result += "\tLoaded from '{}', link '{}'\n".format(self.store.filename, self.name)
 		result += "\tSource: {}\n".format(self.source)
 		result += "\tDestination: {}\n".format(self.destination)
 		result += "\tPanid: 0x{:x}\n".format(self.dest_panid)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Indexes RF4CE links by PAN ID and addresses.
+"""
+
+import threading
+
+
+SHORT_ADDRESS_MODE = 2
+LONG_ADDRESS_MODE = 3
+
+
+def long_address_to_int(address):
+	"""Converts a string representation of a MAC address to an integer"""
+	return int(address.replace(":", ""), 16)
+
+
+class LinkRegistry(object):
+
+	"""Link configurations indexed by (dest_panid, source, destination)
+
+	Both short and long addresses are indexed, so matching a frame
+	against any number of links is a single dictionary lookup.
+	Links can be added and removed while lookups are in progress.
+	"""
+
+	def __init__(self, link_configs=[]):
+		self.index = {}
+		self.links = []
+		self.lock = threading.Lock()
+		for link_config in link_configs:
+			self.add(link_config)
+
+	def get_keys(self, link_config):
+		"""Returns the index keys of a link"""
+		addresses = []
+		for node in (link_config.source, link_config.destination):
+			node_addresses = []
+			if node.get_short_address() is not None:
+				node_addresses.append((SHORT_ADDRESS_MODE, node.get_short_address()))
+			if node.get_long_address() is not None:
+				node_addresses.append((LONG_ADDRESS_MODE,
+					long_address_to_int(node.get_long_address())))
+			addresses.append(node_addresses)
+
+		return [(link_config.dest_panid, src_mode, src, dest_mode, dest)
+			for src_mode, src in addresses[0] for dest_mode, dest in addresses[1]]
+
+	def add(self, link_config):
+		"""Adds a link, replacing the links using the same addresses"""
+		with self.lock:
+			keys = self.get_keys(link_config)
+			for key in keys:
+				previous = self.index.get(key)
+				if previous is not None:
+					self.unindex(previous)
+			for key in keys:
+				self.index[key] = link_config
+			self.links.append(link_config)
+
+	def remove(self, link_config):
+		"""Removes a link"""
+		with self.lock:
+			self.unindex(link_config)
+
+	def unindex(self, link_config):
+		for key in self.get_keys(link_config):
+			if self.index.get(key) is link_config:
+				del self.index[key]
+		if link_config in self.links:
+			self.links.remove(link_config)
+
+	def lookup(self, dest_panid, src_mode, src_addr, dest_mode, dest_addr):
+		"""Returns the link using these addresses, or None"""
+		return self.index.get((dest_panid, src_mode, src_addr, dest_mode, dest_addr))
+
+	def match(self, header):
+		"""Returns the link a parsed 802.15.4 header belongs to, or None"""
+		return self.index.get((header.dest_panid, header.fcf_srcaddrmode, header.src_addr,
+			header.fcf_destaddrmode, header.dest_addr))
+
+	def __len__(self):
+		return len(self.links)
+
+	def __iter__(self):
+		return iter(list(self.links))
+
+	def __contains__(self, link_config):
+		return link_config in self.links
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Stores RF4CE links in a SQLite database.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+from rf4ce import Rf4ceNode
+from linkconfig import LinkConfig
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+	id INTEGER PRIMARY KEY,
+	name TEXT NOT NULL UNIQUE,
+	dest_panid INTEGER NOT NULL,
+	full_source TEXT,
+	short_source INTEGER,
+	full_destination TEXT,
+	short_destination INTEGER,
+	key TEXT,
+	frame_counter INTEGER NOT NULL DEFAULT 0,
+	channels TEXT
+);
+CREATE INDEX IF NOT EXISTS links_short_addresses
+	ON links (dest_panid, short_source, short_destination);
+CREATE INDEX IF NOT EXISTS links_long_addresses
+	ON links (full_source, full_destination);
+"""
+
+COLUMNS = ("id", "name", "dest_panid", "full_source", "short_source", "full_destination",
+	"short_destination", "key", "frame_counter", "channels")
+
+
+def node_name(node):
+	"""Names a node after its short address, or its long address"""
+	if node.get_short_address() is not None:
+		return "{:04x}".format(node.get_short_address())
+	if node.get_long_address():
+		return node.get_long_address().replace(":", "")
+	return "none"
+
+
+def default_name(link_config):
+	"""Names a link after its PAN ID and addresses"""
+	return "{:04x}-{}-{}".format(link_config.dest_panid, node_name(link_config.source),
+		node_name(link_config.destination))
+
+
+class LinkStore(object):
+
+	"""Link configurations stored in a SQLite database
+
+	Each link has a unique name, JSON files are imported under their
+	base name. Links are indexed by PAN ID and short addresses, and
+	by long addresses. Frame counters are updated in place, with a
+	single statement, so concurrent processes never move them back.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		# Links are saved from the packet processor threads too
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.executescript(SCHEMA)
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def row_to_link(self, row):
+		fields = dict(zip(COLUMNS, row))
+		link_config = LinkConfig()
+		link_config.store = self
+		link_config.store_id = fields["id"]
+		link_config.name = fields["name"]
+		link_config.dest_panid = fields["dest_panid"]
+		link_config.source = Rf4ceNode(fields["full_source"], fields["short_source"])
+		link_config.destination = Rf4ceNode(fields["full_destination"],
+			fields["short_destination"])
+		link_config.key = fields["key"]
+		link_config.frame_counter = fields["frame_counter"]
+		if fields["channels"]:
+			link_config.channel_stats = dict((int(channel), stats)
+				for channel, stats in json.loads(fields["channels"]).items())
+		return link_config
+
+	def link_to_row(self, link_config):
+		channels = None
+		if link_config.channel_stats:
+			channels = json.dumps(dict((str(channel), stats)
+				for channel, stats in link_config.channel_stats.items()))
+		return (link_config.dest_panid, link_config.source.get_long_address(),
+			link_config.source.get_short_address(), link_config.destination.get_long_address(),
+			link_config.destination.get_short_address(), link_config.key or None,
+			link_config.frame_counter, channels)
+
+	def insert(self, link_config, name):
+		"""Inserts or updates a link, the lock must be held
+
+		An existing link keeps its id, so the links already loaded
+		from it can still be saved, and its frame counter is never
+		lowered.
+		"""
+		if name is None:
+			name = link_config.name or default_name(link_config)
+		row = self.link_to_row(link_config)
+		cursor = self.db.execute("UPDATE links SET dest_panid = ?, full_source = ?, "
+			"short_source = ?, full_destination = ?, short_destination = ?, key = ?, "
+			"frame_counter = MAX(frame_counter, ?), channels = ? WHERE name = ?", row + (name,))
+		if cursor.rowcount == 0:
+			self.db.execute("INSERT INTO links (dest_panid, full_source, short_source, "
+				"full_destination, short_destination, key, frame_counter, channels, name) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row + (name,))
+		link_config.store = self
+		link_config.store_id, link_config.frame_counter = self.db.execute(
+			"SELECT id, frame_counter FROM links WHERE name = ?", (name,)).fetchone()
+		link_config.name = name
+
+	def add(self, link_config, name=None):
+		"""Adds a link, updating the link with the same name"""
+		with self.lock:
+			with self.db:
+				self.insert(link_config, name)
+		return link_config.name
+
+	def save(self, link_config):
+		"""Writes back a link of the store, its frame counter is
+		never lowered"""
+		with self.lock:
+			with self.db:
+				if link_config.store_id is None:
+					self.insert(link_config, None)
+					return
+				self.db.execute("UPDATE links SET dest_panid = ?, full_source = ?, short_source = ?, "
+					"full_destination = ?, short_destination = ?, key = ?, "
+					"frame_counter = MAX(frame_counter, ?), "
+					"channels = ? WHERE id = ?",
+					self.link_to_row(link_config) + (link_config.store_id,))
+
+	def update_frame_counter(self, link_config, frame_counter):
+		"""Raises the stored frame counter of a link, never lowers it"""
+		with self.lock:
+			with self.db:
+				self.db.execute("UPDATE links SET frame_counter = MAX(frame_counter, ?) WHERE id = ?",
+					(frame_counter, link_config.store_id))
+
+	def get(self, name):
+		"""Returns the link with this name, or None"""
+		with self.lock:
+			row = self.db.execute("SELECT * FROM links WHERE name = ?", (name,)).fetchone()
+		if row is None:
+			return None
+		return self.row_to_link(row)
+
+	def find(self, dest_panid=None, source=None, destination=None):
+		"""Returns the links matching a PAN ID and addresses
+
+		Addresses are short (int) or long (string), None matches any.
+		"""
+		conditions = []
+		values = []
+		if dest_panid is not None:
+			conditions.append("dest_panid = ?")
+			values.append(dest_panid)
+		for column, address in (("source", source), ("destination", destination)):
+			if address is None:
+				continue
+			if isinstance(address, int):
+				conditions.append("short_{} = ?".format(column))
+			else:
+				conditions.append("full_{} = ?".format(column))
+			values.append(address)
+		query = "SELECT * FROM links"
+		if conditions:
+			query += " WHERE " + " AND ".join(conditions)
+		with self.lock:
+			rows = self.db.execute(query, values).fetchall()
+		return [self.row_to_link(row) for row in rows]
+
+	def get_all(self):
+		return self.find()
+
+	def import_json(self, filenames):
+		"""Imports JSON link files in a single transaction, each
+		named after its base name. Returns the names."""
+		links = []
+		for filename in filenames:
+			link_config = LinkConfig(filename)
+			links.append((link_config, os.path.splitext(os.path.basename(filename))[0]))
+		with self.lock:
+			with self.db:
+				for link_config, name in links:
+					self.insert(link_config, name)
+		return [name for link_config, name in links]
+
+	def export_json(self, directory):
+		"""Writes each link to a JSON file named after it, returns
+		the filenames"""
+		filenames = []
+		for link_config in self.get_all():
+			filename = os.path.join(directory, link_config.name + ".json")
+			with open(filename, "w") as f:
+				json.dump(link_config.to_dict(), f, indent=4)
+			filenames.append(filename)
+		return filenames
+
+	def __len__(self):
+		with self.lock:
+			return self.db.execute("SELECT COUNT(*) FROM links").fetchone()[0]
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy 802.15.4 O-QPSK modulator.
+
+Produces the same 4 MS/s baseband as the GNU Radio transmit chain:
+each 4 bits symbol is spread into 32 chips, even chips on I and odd
+chips on Q, every chip pair is shaped by a 4 samples half-sine and
+Q is delayed by half a pulse. A byte always gives the same 128
+samples before the Q offset, so they are looked up in a table.
+"""
+
+import numpy
+
+
+SAMPLE_RATE = 4e6
+SAMPLES_PER_BYTE = 128
+
+# Q is delayed by one chip, 2 samples
+Q_OFFSET = 2
+
+# Preamble and start of frame delimiter
+SHR = b'\x00\x00\x00\x00\xa7'
+
+MAX_PSDU_SIZE = 127
+
+# Wideband recordings hold channels 15, 20 and 25
+WIDEBAND_SAMPLE_RATE = 60e6
+WIDEBAND_CENTER_FREQ = 2450e6
+
+# Chips of symbol 0, c0 first. Symbols 1 to 7 are right rotations of
+# it by 4 chips, symbols 8 to 15 are symbols 0 to 7 with odd chips
+# inverted.
+SYMBOL_0_CHIPS = "11011001110000110101001000101110"
+
+HALF_SINE = numpy.sin(numpy.pi * numpy.arange(4) / 4)
+
+
+def symbol_chips(symbol):
+	"""Returns the 32 chips of a symbol, as a list of 0 and 1"""
+	chips = [int(c) for c in SYMBOL_0_CHIPS]
+	shift = 4 * (symbol % 8)
+	chips = chips[len(chips) - shift:] + chips[:len(chips) - shift]
+	if symbol >= 8:
+		chips = [c ^ (i % 2) for i, c in enumerate(chips)]
+	return chips
+
+
+def make_symbol_table():
+	"""Returns the (16, 16) table of the chip pairs of each symbol"""
+	table = numpy.empty((16, 16), dtype=numpy.complex64)
+	for symbol in range(16):
+		chips = 2 * numpy.array(symbol_chips(symbol), dtype=numpy.float32) - 1
+		table[symbol] = chips[0::2] + 1j * chips[1::2]
+	return table
+
+
+def make_byte_table():
+	"""Returns the (256, 128) table of the shaped samples of each byte
+
+	The low nibble is sent first. Q is not delayed yet.
+	"""
+	symbols = make_symbol_table()
+	pairs = numpy.concatenate((symbols[numpy.arange(256) & 0xf],
+		symbols[numpy.arange(256) >> 4]), axis=1)
+	return (numpy.repeat(pairs, 4, axis=1) * numpy.tile(HALF_SINE, 32)).astype(numpy.complex64)
+
+
+BYTE_TABLE = make_byte_table()
+
+
+def make_ppdu(psdu):
+	"""Prefixes a PSDU, FCS included, with the SHR and PHY header"""
+	if len(psdu) > MAX_PSDU_SIZE:
+		raise ValueError("PSDU too long: {} bytes".format(len(psdu)))
+	return SHR + bytes(bytearray([len(psdu)])) + bytes(psdu)
+
+
+def modulate_batch(psdus, gap=0):
+	"""Modulates a list of PSDUs into a single stream of samples
+
+	Each burst is followed by gap samples of silence. Returns a
+	complex64 array and the offset of each burst.
+	"""
+	ppdus = [make_ppdu(psdu) for psdu in psdus]
+	lengths = numpy.array([len(ppdu) * SAMPLES_PER_BYTE for ppdu in ppdus], dtype=numpy.intp)
+	data = numpy.frombuffer(b''.join(ppdus), dtype=numpy.uint8)
+	shaped = BYTE_TABLE[data].reshape(-1)
+
+	# Bursts are moved apart to make room for the Q tail and the gaps
+	spacing = Q_OFFSET + gap
+	offsets = numpy.zeros(len(ppdus), dtype=numpy.intp)
+	numpy.cumsum(lengths[:-1] + spacing, out=offsets[1:])
+	positions = numpy.arange(len(shaped)) + numpy.repeat(offsets - numpy.cumsum(lengths) + lengths,
+		lengths)
+
+	samples = numpy.zeros(int(lengths.sum()) + len(ppdus) * spacing, dtype=numpy.complex64)
+	view = samples.view(numpy.float32).reshape(-1, 2)
+	view[positions, 0] = shaped.real
+	view[positions + Q_OFFSET, 1] = shaped.imag
+	return samples, offsets
+
+
+def modulate(psdu):
+	"""Modulates a PSDU, FCS included, into complex64 samples"""
+	return modulate_batch([psdu])[0]
+
+
+def write_iq(filename, samples, sample_format="complex64"):
+	"""Writes samples to an IQ file
+
+	Sample formats are the ones of the recorded IQ file source:
+	complex64 and int16 (interleaved I/Q, full scale 32768)
+	"""
+	if sample_format == "complex64":
+		data = samples.astype(numpy.complex64)
+	elif sample_format == "int16":
+		scaled = samples.astype(numpy.complex64).view(numpy.float32) * 32767
+		data = numpy.clip(numpy.round(scaled), -32768, 32767).astype(numpy.int16)
+	else:
+		raise ValueError("Unknown sample format '{}'".format(sample_format))
+	with open(filename, "wb") as f:
+		data.tofile(f)
+
+
+def channel_frequency(channel):
+	"""Returns the center frequency of a 2.4 GHz channel, in Hz"""
+	return 1e6 * (2405 + 5 * (channel - 11))
+
+
+def modulate_wideband(bursts, gap=4096):
+	"""Modulates a list of (channel, psdu) into a 60 MS/s stream
+	centered on 2450 MHz
+
+	Each burst is modulated at 4 MS/s, followed by gap samples of
+	silence, interpolated in the frequency domain and shifted to its
+	channel. Returns a complex64 array and the offset of each burst.
+	"""
+	factor = int(WIDEBAND_SAMPLE_RATE / SAMPLE_RATE)
+	parts = []
+	offsets = []
+	position = 0
+	for channel, psdu in bursts:
+		burst = numpy.concatenate((modulate(psdu), numpy.zeros(gap, dtype=numpy.complex64)))
+		spectrum = numpy.fft.fft(burst)
+		half = (len(burst) + 1) // 2
+		padded = numpy.zeros(len(burst) * factor, dtype=numpy.complex128)
+		padded[:half] = spectrum[:half]
+		padded[len(padded) - len(burst) + half:] = spectrum[half:]
+		samples = numpy.fft.ifft(padded) * factor
+
+		# The carrier phase is continuous across bursts
+		shift = (channel_frequency(channel) - WIDEBAND_CENTER_FREQ) / WIDEBAND_SAMPLE_RATE
+		samples *= numpy.exp(2j * numpy.pi * shift * (position + numpy.arange(len(samples))))
+		parts.append(samples.astype(numpy.complex64))
+		offsets.append(position)
+		position += len(samples)
+	if not parts:
+		return numpy.zeros(0, dtype=numpy.complex64), numpy.zeros(0, dtype=numpy.intp)
+	return numpy.concatenate(parts), numpy.array(offsets, dtype=numpy.intp)
+
+
+def write_wideband_iq(filename, bursts, sample_format="complex64", gap=4096):
+	"""Writes a list of (channel, psdu) to a 60 MS/s IQ file, as read
+	by the wideband receive flow. Returns the offset of each burst."""
+	samples, offsets = modulate_wideband(bursts, gap)
+	write_iq(filename, samples, sample_format)
+	return offsets
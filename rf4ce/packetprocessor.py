@@ -3,37 +3,365 @@
 Packet processor tread. Used to process the incoming RF4CE packets.
 """
 
+from __future__ import print_function
+
+import sys
+import time
 import threading
-import Queue
+import collections
+import multiprocessing
+import signal
+import struct
+import traceback
 
 from linkconfig import LinkConfig
 from rf4ce import Rf4ceNode, Rf4ceFrame
+from fcs import check_fcs
+from stats import ProcessorStats
+
+
+# Size of the 802.15.4 address fields, indexed by addressing mode
+ADDRESS_SIZES = (0, 0, 2, 8)
+
+def link_key(data):
+	"""Returns the raw PAN ID and address fields of a 802.15.4 frame
+
+	Frames sharing these fields belong to the same link.
+	"""
+	if len(data) < 3:
+		return b''
+	fcf = struct.unpack("<H", data[:2])[0]
+	dest_mode = (fcf >> 10) & 0b11
+	src_mode = (fcf >> 14) & 0b11
+	end = 3
+	if dest_mode:
+		end += 2 + ADDRESS_SIZES[dest_mode]
+	if src_mode:
+		if not (fcf & (1 << 6)): # PAN ID compression
+			end += 2
+		end += ADDRESS_SIZES[src_mode]
+	return data[3:end]
+
+
+class PacketQueue(object):
+
+	"""Bounded packet queue
+
+	When the queue is full, put() either drops the oldest packet,
+	drops the new packet or blocks, depending on the policy.
+	Packets are taken out in batches.
+	"""
+
+	DROP_OLDEST = "drop-oldest"
+	DROP_NEWEST = "drop-newest"
+	BLOCK = "block"
+	POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+	def __init__(self, max_size=1024, policy=DROP_OLDEST):
+		if policy not in self.POLICIES:
+			raise ValueError("Unknown queue policy '{}'".format(policy))
+		self.max_size = max_size
+		self.policy = policy
+		self.items = collections.deque()
+		self.closed = False
+		self.unfinished = 0
+
+		self.lock = threading.Lock()
+		self.not_empty = threading.Condition(self.lock)
+		self.not_full = threading.Condition(self.lock)
+		self.all_done = threading.Condition(self.lock)
+
+		self.enqueued = 0
+		self.dropped = 0
+		self.high_water_mark = 0
+
+	def put(self, item):
+		"""Adds a packet, returns False if a packet had to be dropped
+
+		Packets put in a closed queue are dropped.
+		"""
+		with self.lock:
+			accepted = True
+			if self.closed:
+				self.dropped += 1
+				return False
+			if len(self.items) >= self.max_size:
+				if self.policy == self.DROP_NEWEST:
+					self.dropped += 1
+					return False
+				elif self.policy == self.DROP_OLDEST:
+					self.items.popleft()
+					self.dropped += 1
+					self.unfinished -= 1
+					accepted = False
+				else:
+					while len(self.items) >= self.max_size and not self.closed:
+						self.not_full.wait()
+					if self.closed:
+						self.dropped += 1
+						return False
+
+			self.items.append(item)
+			self.enqueued += 1
+			self.unfinished += 1
+			if len(self.items) > self.high_water_mark:
+				self.high_water_mark = len(self.items)
+			self.not_empty.notify()
+			return accepted
+
+	def get_batch(self, max_items):
+		"""Waits for packets and returns up to max_items of them
+
+		Returns an empty list once the queue is closed.
+		"""
+		with self.lock:
+			while not self.items and not self.closed:
+				self.not_empty.wait()
+			batch = [self.items.popleft() for i in range(min(max_items, len(self.items)))]
+			if batch:
+				self.not_full.notify_all()
+			return batch
+
+	def task_done(self, count=1):
+		"""Marks packets returned by get_batch() as processed"""
+		with self.lock:
+			self.unfinished -= count
+			if self.unfinished <= 0:
+				self.all_done.notify_all()
+
+	def join(self):
+		"""Waits until all the queued packets have been processed"""
+		with self.lock:
+			while self.unfinished > 0 and not self.closed:
+				self.all_done.wait()
+
+	def close(self):
+		"""Wakes up all the waiting threads, get_batch() stops blocking"""
+		with self.lock:
+			self.closed = True
+			self.not_empty.notify_all()
+			self.not_full.notify_all()
+			self.all_done.notify_all()
+
+	def __len__(self):
+		return len(self.items)
+
+	def get_stats(self):
+		"""Returns the queue counters"""
+		return {"enqueued": self.enqueued, "dropped": self.dropped,
+			"high_water_mark": self.high_water_mark, "size": len(self.items),
+			"max_size": self.max_size}
+
+	def __repr__(self):
+		return ("Queue: {enqueued} packets enqueued, {dropped} dropped, "
+			"high water mark {high_water_mark}/{max_size}").format(**self.get_stats())
 
 
 class PacketProcessor(threading.Thread):
 
-	"""Packet processor thread"""
+	"""Packet processor thread
 
-	def __init__(self):
+	By default, packets are processed in this thread. With workers > 0,
+	decode() runs in a pool of worker processes instead: packets are
+	sharded by link so a given link is always decoded by the same
+	worker, and output() is called in the order packets were fed.
+
+	Statistics are kept in self.stats. Subclasses can charge the time
+	spent in each stage of decode() and output() with
+	self.trace.lap(stage), and flag errors with self.trace.error: in
+	workers, traces are sent back with the results. Stage timings
+	are only taken with profile=True. With stats_interval, the
+	statistics are dumped periodically.
+	"""
+
+	def __init__(self, workers=0, queue_size=1024, queue_policy=PacketQueue.DROP_OLDEST,
+			batch_size=64, profile=False, stats_interval=0):
 		threading.Thread.__init__(self)
-		self.q = Queue.Queue()
+		self.q = PacketQueue(queue_size, queue_policy)
+		self.batch_size = batch_size
 		self.stopped = False
+		self.stopping = threading.Event()
+		self.workers = workers
+		self.collector = None
+		self.invalid_packets = 0
+		self.stats = ProcessorStats(profile)
+		self.trace = self.stats.trace()
+		self.stats_interval = stats_interval
+
+	def start(self):
+		# Workers are forked before any other thread of this object starts
+		if self.workers:
+			self.start_pool()
+		if self.stats_interval:
+			dumper = threading.Thread(target=self.dump_periodically)
+			dumper.daemon = True
+			dumper.start()
+		threading.Thread.start(self)
 
 	def stop(self):
 		self.stopped = True
+		self.stopping.set()
+		self.q.close()
+
+	def wait(self):
+		"""Waits for this thread, and the result collector with workers,
+		to return after stop()
+
+		Does nothing when called from one of them.
+		"""
+		current = threading.current_thread()
+		for thread in (self, self.collector):
+			if thread is not None and thread.ident is not None and thread is not current:
+				thread.join()
 
 	def run(self):
+		if self.workers:
+			self.dispatch()
+			return
 		while not self.stopped:
-			try:
-				data = self.q.get(timeout=1)
-			except Queue.Empty:
-				continue
-			self.process(data)
-	
-	def feed(self, data):
-		"""Adds packets to the queue"""
-		self.q.put(data)
-
-	def process(self, data):
-		"""This should process the incoming data"""
+			batch = self.q.get_batch(self.batch_size)
+			self.stats.record_queue(len(batch) + len(self.q))
+			for data, channel, fed in batch:
+				if self.stopped:
+					break
+				self.handle(data, channel, fed)
+			self.q.task_done(len(batch))
+
+	def handle(self, data, channel=None, fed=None):
+		"""Processes a packet and records its statistics
+
+		fed is the time it was handed over, if it was queued
+		"""
+		trace = self.trace = self.stats.trace()
+		self.process(data, channel)
+		self.stats.record(trace, link_key(data), fed)
+
+	def dump_stats(self, output=sys.stderr):
+		"""Prints the statistics"""
+		print(repr(self.stats), file=output)
+		print(repr(self.q), file=output)
+
+	def dump_periodically(self):
+		while not self.stopping.wait(self.stats_interval):
+			self.dump_stats()
+
+	def install_signal_handler(self, signum=signal.SIGUSR1):
+		"""Dumps the statistics when signum is received
+
+		Must be called from the main thread
+		"""
+		signal.signal(signum, lambda signum, frame: self.dump_stats())
+
+	def flush(self):
+		"""Waits until all the queued packets have been processed"""
+		self.q.join()
+
+	def feed(self, data, channel=None):
+		"""Adds packets to the queue, tagged with the channel they were received on
+
+		Packets with an invalid FCS are dropped right away
+		"""
+		if not check_fcs(data):
+			self.invalid_packets += 1
+			return
+		self.q.put((data, channel, time.time()))
+
+	def process(self, data, channel=None):
+		"""This should process the incoming data
+
+		By default, the packet is decoded then the result is output
+		"""
+		self.output(self.decode(data, channel))
+
+	def decode(self, data, channel=None):
+		"""Decodes a packet
+
+		With a worker pool, this runs in a worker process: the result
+		must be picklable, and changes made to this object are not seen
+		by the other processes. None results are not output.
+		"""
+		return None
+
+	def output(self, result):
+		"""Handles the result of decode(), always in the packets order"""
 		pass
+
+	def start_pool(self):
+		"""Starts the worker processes and the result collector"""
+		self.results = multiprocessing.Queue()
+		self.shards = []
+		self.pool = []
+		for i in range(self.workers):
+			shard = multiprocessing.Queue()
+			worker = multiprocessing.Process(target=self.work, args=(shard, self.results))
+			worker.daemon = True
+			worker.start()
+			self.shards.append(shard)
+			self.pool.append(worker)
+
+		self.collector = threading.Thread(target=self.collect)
+		self.collector.daemon = True
+		self.collector.start()
+
+	def dispatch(self):
+		"""Sends the queued packets to the workers, sharded by link"""
+		seqnum = 0
+		while not self.stopped:
+			batches = [[] for shard in self.shards]
+			batch = self.q.get_batch(self.batch_size)
+			self.stats.record_queue(len(batch) + len(self.q))
+			for data, channel, fed in batch:
+				link = link_key(data)
+				shard = hash(link) % self.workers
+				batches[shard].append((seqnum, data, channel, fed, link))
+				seqnum += 1
+
+			for shard, batch in zip(self.shards, batches):
+				if batch:
+					shard.put(batch)
+
+		for shard in self.shards:
+			shard.put(None)
+
+	def work(self, shard, results):
+		"""Worker process main loop"""
+		# Interruptions and statistics dumps are handled by the parent process
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+		while True:
+			batch = shard.get()
+			if batch is None:
+				break
+			decoded = []
+			for seqnum, data, channel, fed, link in batch:
+				trace = self.trace = self.stats.trace()
+				try:
+					result = self.decode(data, channel)
+				except Exception:
+					traceback.print_exc()
+					result = None
+					trace.error = True
+				decoded.append((seqnum, (result, trace.laps, trace.error, fed, link)))
+			results.put(decoded)
+		results.put(None)
+
+	def collect(self):
+		"""Outputs the decoded packets, in the order they were fed"""
+		pending = {}
+		next_seqnum = 0
+		running = self.workers
+		while running:
+			decoded = self.results.get()
+			if decoded is None:
+				running -= 1
+				continue
+			pending.update(decoded)
+			while next_seqnum in pending:
+				result, laps, error, fed, link = pending.pop(next_seqnum)
+				# Output stages are added to the trace of the worker
+				trace = self.trace = self.stats.trace(laps, error)
+				if result is not None:
+					self.output(result)
+				self.stats.record(trace, link, fed)
+				next_seqnum += 1
+				self.q.task_done()
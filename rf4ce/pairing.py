@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Follows RF4CE pairing procedures to recover the link keys.
+"""
+
+import time
+import threading
+
+
+CMD_PAIR_RESPONSE = 0x04
+CMD_KEY_SEED = 0x06
+
+KEY_SEED_COUNT = 0x25
+KEY_SEED_SIZE = 80
+KEY_SIZE = 16
+
+
+class PairingSession(object):
+
+	"""Key exchange of a single pairing
+
+	Key seeds are folded into a running XOR as they arrive, in
+	any order. A seed received twice is only counted once.
+	"""
+
+	def __init__(self, link_config, now=None):
+		self.link_config = link_config
+		self.seed = bytearray(KEY_SEED_SIZE)
+		self.received = [False] * KEY_SEED_COUNT
+		self.remaining = KEY_SEED_COUNT
+		self.started = self.last_seen = now if now is not None else time.time()
+
+	def add_seed(self, index, seed, frame_counter, now=None):
+		"""Folds a key seed in, returns False if it was already received"""
+		self.last_seen = now if now is not None else time.time()
+		if self.received[index]:
+			return False
+		self.received[index] = True
+		self.remaining -= 1
+		state = self.seed
+		for i, byte in enumerate(bytearray(seed)):
+			state[i] ^= byte
+		self.link_config.frame_counter = max(self.link_config.frame_counter, frame_counter)
+		return True
+
+	def is_complete(self):
+		return self.remaining == 0
+
+	def get_key(self):
+		"""Reduces the XOR of all the seeds to the 16 bytes key"""
+		key = bytearray(KEY_SIZE)
+		for offset in range(0, KEY_SEED_SIZE, KEY_SIZE):
+			for i in range(KEY_SIZE):
+				key[i] ^= self.seed[offset + i]
+		return bytes(key)
+
+
+class PairingTracker(object):
+
+	"""Follows concurrent pairings
+
+	Sessions are indexed by (panid, source, destination) of the frames
+	sent by the target: the pairing response starts a session, the
+	key seeds follow it. Sessions without any frame for timeout
+	seconds are dropped, unless timeout is None.
+	"""
+
+	def __init__(self, timeout=60.0):
+		self.timeout = timeout
+		self.sessions = {}
+		self.lock = threading.Lock()
+
+		self.started = 0
+		self.completed = 0
+		self.expired = 0
+		self.duplicates = 0
+		self.ignored = 0
+
+	def start(self, index, link_config, now=None):
+		"""Starts a session, replacing the previous pairing of the link"""
+		with self.lock:
+			session = PairingSession(link_config, now)
+			self.sessions[index] = session
+			self.started += 1
+			return session
+
+	def add_seed(self, index, seed_index, seed, frame_counter, now=None):
+		"""Adds a key seed to its session
+
+		Returns the session, or None if the seed cannot be used, and
+		whether the seed was new. Completed sessions are kept until
+		they time out, so late retransmissions are recognized.
+		"""
+		with self.lock:
+			session = self.sessions.get(index)
+			if session is None or seed_index >= KEY_SEED_COUNT or len(seed) != KEY_SEED_SIZE:
+				self.ignored += 1
+				return None, False
+			added = session.add_seed(seed_index, seed, frame_counter, now)
+			if not added:
+				self.duplicates += 1
+			elif session.is_complete():
+				self.completed += 1
+			return session, added
+
+	def expire(self, now=None):
+		"""Drops the stale sessions, returns the incomplete ones"""
+		if self.timeout is None:
+			return []
+		if now is None:
+			now = time.time()
+		with self.lock:
+			stale = [index for index, session in self.sessions.items()
+				if now - session.last_seen > self.timeout]
+			expired = [session for session in (self.sessions.pop(index) for index in stale)
+				if not session.is_complete()]
+			self.expired += len(expired)
+			return expired
+
+	def get_active(self):
+		"""Returns the number of incomplete sessions"""
+		return len([session for session in self.sessions.values() if not session.is_complete()])
+
+	def get_stats(self):
+		"""Returns the session counters"""
+		return {"started": self.started, "completed": self.completed, "expired": self.expired,
+			"duplicates": self.duplicates, "ignored": self.ignored, "active": self.get_active()}
+
+	def __repr__(self):
+		return ("Pairings: {started} started, {completed} completed, {expired} expired, "
+			"{active} active, {duplicates} duplicate and {ignored} unusable key seeds").format(
+			**self.get_stats())
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Reads 802.15.4 frames from pcap and pcapng capture files.
+"""
+
+import struct
+
+from fcs import make_fcs
+
+
+LINKTYPE_IEEE802_15_4_WITHFCS = 195
+LINKTYPE_IEEE802_15_4_NONASK_PHY = 215
+LINKTYPE_IEEE802_15_4_NOFCS = 230
+
+LINKTYPES = (LINKTYPE_IEEE802_15_4_WITHFCS, LINKTYPE_IEEE802_15_4_NONASK_PHY,
+	LINKTYPE_IEEE802_15_4_NOFCS)
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAPNG_OPT_ENDOFOPT = 0
+PCAPNG_OPT_IF_TSRESOL = 9
+
+
+class CaptureException(Exception):
+	pass
+
+
+class CaptureReader(object):
+
+	"""Iterates over the 802.15.4 frames of a pcap or pcapng file
+
+	Frames are read one at a time and returned as (timestamp, psdu)
+	tuples. The PSDU always ends with the FCS: it is computed for
+	captures that do not store it.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = open(filename, "rb")
+		magic = self.f.read(4)
+		if len(magic) < 4:
+			raise CaptureException("Empty capture file")
+		if struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+			self.frames = self.read_pcapng(magic)
+		else:
+			self.frames = self.read_pcap(magic)
+
+	def __iter__(self):
+		return self.frames
+
+	def close(self):
+		self.f.close()
+
+	def to_psdu(self, linktype, data):
+		"""Converts a captured frame to a PSDU, FCS included"""
+		if linktype == LINKTYPE_IEEE802_15_4_WITHFCS:
+			return data
+		if linktype == LINKTYPE_IEEE802_15_4_NOFCS:
+			return data + make_fcs(data)
+		if linktype == LINKTYPE_IEEE802_15_4_NONASK_PHY:
+			# Preamble, SFD and PHY header
+			return data[6:]
+		raise CaptureException("Unsupported link type: {}".format(linktype))
+
+	def read_pcap(self, magic):
+		for endian in "<>":
+			value = struct.unpack(endian + "I", magic)[0]
+			if value in (PCAP_MAGIC, PCAP_MAGIC_NS):
+				break
+		else:
+			raise CaptureException("Not a pcap or pcapng file")
+		resolution = 1e-9 if value == PCAP_MAGIC_NS else 1e-6
+
+		header = self.f.read(20)
+		if len(header) < 20:
+			raise CaptureException("Truncated pcap header")
+		linktype = struct.unpack(endian + "HHiIII", header)[5] & 0xffff
+		if linktype not in LINKTYPES:
+			raise CaptureException("Unsupported link type: {}".format(linktype))
+
+		record_header = struct.Struct(endian + "IIII")
+		read = self.f.read
+		while True:
+			header = read(16)
+			if len(header) < 16:
+				break
+			ts_sec, ts_frac, incl_len, orig_len = record_header.unpack(header)
+			data = read(incl_len)
+			if len(data) < incl_len:
+				break
+			yield ts_sec + ts_frac * resolution, self.to_psdu(linktype, data)
+
+	def read_pcapng(self, magic):
+		interfaces = []
+		endian = "<"
+		read = self.f.read
+		block = magic
+		while True:
+			header = block + read(8 - len(block))
+			if len(header) < 8:
+				break
+			block_type, block_length = struct.unpack(endian + "II", header)
+
+			if block_type == PCAPNG_SHB:
+				# The byte order magic tells the endianness of this section
+				byte_order = read(4)
+				if len(byte_order) < 4:
+					break
+				if struct.unpack("<I", byte_order)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+					endian = "<"
+				else:
+					endian = ">"
+				block_length = struct.unpack(endian + "I", header[4:])[0]
+				body = read(block_length - 16)
+				interfaces = []
+			else:
+				body = read(block_length - 12)
+			if len(read(4)) < 4:
+				break
+			block = b''
+
+			if block_type == PCAPNG_IDB:
+				linktype = struct.unpack(endian + "H", body[:2])[0]
+				interfaces.append((linktype, self.parse_tsresol(endian, body[8:])))
+
+			elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+				if block_type == PCAPNG_EPB:
+					interface_id, ts_high, ts_low, cap_len, orig_len = struct.unpack(
+						endian + "IIIII", body[:20])
+				else:
+					interface_id, drops, ts_high, ts_low, cap_len, orig_len = struct.unpack(
+						endian + "HHIIII", body[:20])
+				linktype, resolution = interfaces[interface_id]
+				if linktype not in LINKTYPES:
+					continue
+				timestamp = ((ts_high << 32) | ts_low) * resolution
+				yield timestamp, self.to_psdu(linktype, body[20:20 + cap_len])
+
+			elif block_type == PCAPNG_SPB:
+				linktype, resolution = interfaces[0]
+				if linktype not in LINKTYPES:
+					continue
+				orig_len = struct.unpack(endian + "I", body[:4])[0]
+				yield None, self.to_psdu(linktype, body[4:4 + orig_len])
+
+	def parse_tsresol(self, endian, options):
+		"""Reads the timestamp resolution from interface options"""
+		offset = 0
+		while offset + 4 <= len(options):
+			code, length = struct.unpack(endian + "HH", options[offset:offset + 4])
+			if code == PCAPNG_OPT_ENDOFOPT:
+				break
+			if code == PCAPNG_OPT_IF_TSRESOL:
+				tsresol = ord(options[offset + 4:offset + 5])
+				if tsresol & 0x80:
+					return 2.0 ** -(tsresol & 0x7f)
+				return 10.0 ** -tsresol
+			offset += 4 + (length + 3) // 4 * 4
+		return 1e-6
+
+
+def replay(filename, handler, timestamps=False):
+	"""Passes all the frames of a capture file to handler
+
+	Frames are handled as fast as possible, not in real time. With
+	timestamps, handler also gets the capture time of each frame.
+	Frames without one, as in pcapng simple packet blocks, get the
+	time of the previous frame, or None. Returns the number of frames.
+	"""
+	reader = CaptureReader(filename)
+	count = 0
+	last_timestamp = None
+	try:
+		for timestamp, data in reader:
+			if timestamp is None:
+				timestamp = last_timestamp
+			last_timestamp = timestamp
+			if timestamps:
+				handler(data, timestamp)
+			else:
+				handler(data)
+			count += 1
+	finally:
+		reader.close()
+	return count
@@ -3,28 +3,39 @@
 Low level gnuradio graphs for 802.15.4.
 """
 
-from math import pi, sin
+import collections
+import threading
+
 import numpy
 
 from gnuradio import blocks
-from gnuradio import digital
 from gnuradio import eng_notation
 from gnuradio import gr
 from gnuradio import iio
 from gnuradio.eng_option import eng_option
 from gnuradio.filter import firdes
-import es
+from gnuradio.filter import pfb
+from gnuradio.filter import rational_resampler_ccc
 import foo
-import ieee802_15_4
 import osmosdr
 import pmt
 
 from autognuradio.ieee802_15_4_oqpsk_phy import ieee802_15_4_oqpsk_phy
+from oqpsk import modulate, modulate_batch, channel_frequency
+from oqpsk import WIDEBAND_SAMPLE_RATE, WIDEBAND_CENTER_FREQ
+from virtualair import ChannelModel, virtual_air
 
 
 class TxFlow(gr.top_block):
 
-	def __init__(self, channel, processor, sdr_device="pluto-sdr"):
+	"""Transmits 802.15.4 frames
+
+	The virtual device sends the bursts to a VirtualAir instead of a
+	SDR. It is full-duplex when a processor is given, like the
+	PlutoSDR.
+	"""
+
+	def __init__(self, channel, processor, sdr_device="pluto-sdr", air=None):
 		gr.top_block.__init__(self, "Tx Flow")
 
 		##################################################
@@ -33,6 +44,9 @@ class TxFlow(gr.top_block):
 		self.channel = channel
 		self.sdr_device = sdr_device
 		self.processor = processor
+		self.air = air if air is not None else virtual_air
+		self.full_duplex = sdr_device == "pluto-sdr" or (sdr_device == "virtual" and
+			processor is not None)
 
 		##################################################
 		# Blocks
@@ -52,25 +66,17 @@ class TxFlow(gr.top_block):
 				int(4e6), int(4e6), 0x8000, False, 0, '', True)
 			self.sdr_source = iio.pluto_source('192.168.2.1', self.get_center_freq(),
 				int(4e6), int(4e6), 0x8000, True, True, True, "manual", 50, '', True)
+		elif self.sdr_device == "virtual":
+			if self.full_duplex:
+				self.sdr_source = virtual_source(self.air, self.channel)
+		else:
+			raise ValueError("Unknown SDR device '{}'".format(self.sdr_device))
+
+		# Bursts are modulated in NumPy and streamed straight to the sink
+		if self.sdr_device != "virtual":
+			self.burst_source_0 = burst_source()
 
-		self.ieee802_15_4_access_code_prefixer_0 = ieee802_15_4.access_code_prefixer()
-		self.es_source_0 = es.source(1*[gr.sizeof_gr_complex], 1, 2, 0)
-		self.digital_chunks_to_symbols_xx_0 = digital.chunks_to_symbols_bc(([(1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (1-1j), (-1+1j), (1+1j), (-1-1j), (-1-1j), (1+1j), (-1+1j), (-1+1j), (-1-1j), (1-1j), (-1-1j), (1-1j), (1+1j), (1-1j), (1+1j), (-1+1j), (1+1j), (-1-1j), (1-1j), (-1+1j), (-1+1j), (1-1j), (-1-1j), (-1-1j), (-1+1j), (1+1j), (-1+1j), (1+1j), (1-1j), (1+1j), (1-1j), (-1-1j)]), 16)
-		self.blocks_vector_source_x_0 = blocks.vector_source_c([0, sin(pi/4), 1, sin(3*pi/4)], True, 1, [])
-		self.blocks_tagged_stream_to_pdu_0 = blocks.tagged_stream_to_pdu(blocks.complex_t, 'pdu_length')
-		self.blocks_tagged_stream_multiply_length_0 = blocks.tagged_stream_multiply_length(gr.sizeof_gr_complex*1, 'pdu_length', 128)
-		self.blocks_tagged_stream_multiply_length_0.set_min_output_buffer(20000)
-		self.blocks_repeat_0 = blocks.repeat(gr.sizeof_gr_complex*1, 4)
-		self.blocks_pdu_to_tagged_stream_0_0_0 = blocks.pdu_to_tagged_stream(blocks.byte_t, 'pdu_length')
-		self.blocks_packed_to_unpacked_xx_0 = blocks.packed_to_unpacked_bb(4, gr.GR_LSB_FIRST)
-		self.blocks_multiply_xx_0 = blocks.multiply_vcc(1)
-		self.blocks_float_to_complex_0 = blocks.float_to_complex(1)
-		self.blocks_delay_0 = blocks.delay(gr.sizeof_float*1, 2)
-		self.blocks_complex_to_float_0 = blocks.complex_to_float(1)
-
-		self.msg_in_0 = msg_block_source()
-
-		if self.sdr_device == "pluto-sdr":
+		if self.full_duplex:
 			self.ieee802_15_4_oqpsk_phy_0 = ieee802_15_4_oqpsk_phy()
 			self.blocks_null_sink_0 = blocks.null_sink(gr.sizeof_gr_complex*1)
 
@@ -79,56 +85,74 @@ class TxFlow(gr.top_block):
 		##################################################
 		# Connections
 		##################################################
-		self.msg_connect((self.blocks_tagged_stream_to_pdu_0, 'pdus'), (self.es_source_0, 'schedule_event'))
-		self.msg_connect((self.ieee802_15_4_access_code_prefixer_0, 'out'), (self.blocks_pdu_to_tagged_stream_0_0_0, 'pdus'))
-		self.msg_connect((self.msg_in_0, 'msg_out'), (self.ieee802_15_4_access_code_prefixer_0, 'in'))
-		self.connect((self.blocks_complex_to_float_0, 1), (self.blocks_delay_0, 0))
-		self.connect((self.blocks_complex_to_float_0, 0), (self.blocks_float_to_complex_0, 0))
-		self.connect((self.blocks_delay_0, 0), (self.blocks_float_to_complex_0, 1))
-		self.connect((self.blocks_float_to_complex_0, 0), (self.sdr_sink, 0))
-		self.connect((self.blocks_multiply_xx_0, 0), (self.blocks_tagged_stream_multiply_length_0, 0))
-		self.connect((self.blocks_packed_to_unpacked_xx_0, 0), (self.digital_chunks_to_symbols_xx_0, 0))
-		self.connect((self.blocks_pdu_to_tagged_stream_0_0_0, 0), (self.blocks_packed_to_unpacked_xx_0, 0))
-		self.connect((self.blocks_repeat_0, 0), (self.blocks_multiply_xx_0, 1))
-		self.connect((self.blocks_tagged_stream_multiply_length_0, 0), (self.blocks_tagged_stream_to_pdu_0, 0))
-		self.connect((self.blocks_vector_source_x_0, 0), (self.blocks_multiply_xx_0, 0))
-		self.connect((self.digital_chunks_to_symbols_xx_0, 0), (self.blocks_repeat_0, 0))
-		self.connect((self.es_source_0, 0), (self.blocks_complex_to_float_0, 0))
-
-		if self.sdr_device == "pluto-sdr":
+		if self.sdr_device != "virtual":
+			self.connect((self.burst_source_0, 0), (self.sdr_sink, 0))
+
+		if self.full_duplex:
 			self.msg_connect((self.ieee802_15_4_oqpsk_phy_0, 'rxout'), (self.msg_out_0, 'msg_in'))
 			self.connect((self.ieee802_15_4_oqpsk_phy_0, 0), (self.blocks_null_sink_0, 0))
 			self.connect((self.sdr_source, 0), (self.ieee802_15_4_oqpsk_phy_0, 0))
 
+	# A virtual transmitter without receive path has no block to run
+	def start(self, *args):
+		if self.sdr_device != "virtual" or self.full_duplex:
+			gr.top_block.start(self, *args)
+
+	def stop(self):
+		if self.sdr_device != "virtual" or self.full_duplex:
+			gr.top_block.stop(self)
+
+	def wait(self):
+		if self.sdr_device != "virtual" or self.full_duplex:
+			gr.top_block.wait(self)
 
 	def get_channel(self):
 		return self.channel
 
 	def set_channel(self, channel):
 		self.channel = channel
-		if self.sdr_device == "hackrf":
+		if self.sdr_device == "virtual":
+			if self.full_duplex:
+				self.sdr_source.channel = channel
+		elif self.sdr_device == "hackrf":
 			self.sdr_source.set_center_freq(self.get_center_freq())
 		elif self.sdr_device == "pluto-sdr":
 			self.sdr_source.set_params(self.get_center_freq(),
 					int(4e6), int(20e6), True, True, True, "manual", 50, '', True)
 			self.sdr_sink.set_params(self.get_center_freq(), int(4e6), int(20e6), 0, '', True)
 
-	def frequency_switch(self):
-		channels = [15, 20, 25]
-		i = channels.index(self.get_channel())
-		self.set_channel(channels[(i+1)%3])
-
 	def get_center_freq(self):
 		return 1000000 * (2400 + 5 * (self.channel - 10))
 
 
 	def transmit(self, data):
-		self.msg_in_0.transmit(data)
+		"""Transmits a 802.15.4 frame, FCS included"""
+		self.transmit_samples(modulate(data))
+
+	def transmit_batch(self, frames, gap=0):
+		"""Transmits a list of frames as a single burst
+
+		Frames are separated by gap samples of silence
+		"""
+		self.transmit_samples(modulate_batch(frames, gap)[0])
+
+	def transmit_samples(self, samples):
+		if self.sdr_device == "virtual":
+			self.air.transmit(self.channel, samples)
+		else:
+			self.burst_source_0.transmit(samples)
 
 
 class RxFlow(gr.top_block):
 
-	def __init__(self, channel, processor, device="pluto-sdr"):
+	"""Receives 802.15.4 frames on a channel
+
+	The virtual device receives the bursts of a VirtualAir, through
+	channel_model.
+	"""
+
+	def __init__(self, channel, processor, device="pluto-sdr", iq_file=None,
+			sample_format="complex64", chunk_size=0x8000, air=None, channel_model=None):
 		gr.top_block.__init__(self, "Sniffer Flow")
 
 		self.processor = processor
@@ -138,6 +162,7 @@ class RxFlow(gr.top_block):
 		##################################################
 		self.channel = channel
 		self.device = device
+		self.sample_rate = 4e6
 
 		##################################################
 		# Blocks
@@ -158,6 +183,12 @@ class RxFlow(gr.top_block):
 		elif self.device == "pluto-sdr":
 			self.sdr_source = iio.pluto_source('192.168.2.1', self.get_center_freq(),
 				int(4e6), int(20e6), 0x8000, True, True, True, "manual", 50, '', True)
+		elif self.device == "file":
+			# Recorded at 4 MS/s, decoded as fast as possible (no throttle)
+			self.sdr_source = mmap_iq_source(iq_file, sample_format, chunk_size)
+		elif self.device == "virtual":
+			self.sdr_source = virtual_source(air if air is not None else virtual_air,
+				self.channel, channel_model)
 
 
 		self.ieee802_15_4_oqpsk_phy_0 = ieee802_15_4_oqpsk_phy()
@@ -177,7 +208,9 @@ class RxFlow(gr.top_block):
 
 	def set_channel(self, channel):
 		self.channel = channel
-		if self.device == "hackrf":
+		if self.device == "virtual":
+			self.sdr_source.channel = channel
+		elif self.device == "hackrf":
 			self.sdr_source.set_center_freq(self.get_center_freq())
 		elif self.device == "pluto-sdr":
 			self.sdr_source.set_params('192.168.2.1', self.get_center_freq(),
@@ -187,10 +220,135 @@ class RxFlow(gr.top_block):
 		return 1000000 * (2400 + 5 * (self.channel - 10))
 
 
+class WidebandRxFlow(gr.top_block):
+
+	"""Receives channels 15, 20 and 25 at once
+
+	A single 60 MS/s stream centered on 2450 MHz (channel 20) is split
+	into 5 MHz wide bins by a polyphase channelizer: channels 15, 20 and
+	25 are the bins at -25 MHz, 0 and +25 MHz. Each of them is resampled
+	to 4 MS/s and decoded by its own PHY, and the received frames are
+	tagged with their channel.
+
+	Only recordings are supported: the PlutoSDR (AD9363, USB 2) and
+	the HackRF cannot stream 60 MS/s. oqpsk.write_wideband_iq()
+	generates synthetic recordings.
+	"""
+
+	CHANNELS = (15, 20, 25)
+	CENTER_FREQ = WIDEBAND_CENTER_FREQ
+	SAMPLE_RATE = WIDEBAND_SAMPLE_RATE
+	CHANNEL_SPACING = 5e6
+
+	def __init__(self, processor, device="file", iq_file=None,
+			sample_format="complex64", chunk_size=0x8000):
+		gr.top_block.__init__(self, "Wideband Sniffer Flow")
+
+		self.processor = processor
+
+		##################################################
+		# Variables
+		##################################################
+		self.device = device
+		self.sample_rate = self.SAMPLE_RATE
+		self.bins = int(self.SAMPLE_RATE / self.CHANNEL_SPACING)
+
+		##################################################
+		# Blocks
+		##################################################
+		if self.device == "file":
+			# Recorded at 60 MS/s, centered on channel 20
+			self.sdr_source = mmap_iq_source(iq_file, sample_format, chunk_size)
+		else:
+			raise ValueError("Device '{}' cannot capture {:.0f} MHz".format(
+				self.device, self.SAMPLE_RATE / 1e6))
+
+		# The O-QPSK main lobe is 3 MHz wide, the filter stops at the
+		# Nyquist frequency of the resampled channels
+		taps = firdes.low_pass_2(1, self.SAMPLE_RATE, 1.5e6, 1e6, 60)
+		self.channelizer = pfb.channelizer_ccf(self.bins, taps, 1.0, 100)
+		# Only the mapped bins are filtered and output
+		self.channelizer.set_channel_map([self.get_bin(channel) for channel in self.CHANNELS])
+
+		self.resamplers = []
+		self.phys = []
+		self.null_sinks = []
+		self.msg_outs = []
+		for channel in self.CHANNELS:
+			self.resamplers.append(rational_resampler_ccc(interpolation=4, decimation=5))
+			self.phys.append(ieee802_15_4_oqpsk_phy())
+			self.null_sinks.append(blocks.null_sink(gr.sizeof_gr_complex*1))
+			self.msg_outs.append(msg_sink_block(self.processor, channel))
+
+		##################################################
+		# Connections
+		##################################################
+		self.connect((self.sdr_source, 0), (self.channelizer, 0))
+		for i in range(len(self.CHANNELS)):
+			self.connect((self.channelizer, i), (self.resamplers[i], 0))
+			self.connect((self.resamplers[i], 0), (self.phys[i], 0))
+			self.connect((self.phys[i], 0), (self.null_sinks[i], 0))
+			self.msg_connect((self.phys[i], 'rxout'), (self.msg_outs[i], 'msg_in'))
+
+	def get_bin(self, channel):
+		"""Returns the channelizer output of a channel
+
+		Bins are in FFT order: 0 is centered, negative frequencies
+		are at the end.
+		"""
+		offset = channel_frequency(channel) - self.CENTER_FREQ
+		return int(round(offset / self.CHANNEL_SPACING)) % self.bins
+
+
+class mmap_iq_source(gr.sync_block):
+
+	"""Streams a recorded IQ file, read through memory mapping
+
+	Supported sample formats are complex64 (GNU Radio file sink)
+	and int16 (interleaved I/Q, full scale 32768)
+	"""
+
+	SAMPLE_FORMATS = ("complex64", "int16")
+
+	def __init__(self, filename, sample_format="complex64", chunk_size=0x8000):
+
+		gr.sync_block.__init__(
+			 self,
+			 name="mmap_iq_source",
+			 in_sig=None,
+			 out_sig=[numpy.complex64])
+
+		if sample_format == "complex64":
+			self.samples = numpy.memmap(filename, dtype=numpy.complex64, mode="r")
+		elif sample_format == "int16":
+			raw = numpy.memmap(filename, dtype=numpy.int16, mode="r")
+			self.samples = raw[:len(raw) // 2 * 2].reshape(-1, 2)
+		else:
+			raise ValueError("Unknown sample format '{}'".format(sample_format))
+
+		self.sample_format = sample_format
+		self.chunk_size = chunk_size
+		self.offset = 0
+
+	def work(self, input_items, output_items):
+		out = output_items[0]
+		n = min(len(out), self.chunk_size, len(self.samples) - self.offset)
+		if n <= 0:
+			return -1 # WORK_DONE
+
+		chunk = self.samples[self.offset:self.offset + n]
+		if self.sample_format == "int16":
+			# Scales straight into the output buffer, seen as float32 pairs
+			numpy.multiply(chunk, 1.0 / 32768, out=out[:n].view(numpy.float32).reshape(n, 2))
+		else:
+			out[:n] = chunk
+		self.offset += n
+		return n
+
 
 class msg_sink_block(gr.basic_block):
 
-	def __init__(self, processor):
+	def __init__(self, processor, channel=None):
 
 		gr.basic_block.__init__(
 			 self,
@@ -199,6 +357,7 @@ class msg_sink_block(gr.basic_block):
 			 out_sig=None)
 
 		self.processor = processor
+		self.channel = channel
 		self.message_port_register_in(pmt.intern('msg_in'))
 		self.set_msg_handler(pmt.intern('msg_in'), self.handle_msg)
 
@@ -206,24 +365,115 @@ class msg_sink_block(gr.basic_block):
 		messages = pmt.to_python(msg)
 		for message in messages:
 			if type(message) == numpy.ndarray:
-				self.processor.feed(message.tostring())
+				self.processor.feed(message.tostring(), self.channel)
+
 
+class burst_source(gr.sync_block):
 
-class msg_block_source(gr.basic_block):
+	"""Streams the queued bursts, and zeros between them"""
 
 	def __init__(self):
 
-		gr.basic_block.__init__(
+		gr.sync_block.__init__(
 			 self,
-			 name="msg_block",
+			 name="burst_source",
 			 in_sig=None,
-			 out_sig=None)
+			 out_sig=[numpy.complex64])
+
+		self.bursts = collections.deque()
+		self.offset = 0
+		self.lock = threading.Lock()
+
+	def transmit(self, samples):
+		"""Queues a burst of complex64 samples"""
+		with self.lock:
+			self.bursts.append(samples)
+
+	def work(self, input_items, output_items):
+		out = output_items[0]
+		n = 0
+		with self.lock:
+			while self.bursts and n < len(out):
+				burst = self.bursts[0]
+				count = min(len(out) - n, len(burst) - self.offset)
+				out[n:n + count] = burst[self.offset:self.offset + count]
+				n += count
+				self.offset += count
+				if self.offset == len(burst):
+					self.bursts.popleft()
+					self.offset = 0
+		out[n:] = 0
+		return len(out)
+
+
+class virtual_source(gr.sync_block):
+
+	"""Streams the bursts of a VirtualAir heard on a channel
+
+	Each burst is followed by some noise so the PHY can flush it.
+	Between bursts, noise is output in small chunks, after waiting
+	for a burst a little, so an idle receiver does not spin.
+	"""
+
+	TAIL = 1024
+	IDLE_SIZE = 4096
+	IDLE_TIMEOUT = 0.01
+
+	def __init__(self, air, channel, channel_model=None):
+
+		gr.sync_block.__init__(
+			 self,
+			 name="virtual_source",
+			 in_sig=None,
+			 out_sig=[numpy.complex64])
 
-		self.message_port_register_out(pmt.intern('msg_out'))
-	
-	def transmit(self, data):
-		vector = pmt.make_u8vector(len(data), 0)
-		for i, c in enumerate(data):
-			pmt.u8vector_set(vector, i, ord(data[i]))
-		pdu = pmt.cons(pmt.make_dict(), vector)
-		self.message_port_pub(pmt.intern('msg_out'), pdu)
+		self.air = air
+		self.channel = channel
+		if channel_model is None:
+			channel_model = ChannelModel()
+		self.channel_model = channel_model
+		self.bursts = collections.deque()
+		self.offset = 0
+		self.produced = 0
+		self.ready = threading.Condition()
+
+	def start(self):
+		self.air.attach(self)
+		return True
+
+	def stop(self):
+		self.air.detach(self)
+		with self.ready:
+			self.ready.notify_all()
+		return True
+
+	def deliver(self, channel, samples):
+		"""Queues a burst sent on channel, if it is heard"""
+		if not self.channel_model.is_routed(channel, self.channel):
+			return
+		burst = numpy.concatenate((self.channel_model.apply(samples),
+			self.channel_model.noise(self.TAIL)))
+		with self.ready:
+			self.bursts.append(burst)
+			self.ready.notify()
+
+	def work(self, input_items, output_items):
+		out = output_items[0]
+		n = 0
+		with self.ready:
+			if not self.bursts:
+				self.ready.wait(self.IDLE_TIMEOUT)
+			while self.bursts and n < len(out):
+				burst = self.bursts[0]
+				count = min(len(out) - n, len(burst) - self.offset)
+				out[n:n + count] = burst[self.offset:self.offset + count]
+				n += count
+				self.offset += count
+				if self.offset == len(burst):
+					self.bursts.popleft()
+					self.offset = 0
+		if not n:
+			n = min(len(out), self.IDLE_SIZE)
+			out[:n] = self.channel_model.noise(n)
+		self.produced += n
+		return n
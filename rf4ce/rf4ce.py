@@ -9,6 +9,8 @@ from builtins import *
 
 import struct
 import binascii
+import threading
+from collections import OrderedDict
 
 from Crypto.Cipher import AES
 from Crypto.Util.strxor import strxor
@@ -21,41 +23,101 @@ class Rf4ceConstants(object):
 	FRAME_TYPE_VENDOR = 0b11
 
 
+FRAME_TYPE_NAMES = {
+	Rf4ceConstants.FRAME_TYPE_DATA: "data",
+	Rf4ceConstants.FRAME_TYPE_COMMAND: "command",
+	Rf4ceConstants.FRAME_TYPE_VENDOR: "vendor",
+}
+
+
 def address_to_raw(address):
 	"""Converts a string representation of a MAC address
 	to bytes"""
 	return bytes([int(n, 16) for n in address.split(":")][::-1])
 
 
+def raw_to_address(raw):
+	"""Converts a raw MAC address to its string representation"""
+	return ":".join("{:02x}".format(n) for n in bytearray(raw)[::-1])
+
+
 def pad128(data):
 	"""Pads data so its length is a multiple of 128"""
 	return data + b'\x00' * (16 - (len(data) % 16)) 
 
 
+ZERO_BLOCK = b'\x00' * 16
+
+# CCM B0 block followed by the authentication data block
+MAC_HEADER = struct.Struct("<B8sIBBBBBBI8sB")
+
+# CCM nonce: source address, frame counter, security level
+NONCE = struct.Struct("<8sIB")
+
+# CCM counter block: flags, nonce, counter
+CTR_BLOCK = struct.Struct(">B13sH")
+
+# Raw long address, as sent on air
+LONG_ADDRESS = struct.Struct("<Q")
+
+# Frame control and frame counter
+FRAME_HEADER = struct.Struct("<BI")
+
+# Profile identifier, command identifier
+BYTE = struct.Struct("<B")
+
+# Profile and vendor identifiers
+VENDOR_HEADER = struct.Struct("<BH")
+
+
 class Rf4ceException(Exception):
 	pass
 
 
 class Rf4ceNode(object):
 
-	"""Describes a RF4CE node (target or originator)"""
+	"""Describes a RF4CE node (target or originator)
+
+	The long address is kept raw, as used by the cipher, and its
+	string representation is only built when first needed.
+	"""
+
+	__slots__ = ("raw_address", "short_address", "address_string")
 
 	def __init__(self, long_address, short_address):
+		self.long_address = long_address
+		self.short_address = short_address
 
+	@property
+	def long_address(self):
+		if self.address_string is None and self.raw_address is not None:
+			self.address_string = raw_to_address(self.raw_address)
+		return self.address_string
+
+	@long_address.setter
+	def long_address(self, long_address):
 		if isinstance(long_address, int):
-			mac = "{:016x}".format(long_address)
-			mac = ':'.join(mac[i:i+2] for i in range(0, len(mac), 2))
-			self.long_address = mac
+			self.raw_address = LONG_ADDRESS.pack(long_address)
+			self.address_string = None
+		elif long_address:
+			self.raw_address = address_to_raw(long_address)
+			self.address_string = long_address
 		else:
-			self.long_address = long_address
-		self.short_address = short_address
+			self.raw_address = None
+			self.address_string = None
 	
 	def get_long_address(self):
 		return self.long_address
 
+	def get_raw_address(self):
+		return self.raw_address
+
 	def get_short_address(self):
 		return self.short_address
 
+	def to_dict(self):
+		return {"long_address": self.long_address, "short_address": self.short_address}
+
 	def __repr__(self):
 		repr = []
 		if self.long_address:
@@ -67,93 +129,266 @@ class Rf4ceNode(object):
 
 class Rf4ceAES(object):
 
-	"""Implements the algorythm used by RF4CE to cipher payload"""
+	"""Implements the algorythm used by RF4CE to cipher payload
+
+	AES-128-CCM with a 4 bytes MIC. Work is done in buffers allocated
+	once per context: the CTR keystream of a whole batch of frames is
+	generated with a single ECB call, the CBC-MAC of a frame with a
+	single CBC call, and the payloads are XORed in a single call.
+	"""
+
+	M = 4
 
 	def __init__(self, key, source, destination):
-		self.source = address_to_raw(source.get_long_address())
-		self.destination = address_to_raw(destination.get_long_address())
+		self.source = source.get_raw_address()
+		self.destination = destination.get_raw_address()
 		self.cipher_engine = AES.new(key, AES.MODE_ECB)
 
-		self.M = 4
+		# The CBC-MAC engine is never reset: its chaining value is kept
+		# in mac_state and cancelled out of the first block of each MAC
+		self.mac_engine = AES.new(key, AES.MODE_CBC, iv=ZERO_BLOCK)
+		self.mac_state = bytearray(16)
+
+		self.lock = threading.Lock()
+		self.buffer_size = 0
+		self.mac_buffer_size = 0
+		self.reserve(10 * 16, 10 * 16)
+
+	def reserve(self, buffer_size, mac_buffer_size):
+		"""Makes sure the work buffers are large enough"""
+		if buffer_size > self.buffer_size:
+			self.buffer_size = buffer_size
+			self.ctr_buffer = bytearray(buffer_size)
+			self.ctr_view = memoryview(self.ctr_buffer)
+			self.keystream = bytearray(buffer_size)
+			self.keystream_view = memoryview(self.keystream)
+			self.work_buffer = bytearray(buffer_size)
+			self.work_view = memoryview(self.work_buffer)
+		if mac_buffer_size > self.mac_buffer_size:
+			self.mac_buffer_size = mac_buffer_size
+			self.mac_buffer = bytearray(mac_buffer_size)
+			self.mac_view = memoryview(self.mac_buffer)
 
 	def E(self, data):
 		return self.cipher_engine.encrypt(data)
 
 	def gen_nonce(self, frame_counter_value):
-		frame_counter = struct.pack("I", frame_counter_value)
-		security_level = b'\x05'
-		return self.source + frame_counter + security_level
-		
-	def gen_a(self, frame_control_value, frame_counter_value):
-		frame_control = struct.pack("B", frame_control_value)
-		frame_counter = struct.pack("I", frame_counter_value)
-		return frame_control + frame_counter + self.destination
-
-	def gen_auth(self, plain_text, frame_control_value, frame_counter_value):
-		a = self.gen_a(frame_control_value, frame_counter_value)
-		nonce = self.gen_nonce(frame_counter_value)
-		
-		auth_data = pad128(struct.pack(">H", len(a)) + a)
-		auth_data += pad128(plain_text)
-
-		B = b'\x49' + nonce + struct.pack(">H", len(plain_text))
-		X = b'\x00' * 16
-		X = self.E(strxor(X, B))
-		for i in range(1, len(auth_data) // 16 + 1):
-			B = auth_data[(i-1)*16:i*16]
-			X = self.E(strxor(X, B))		
+		return NONCE.pack(self.source, frame_counter_value, 0x05)
 
-		return X[:self.M]
+	def compute_mac(self, plain_text, frame_control_value, frame_counter_value):
+		"""Computes the CBC-MAC of a frame
 
-	def cipher(self, plain_text, frame_control_value, frame_counter_value):
-		nonce = self.gen_nonce(frame_counter_value)
+		Returns a view on the MIC, only valid until the next call
+		"""
+		length = len(plain_text)
+		# Just like pad128, aligned data gets a full block of padding
+		end = 32 + (length // 16 + 1) * 16
+		self.reserve(0, end)
+
+		buf = self.mac_buffer
+		MAC_HEADER.pack_into(buf, 0, 0x49, self.source, frame_counter_value, 0x05,
+			length >> 8, length & 0xff, 0x00, 13, frame_control_value,
+			frame_counter_value, self.destination, 0x00)
+		buf[32:32 + length] = plain_text
+		buf[32 + length:end] = ZERO_BLOCK[:end - 32 - length]
+
+		view = self.mac_view[:end]
+		strxor(view[:16], self.mac_state, output=view[:16])
+		self.mac_engine.encrypt(view, output=view)
+		self.mac_state[:] = view[end - 16:]
+		return view[end - 16:end - 16 + self.M]
 
-		T = self.gen_auth(plain_text, frame_control_value, frame_counter_value)
+	def gen_auth(self, plain_text, frame_control_value, frame_counter_value):
+		with self.lock:
+			mac = self.compute_mac(plain_text, frame_control_value, frame_counter_value)
+			return mac.tobytes()
+
+	def load_keystream(self, frames):
+		"""Generates the keystream of a batch of (frame_counter, length)
+
+		Each frame gets a region made of its counter blocks A1..An
+		followed by A0. Once ciphered, the first M bytes of E(A0) are
+		moved right after the payload keystream, so the payload and
+		the MIC of a frame are XORed with a single contiguous region.
+		Returns the offset of each region and the total length.
+		"""
+		offsets = []
+		end = 0
+		for frame_counter_value, length in frames:
+			offsets.append(end)
+			end += ((length + self.M + 15) // 16 + 1) * 16
+		self.reserve(end, 0)
+
+		buf = self.ctr_buffer
+		for (frame_counter_value, length), offset in zip(frames, offsets):
+			nonce = self.gen_nonce(frame_counter_value)
+			for counter in range(1, (length + self.M + 15) // 16 + 1):
+				CTR_BLOCK.pack_into(buf, offset, 0x01, nonce, counter)
+				offset += 16
+			CTR_BLOCK.pack_into(buf, offset, 0x01, nonce, 0)
+
+		self.cipher_engine.encrypt(self.ctr_view[:end], output=self.keystream_view[:end])
+
+		keystream = self.keystream
+		for (frame_counter_value, length), offset in zip(frames, offsets):
+			a0 = offset + (length + self.M + 15) // 16 * 16
+			keystream[offset + length:offset + length + self.M] = self.keystream_view[a0:a0 + self.M]
+
+		return offsets, end
+
+	def cipher_batch(self, frames):
+		"""Ciphers a list of (frame_control, frame_counter, plain_text)
+
+		Returns the list of ciphered payloads, MIC included
+		"""
+		with self.lock:
+			offsets, end = self.load_keystream([(frame_counter_value, len(plain_text))
+				for frame_control_value, frame_counter_value, plain_text in frames])
 
-		padded_data = pad128(plain_text)
+			work = self.work_buffer
+			for (frame_control_value, frame_counter_value, plain_text), offset in zip(frames, offsets):
+				length = len(plain_text)
+				work[offset:offset + length] = plain_text
+				work[offset + length:offset + length + self.M] = self.compute_mac(plain_text,
+					frame_control_value, frame_counter_value)
 
-		flags = b'\x01'
-		A = [flags + nonce + struct.pack(">H", counter) for counter in range(len(padded_data)//16 + 1)]
+			stream = strxor(self.work_view[:end], self.keystream_view[:end])
 
-		U = strxor(T, self.E(A[0])[:self.M])
+		return [stream[offset:offset + len(plain_text) + self.M]
+			for (frame_control_value, frame_counter_value, plain_text), offset in zip(frames, offsets)]
 
-		ciphered_data = b''
-		for i in range(1, len(padded_data)//16 + 1):
-			data_chunck = padded_data[(i-1)*16:i*16]
-			ciphered_data += strxor(self.E(A[i]), data_chunck)
+	def decipher_batch(self, frames):
+		"""Deciphers a list of (frame_control, frame_counter, data)
 
-		ciphered_data = ciphered_data[:len(plain_text)]
+		Returns the list of plaintext payloads. Frames that cannot
+		be authenticated are replaced by None.
+		"""
+		with self.lock:
+			offsets, end = self.load_keystream([(frame_counter_value, max(len(data) - self.M, 0))
+				for frame_control_value, frame_counter_value, data in frames])
+
+			work = self.work_buffer
+			for (frame_control_value, frame_counter_value, data), offset in zip(frames, offsets):
+				work[offset:offset + len(data)] = data
+
+			stream = strxor(self.work_view[:end], self.keystream_view[:end])
+			view = memoryview(stream)
+
+			results = []
+			for (frame_control_value, frame_counter_value, data), offset in zip(frames, offsets):
+				length = len(data) - self.M
+				if length < 0:
+					results.append(None)
+					continue
+				mac = self.compute_mac(view[offset:offset + length],
+					frame_control_value, frame_counter_value)
+				if mac.tobytes() != stream[offset + length:offset + length + self.M]:
+					results.append(None)
+				else:
+					results.append(stream[offset:offset + length])
+
+		return results
+
+	def check_mic(self, data, frame_control_value, frame_counter_value):
+		"""Checks the MIC of a ciphered payload, MIC included
+
+		Cheaper than decipher_batch() for a single frame, used to
+		find the key of a frame among many
+		"""
+		length = len(data) - self.M
+		if length < 0:
+			return False
+		with self.lock:
+			# A0 first, then A1..An
+			blocks = (length + 15) // 16 + 1
+			self.reserve(blocks * 16, 0)
+			nonce = self.gen_nonce(frame_counter_value)
+			for counter in range(blocks):
+				CTR_BLOCK.pack_into(self.ctr_buffer, counter * 16, 0x01, nonce, counter)
+			keystream = self.keystream_view[:blocks * 16]
+			self.cipher_engine.encrypt(self.ctr_view[:blocks * 16], output=keystream)
+
+			plain_text = b''
+			if length:
+				plain_text = strxor(data[:length], keystream[16:16 + length])
+			mac = self.compute_mac(plain_text, frame_control_value, frame_counter_value)
+			# Too short for strxor to pay off
+			return bytearray(mac) == bytearray(a ^ b for a, b in
+				zip(bytearray(keystream[:self.M]), bytearray(data[length:])))
 
-		return ciphered_data + U
+	def cipher(self, plain_text, frame_control_value, frame_counter_value):
+		return self.cipher_batch([(frame_control_value, frame_counter_value, plain_text)])[0]
 
 	def decipher(self, data, frame_control_value, frame_counter_value):
+		plain_text = self.decipher_batch([(frame_control_value, frame_counter_value, data)])[0]
+		if plain_text is None:
+			raise Rf4ceException("Frame authentification error")
+		return plain_text
 
-		nonce = self.gen_nonce(frame_counter_value)
-
-		padded_C = pad128(data[:len(data)-self.M])
-		U = data[len(data)-self.M:]
 
-		flags = b'\x01'
-		A = [flags + nonce + struct.pack(">H", counter) for counter in range(len(padded_C)//16 + 1)]
+class Rf4ceCipherCache(object):
+
+	"""Bounded LRU cache of ready to use RF4CE cipher contexts
+
+	Contexts are indexed by (key, source, destination), so the
+	AES key schedule and the address conversions are only done
+	once per link
+	"""
+
+	def __init__(self, max_size=64):
+		self.max_size = max_size
+		self.contexts = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, source, destination):
+		"""Returns the cipher context of a link, creates it if needed"""
+		index = (key, source.get_raw_address(), destination.get_raw_address())
+		with self.lock:
+			cipher = self.contexts.pop(index, None)
+			if cipher is None:
+				self.misses += 1
+				cipher = Rf4ceAES(key, source, destination)
+				if len(self.contexts) >= self.max_size:
+					self.contexts.popitem(last=False)
+			else:
+				self.hits += 1
+			self.contexts[index] = cipher
+		return cipher
+
+	def clear(self):
+		"""Drops all cached contexts and resets the counters"""
+		with self.lock:
+			self.contexts.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def get_stats(self):
+		"""Returns the cache hit/miss counters"""
+		return {"hits": self.hits, "misses": self.misses,
+			"size": len(self.contexts), "max_size": self.max_size}
 
-		T = strxor(U, self.E(A[0])[:self.M])
+	def __repr__(self):
+		return "Cipher cache: {hits} hits, {misses} misses, {size}/{max_size} contexts".format(
+			**self.get_stats())
 
-		plain_text = b''
-		for i in range(1, len(padded_C)//16 + 1):
-			data_chunck = padded_C[(i-1)*16:i*16]
-			plain_text += strxor(self.E(A[i]), data_chunck)
 
-		plain_text = plain_text[:len(data)-self.M]
+# Cipher contexts shared by all frames and link configurations
+cipher_cache = Rf4ceCipherCache()
 
-		if self.gen_auth(plain_text, frame_control_value, frame_counter_value) != T:
-			raise Rf4ceException("Frame authentification error")
 
-		return plain_text
+class Rf4ceFrame(object):
 
+	"""Describes a RF4CE frame
 
-class Rf4ceFrame(object):
+	Parsed payloads are slices of the parsed data, so parsing a
+	memoryview does not copy them.
+	"""
 
-	"""Describes a RF4CE frame"""
+	__slots__ = ("source", "destination", "frame_type", "frame_ciphered", "protocol_version",
+		"channel_designator", "frame_counter", "payload", "profile_indentifier",
+		"vendor_indentifier", "command", "key")
 
 	def __init__(self):
 		self.source = None
@@ -165,8 +400,14 @@ class Rf4ceFrame(object):
 		self.frame_counter = 0
 		self.payload = None
 		self.profile_indentifier = 0x1
+		self.vendor_indentifier = None
+		self.command = None
 		self.key = None
 
+	def get_cipher(self):
+		"""Returns the cached cipher context of the frame's link"""
+		return cipher_cache.get(self.key, self.source, self.destination)
+
 	def get_frame_control(self):
 		"""Generates the frame control byte from the frame's parameters"""
 		frame_control = self.frame_type
@@ -189,7 +430,7 @@ class Rf4ceFrame(object):
 		if self.frame_type == Rf4ceConstants.FRAME_TYPE_COMMAND:
 			data = struct.pack("B", self.command) + self.payload
 			if self.frame_ciphered:
-				cipher = Rf4ceAES(self.key, self.source, self.destination)
+				cipher = self.get_cipher()
 				result += cipher.cipher(data, self.get_frame_control(), self.frame_counter)
 			else:
 				result += data
@@ -198,7 +439,7 @@ class Rf4ceFrame(object):
 			result += struct.pack("B", self.profile_indentifier)
 			data = self.payload
 			if self.frame_ciphered:
-				cipher = Rf4ceAES(self.key, self.source, self.destination)
+				cipher = self.get_cipher()
 				result += cipher.cipher(data, self.get_frame_control(), self.frame_counter)
 			else:
 				result += data
@@ -209,7 +450,7 @@ class Rf4ceFrame(object):
 			
 			data = self.payload
 			if self.frame_ciphered:
-				cipher = Rf4ceAES(self.key, self.source, self.destination)
+				cipher = self.get_cipher()
 				result += cipher.cipher(data, self.get_frame_control(), self.frame_counter)
 			else:
 				result += data
@@ -224,14 +465,16 @@ class Rf4ceFrame(object):
 		self.source = source
 		self.destination = destination
 
-		frame_control = data[0]
+		if len(data) < FRAME_HEADER.size:
+			raise Rf4ceException("Frame too short")
+		frame_control, self.frame_counter = FRAME_HEADER.unpack_from(data)
 
 		self.frame_type = frame_control & 0b11
 		
 		if self.frame_type == Rf4ceConstants.FRAME_TYPE_RESERVED:
 			raise Rf4ceException("Unknown frame type")
 
-		if (data[0] & (1 << 2)):
+		if (frame_control & (1 << 2)):
 			self.frame_ciphered = True
 		else:
 			self.frame_ciphered = False
@@ -240,8 +483,6 @@ class Rf4ceFrame(object):
 
 		self.channel_designator = (frame_control >> 6) & 0b11
 
-		self.frame_counter = struct.unpack("I", data[1:5])[0]
-
 		if self.frame_type == Rf4ceConstants.FRAME_TYPE_DATA:
 			self.data_frame_from_string(data)
 		elif self.frame_type == Rf4ceConstants.FRAME_TYPE_COMMAND:
@@ -249,36 +490,43 @@ class Rf4ceFrame(object):
 		elif self.frame_type == Rf4ceConstants.FRAME_TYPE_VENDOR:
 			self.data_frame_from_string(data, True)
 
+	def decipher(self, raw_payload):
+		"""Returns the deciphered payload"""
+		if not self.key:
+			raise Rf4ceException("Missing key")
+		cipher = self.get_cipher()
+		return cipher.decipher(raw_payload, self.get_frame_control(), self.frame_counter)
+
 	def data_frame_from_string(self, data, vendor_specific=False):
 		"""Parses a RF4CE data pyload from a string"""
-		self.profile_indentifier = data[5]
-		if vendor_specific:
-			self.vendor_indentifier = struct.unpack("H", data[6:8])[0]
-			raw_payload = data[8:]
-		else:
-			raw_payload = data[6:]
+		try:
+			if vendor_specific:
+				self.profile_indentifier, self.vendor_indentifier = \
+					VENDOR_HEADER.unpack_from(data, FRAME_HEADER.size)
+				raw_payload = data[FRAME_HEADER.size + VENDOR_HEADER.size:]
+			else:
+				self.profile_indentifier = BYTE.unpack_from(data, FRAME_HEADER.size)[0]
+				raw_payload = data[FRAME_HEADER.size + BYTE.size:]
+		except struct.error:
+			raise Rf4ceException("Frame too short")
 
 		if self.frame_ciphered:
-			if not self.key:
-				raise Rf4ceException("Missing key")
-			cipher = Rf4ceAES(self.key, self.source, self.destination)
-			self.payload = cipher.decipher(raw_payload, self.get_frame_control(), self.frame_counter)
+			self.payload = self.decipher(raw_payload)
 		else:
 			self.payload = raw_payload
 
 	def command_frame_from_string(self, data):
 		"""Parses a RF4CE command pyload from a string"""
-		raw_payload = data[5:]
+		raw_payload = data[FRAME_HEADER.size:]
 		if self.frame_ciphered:
-			if not self.key:
-				raise Rf4ceException("Missing key")
-			cipher = Rf4ceAES(self.key, self.source, self.destination)
-			command_data = cipher.decipher(raw_payload, self.get_frame_control(), self.frame_counter)
+			command_data = self.decipher(raw_payload)
 		else:
 			command_data = raw_payload
 
-		self.command = bytes(command_data)[0]
-		self.payload = command_data[1:]
+		if not len(command_data):
+			raise Rf4ceException("Missing command")
+		self.command = BYTE.unpack_from(command_data)[0]
+		self.payload = command_data[BYTE.size:]
 
 	def __repr__(self):
 		if self.frame_type == Rf4ceConstants.FRAME_TYPE_DATA:
@@ -299,3 +547,22 @@ class Rf4ceFrame(object):
 		result += "[{} - counter:{}] : {}".format(type, counter, data)
 
 		return result
+
+	def to_dict(self):
+		"""Returns the frame's fields, for structured output"""
+		result = {}
+		result["source"] = self.source.to_dict()
+		result["destination"] = self.destination.to_dict()
+		result["frame_type"] = FRAME_TYPE_NAMES.get(self.frame_type)
+		result["ciphered"] = self.frame_ciphered
+		result["protocol_version"] = self.protocol_version
+		result["channel_designator"] = self.channel_designator
+		result["frame_counter"] = self.frame_counter
+		if self.frame_type == Rf4ceConstants.FRAME_TYPE_COMMAND:
+			result["command"] = self.command
+		else:
+			result["profile"] = self.profile_indentifier
+		if self.frame_type == Rf4ceConstants.FRAME_TYPE_VENDOR:
+			result["vendor"] = self.vendor_indentifier
+		result["payload"] = binascii.hexlify(self.payload).decode()
+		return result
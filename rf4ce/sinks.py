@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Structured output sinks for decoded packets.
+
+Sinks buffer their output, flush it periodically and can rotate
+their files by size or age, so a sniffer can run for days.
+"""
+
+import os
+import json
+import time
+import struct
+import binascii
+import threading
+
+from pcap import PCAPNG_SHB, PCAPNG_IDB, PCAPNG_EPB, PCAPNG_BYTE_ORDER_MAGIC
+from pcap import LINKTYPE_IEEE802_15_4_WITHFCS
+
+
+class OutputSink(object):
+
+	"""Buffered output file
+
+	Records are written to the file once buffer_size bytes are
+	buffered, or every flush_interval seconds. With max_size or
+	max_age (in seconds) set, a new file is started once the current
+	one is too big or too old: files are named like the given
+	filename, with an increasing index before the extension.
+
+	Sinks writing the decoded fields of the records set decoded,
+	other sinks only get the raw packets.
+	"""
+
+	decoded = False
+
+	def __init__(self, filename, max_size=0, max_age=0, flush_interval=1.0,
+			buffer_size=0x10000):
+		self.filename = filename
+		self.max_size = max_size
+		self.max_age = max_age
+		self.flush_interval = flush_interval
+		self.buffer_size = buffer_size
+
+		self.lock = threading.Lock()
+		self.buffer = []
+		self.buffered = 0
+		self.index = 0
+		self.f = None
+		self.open_file()
+
+		self.closed = threading.Event()
+		self.flusher = threading.Thread(target=self.run)
+		self.flusher.daemon = True
+		self.flusher.start()
+
+	def get_filename(self):
+		"""Returns the name of the current file"""
+		if self.index == 0:
+			return self.filename
+		root, ext = os.path.splitext(self.filename)
+		return "{}.{}{}".format(root, self.index, ext)
+
+	def header(self):
+		"""Returns the data starting every file"""
+		return b''
+
+	def open_file(self):
+		self.f = open(self.get_filename(), "wb")
+		self.opened = time.time()
+		header = self.header()
+		self.f.write(header)
+		self.file_size = len(header)
+		self.header_size = len(header)
+
+	def rotate(self):
+		self.write_buffer()
+		self.f.close()
+		self.index += 1
+		self.open_file()
+
+	def write_buffer(self):
+		if self.buffer:
+			self.f.write(b''.join(self.buffer))
+			self.buffer = []
+			self.buffered = 0
+		self.f.flush()
+
+	def write(self, data):
+		"""Buffers a record, records are never split across files"""
+		with self.lock:
+			if self.f is None:
+				return
+			size = self.file_size + self.buffered
+			if size > self.header_size:
+				if self.max_size and size + len(data) > self.max_size:
+					self.rotate()
+				elif self.max_age and time.time() - self.opened >= self.max_age:
+					self.rotate()
+			self.buffer.append(data)
+			self.buffered += len(data)
+			if self.buffered >= self.buffer_size:
+				self.file_size += self.buffered
+				self.write_buffer()
+
+	def flush(self):
+		"""Writes the buffered records to the file"""
+		with self.lock:
+			if self.f is not None:
+				self.file_size += self.buffered
+				self.write_buffer()
+
+	def run(self):
+		while not self.closed.wait(self.flush_interval):
+			self.flush()
+
+	def close(self):
+		self.flush()
+		with self.lock:
+			if self.f is not None:
+				self.f.close()
+				self.f = None
+		self.closed.set()
+		# Daemon threads still waiting at exit make Python 2 complain
+		self.flusher.join()
+
+	def handle(self, record):
+		"""This should write a decoded packet record
+
+		By default, records are ignored
+		"""
+		pass
+
+
+class JsonLinesSink(OutputSink):
+
+	"""Writes one JSON object per packet
+
+	The raw packet is stored as an hexadecimal string.
+	"""
+
+	decoded = True
+
+	def handle(self, record):
+		record = dict(record)
+		record["data"] = binascii.hexlify(record["data"]).decode()
+		self.write(json.dumps(record, sort_keys=True).encode("utf-8") + b'\n')
+
+
+class PcapngSink(OutputSink):
+
+	"""Writes the packets to a pcapng file, FCS included"""
+
+	def header(self):
+		shb = struct.pack("<IIIHHq", PCAPNG_SHB, 28, PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+		shb += struct.pack("<I", 28)
+		idb = struct.pack("<IIHHI", PCAPNG_IDB, 20, LINKTYPE_IEEE802_15_4_WITHFCS, 0, 0)
+		idb += struct.pack("<I", 20)
+		return shb + idb
+
+	def handle(self, record):
+		data = record["data"]
+		timestamp = int(record["timestamp"] * 1e6)
+		padding = b'\x00' * (-len(data) % 4)
+		length = 32 + len(data) + len(padding)
+		block = struct.pack("<IIIIIII", PCAPNG_EPB, length, 0, timestamp >> 32,
+			timestamp & 0xffffffff, len(data), len(data))
+		self.write(block + data + padding + struct.pack("<I", length))
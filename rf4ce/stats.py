@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Latency statistics.
+"""
+
+import bisect
+import binascii
+import threading
+import time
+from collections import OrderedDict
+
+
+class LatencyHistogram(object):
+
+	"""Histogram of latencies in seconds, with logarithmic buckets
+
+	Bucket i counts the latencies lower than BOUNDS[i], the last
+	bucket counts the others.
+	"""
+
+	BOUNDS = (1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2,
+		0.1, 0.2, 0.5, 1.0)
+
+	def __init__(self, name="Latency"):
+		self.name = name
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.buckets = [0] * (len(self.BOUNDS) + 1)
+			self.count = 0
+			self.total = 0.0
+			self.min = None
+			self.max = None
+
+	def add(self, latency):
+		with self.lock:
+			self.buckets[bisect.bisect_right(self.BOUNDS, latency)] += 1
+			self.count += 1
+			self.total += latency
+			if self.min is None or latency < self.min:
+				self.min = latency
+			if self.max is None or latency > self.max:
+				self.max = latency
+
+	def get_stats(self):
+		"""Returns the latency counters, in seconds"""
+		return {"name": self.name, "count": self.count,
+			"mean": self.total / self.count if self.count else 0.0,
+			"min": self.min or 0.0, "max": self.max or 0.0}
+
+	def format_bound(self, bound):
+		if bound < 1e-3:
+			return "{:g} us".format(bound * 1e6)
+		if bound < 1:
+			return "{:g} ms".format(bound * 1e3)
+		return "{:g} s".format(bound)
+
+	def __repr__(self):
+		stats = self.get_stats()
+		result = "{}: {} samples, mean {:.3f} ms, min {:.3f} ms, max {:.3f} ms".format(
+			self.name, stats["count"], stats["mean"] * 1e3, stats["min"] * 1e3, stats["max"] * 1e3)
+		if not self.count:
+			return result
+		largest = max(self.buckets)
+		for i, count in enumerate(self.buckets):
+			if not count:
+				continue
+			if i < len(self.BOUNDS):
+				label = "< " + self.format_bound(self.BOUNDS[i])
+			else:
+				label = ">= " + self.format_bound(self.BOUNDS[-1])
+			bar = "#" * max(1, 40 * count // largest)
+			result += "\n\t{:>10} {:<40} {}".format(label, bar, count)
+		return result
+
+
+class PacketTrace(object):
+
+	"""Stage timings of a packet
+
+	lap() charges the time since the previous lap to a stage. Laps
+	are only taken when profiling, so an unused trace costs a method
+	call per stage. Decoding errors are flagged with error.
+	"""
+
+	def __init__(self, profile=False, laps=None, error=False):
+		self.profile = profile
+		self.laps = laps if laps is not None else []
+		self.error = error
+		self.last = time.time() if profile else None
+
+	def lap(self, stage):
+		if self.profile:
+			now = time.time()
+			self.laps.append((stage, now - self.last))
+			self.last = now
+
+
+class ProcessorStats(object):
+
+	"""Hot path statistics of a packet processor
+
+	Keeps the latency from the handoff by GNU Radio to the end of the
+	processing, the queue depth at each wakeup, packet and error
+	counters per link and, when profiling, a histogram per stage.
+	"""
+
+	def __init__(self, profile=False):
+		self.profile = profile
+		self.stages = OrderedDict()
+		self.latency = LatencyHistogram("Handoff to processed")
+		self.links = {}
+		self.lock = threading.Lock()
+		self.queue_wakeups = 0
+		self.queue_total = 0
+		self.queue_max = 0
+
+	def trace(self, laps=None, error=False):
+		"""Returns a new packet trace, or resumes one from a worker"""
+		return PacketTrace(self.profile, laps, error)
+
+	def record(self, trace, link, fed=None, now=None):
+		"""Records a processed packet, fed is its handoff time"""
+		if now is None:
+			now = time.time()
+		if fed is not None:
+			self.latency.add(now - fed)
+		for stage, elapsed in trace.laps:
+			histogram = self.stages.get(stage)
+			if histogram is None:
+				with self.lock:
+					histogram = self.stages.setdefault(stage, LatencyHistogram(stage))
+			histogram.add(elapsed)
+		with self.lock:
+			counters = self.links.get(link)
+			if counters is None:
+				counters = self.links[link] = [0, 0]
+			counters[0] += 1
+			if trace.error:
+				counters[1] += 1
+
+	def record_queue(self, depth):
+		"""Records the queue depth at a wakeup"""
+		self.queue_wakeups += 1
+		self.queue_total += depth
+		if depth > self.queue_max:
+			self.queue_max = depth
+
+	def get_stats(self):
+		"""Returns all the statistics, latencies in seconds"""
+		with self.lock:
+			links = dict((binascii.hexlify(link).decode(), {"packets": packets, "errors": errors})
+				for link, (packets, errors) in self.links.items())
+			stages = list(self.stages.values())
+		return {
+			"latency": self.latency.get_stats(),
+			"stages": OrderedDict((stage.name, stage.get_stats()) for stage in stages),
+			"queue": {"wakeups": self.queue_wakeups, "max": self.queue_max,
+				"mean": self.queue_total / float(self.queue_wakeups) if self.queue_wakeups else 0.0},
+			"links": links,
+		}
+
+	def __repr__(self, max_links=10):
+		stats = self.get_stats()
+		result = "Processor statistics:"
+		result += "\n\tQueue depth at wakeup: mean {mean:.1f}, max {max} ({wakeups} wakeups)".format(
+			**stats["queue"])
+		result += "\n" + repr(self.latency)
+		if stats["stages"]:
+			total = sum(stage["mean"] * stage["count"] for stage in stats["stages"].values())
+			result += "\nStages:"
+			for name, stage in stats["stages"].items():
+				share = stage["mean"] * stage["count"] / total if total else 0.0
+				result += "\n\t{:<12} {:>8} calls, mean {:8.3f} us, max {:9.3f} us, {:5.1f}%".format(
+					name, stage["count"], stage["mean"] * 1e6, stage["max"] * 1e6, share * 100)
+		links = sorted(stats["links"].items(), key=lambda item: -item[1]["packets"])
+		result += "\nLinks: {}".format(len(links))
+		for link, counters in links[:max_links]:
+			result += "\n\t{:<28} {:>8} packets, {} errors".format(link or "-",
+				counters["packets"], counters["errors"])
+		return result
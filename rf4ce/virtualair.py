@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+In-process radio medium for the "virtual" SDR device.
+"""
+
+import threading
+
+import numpy
+
+from oqpsk import SAMPLE_RATE
+
+
+class ChannelModel(object):
+
+	"""Impairments between the virtual transmitters and a receiver
+
+	The modulator output has a unit mean power, the SNR sets the
+	power of the complex AWGN relative to it. Noise is also added
+	between bursts, so the receiver sees a continuous noise floor.
+	The frequency offset is applied with a phase continuous across
+	bursts. routes maps each transmit channel to the receive channels
+	that hear it, by default each channel only hears itself.
+	"""
+
+	SIGNAL_POWER = 1.0
+
+	def __init__(self, snr=None, frequency_offset=0.0, routes=None, seed=None,
+			sample_rate=SAMPLE_RATE):
+		self.snr = snr
+		self.frequency_offset = frequency_offset
+		self.routes = routes
+		self.sample_rate = sample_rate
+		self.random = numpy.random.RandomState(seed)
+		self.phase = 0.0
+
+	def is_routed(self, tx_channel, rx_channel):
+		"""Returns True if a receiver on rx_channel hears tx_channel"""
+		if self.routes is None:
+			return tx_channel == rx_channel
+		return rx_channel in self.routes.get(tx_channel, ())
+
+	def noise(self, count):
+		"""Returns count samples of noise, zeros for a noiseless channel"""
+		if self.snr is None:
+			return numpy.zeros(count, dtype=numpy.complex64)
+		scale = numpy.sqrt(self.SIGNAL_POWER / 10 ** (self.snr / 10.0) / 2)
+		noise = (self.random.standard_normal(2 * count) * scale).astype(numpy.float32)
+		return noise.view(numpy.complex64)
+
+	def apply(self, samples):
+		"""Returns a burst as received through the channel"""
+		samples = numpy.asarray(samples, dtype=numpy.complex64)
+		if self.frequency_offset:
+			step = 2 * numpy.pi * self.frequency_offset / self.sample_rate
+			phases = self.phase + step * numpy.arange(len(samples))
+			samples = samples * numpy.exp(1j * phases).astype(numpy.complex64)
+			self.phase = (self.phase + step * len(samples)) % (2 * numpy.pi)
+		if self.snr is not None:
+			samples = samples + self.noise(len(samples))
+		return samples
+
+
+class VirtualAir(object):
+
+	"""Connects virtual transmitters to virtual receivers
+
+	Receivers attach themselves while their flowgraph runs, and get
+	every transmitted burst through deliver(channel, samples).
+	"""
+
+	def __init__(self):
+		self.receivers = []
+		self.lock = threading.Lock()
+		self.bursts = 0
+		self.samples = 0
+
+	def attach(self, receiver):
+		with self.lock:
+			if receiver not in self.receivers:
+				self.receivers.append(receiver)
+
+	def detach(self, receiver):
+		with self.lock:
+			if receiver in self.receivers:
+				self.receivers.remove(receiver)
+
+	def transmit(self, channel, samples):
+		"""Sends a burst of complex64 samples on a channel"""
+		with self.lock:
+			receivers = list(self.receivers)
+			self.bursts += 1
+			self.samples += len(samples)
+		for receiver in receivers:
+			receiver.deliver(channel, samples)
+
+	def get_stats(self):
+		return {"receivers": len(self.receivers), "bursts": self.bursts, "samples": self.samples}
+
+	def __repr__(self):
+		return "Virtual air: {receivers} receivers, {bursts} bursts, {samples} samples".format(
+			**self.get_stats())
+
+
+# Medium shared by the virtual flowgraphs that are not given another
+virtual_air = VirtualAir()
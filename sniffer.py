@@ -9,13 +9,21 @@ from __future__ import (absolute_import,
 from builtins import *
 
 import argparse
+import sys
+import time
 from datetime import datetime
 import binascii
+import struct
+import sqlite3
 
-from rf4ce import Dot15d4FCS, Dot15d4Data, Raw, makeFCS
-from rf4ce import LinkConfig, Rf4ceNode, Rf4ceFrame, Rf4ceException
-from rf4ce.radio import RxFlow
-from rf4ce.packetprocessor import PacketProcessor
+from rf4ce import Dot15d4FCS
+from rf4ce import LinkConfig, LinkRegistry, LinkStore, Rf4ceNode, Rf4ceFrame, Rf4ceException
+from rf4ce.dot15d4 import parse_header, Dot15d4Constants, Dot15d4Exception
+from rf4ce.framecounter import FrameCounterIndex, link_id
+from rf4ce.keyring import Keyring
+from rf4ce.packetprocessor import PacketProcessor, PacketQueue
+from rf4ce.pcap import replay, CaptureException
+from rf4ce.sinks import JsonLinesSink, PcapngSink
 import huepy as hue
 
 
@@ -25,50 +33,145 @@ class SnifferProcessor(PacketProcessor):
 
 	Parses incoming packets
 	If possible, decode them
+
+	Ciphered frames matching no link are looked up in the keyring, if
+	any: identified links are added to the registry, and addresses
+	that could not be identified are not searched again.
+
+	Frame counters are checked in output(), so they are seen in order
+	even with workers.
+
+	Packets are printed in full, as a one line summary, or not at
+	all. Full descriptions are only rendered in full verbosity, and
+	the decoded fields of the records only when the summary or a
+	sink uses them. Summaries are only colored on a terminal.
 	"""
 
-	def __init__(self, link_configs=[]):
-		PacketProcessor.__init__(self)
-		self.link_configs = link_configs
+	QUIET = "quiet"
+	SUMMARY = "summary"
+	FULL = "full"
+	VERBOSITIES = (QUIET, SUMMARY, FULL)
+
+	def __init__(self, link_configs=[], workers=0, dissect=False, sinks=[], keyring=None,
+			counters=None, verbosity=FULL, **kwargs):
+		PacketProcessor.__init__(self, workers, **kwargs)
+		self.links = LinkRegistry(link_configs)
+		self.dissect = dissect
+		self.verbosity = verbosity
+		self.sinks = sinks
+		self.structured = verbosity == self.SUMMARY or any(sink.decoded for sink in sinks)
+		self.color = sys.stdout.isatty()
+		self.counter_links = {}
+		self.keyring = keyring
+		self.unidentified = set()
+		if counters is None:
+			counters = FrameCounterIndex()
+		self.counters = counters
+
+	def stop(self):
+		PacketProcessor.stop(self)
+		# Packets being output are written before the sinks are closed
+		self.wait()
+		if self.keyring is not None:
+			self.keyring.stop()
+		self.counters.close()
+		for sink in self.sinks:
+			sink.close()
+
+	def identify(self, packet, data):
+		"""Returns the link of a ciphered frame found in the keyring, or None"""
+		payload = packet.get_payload(data)
+		if not payload or not bytearray(payload[:1])[0] & (1 << 2):
+			return None
+		addresses = (packet.dest_panid, packet.fcf_srcaddrmode, packet.src_addr,
+			packet.fcf_destaddrmode, packet.dest_addr)
+		if addresses in self.unidentified:
+			return None
+		result = self.keyring.search(payload)
+		if result is None:
+			self.unidentified.add(addresses)
+			return None
 
-	def process(self, data):
-		print(hue.bold(hue.green("\n------ {} ------".format(datetime.now()))))
-		print(hue.yellow("Full packet data: ") + hue.italic(binascii.hexlify(data)))
-		
-		# Checks if the 802.15.4 packet is valid
-		if makeFCS(data[:-2]) != data[-2:]:
-			print(hue.bad("Invalid packet"))
-			return
+		key, source, destination = result
+		short_source = short_destination = None
+		if packet.fcf_srcaddrmode == Dot15d4Constants.ADDR_MODE_SHORT:
+			short_source = packet.src_addr
+		if packet.fcf_destaddrmode == Dot15d4Constants.ADDR_MODE_SHORT:
+			short_destination = packet.dest_addr
+		link = LinkConfig()
+		link.dest_panid = packet.dest_panid
+		link.source = Rf4ceNode(source.get_long_address(), short_source)
+		link.destination = Rf4ceNode(destination.get_long_address(), short_destination)
+		link.key = binascii.hexlify(key).decode()
+		self.links.add(link)
+
+		# Answers are sent to the PAN of the source
+		if packet.src_panid is not None:
+			reverse = LinkConfig()
+			reverse.dest_panid = packet.src_panid
+			reverse.source = link.destination
+			reverse.destination = link.source
+			reverse.key = link.key
+			self.links.add(reverse)
+		return link
+
+	def decode(self, data, channel=None):
+		"""Returns a record and the lines describing a packet
+
+		Lines are only rendered in full verbosity, other levels
+		work from the record. Packets with an invalid FCS never get
+		here, they are dropped and counted by feed().
+		"""
+		now = time.time()
+		record = {"timestamp": now, "channel": channel, "data": data, "fcs_valid": True,
+			"dot15d4": None, "rf4ce": None, "frame_counter": None, "counter_status": None,
+			"error": None}
+		full = self.verbosity == self.FULL
+		lines = []
+		if full:
+			title = "{}".format(datetime.fromtimestamp(now))
+			if channel is not None:
+				title += " - channel {}".format(channel)
+			lines.append(hue.bold(hue.green("\n------ {} ------".format(title))))
+			lines.append(hue.yellow("Full packet data: ") + hue.italic(binascii.hexlify(data)))
+			self.trace.lap("hexdump")
 
 		# Parses 802.15.4 packet
-		packet = Dot15d4FCS(data)
-		packet.show()
+		try:
+			packet = parse_header(data)
+		except Dot15d4Exception as e:
+			record["error"] = "Cannot parse 802.15.4 header: {}".format(e)
+			if full:
+				lines.append(hue.bad(record["error"]))
+			self.trace.error = True
+			return record, lines, None
+		if self.structured:
+			record["dot15d4"] = packet.to_dict()
+		self.trace.lap("header")
+		if full:
+			if self.dissect:
+				lines.append(Dot15d4FCS(data).show(dump=True))
+			else:
+				lines.append(repr(packet))
+			self.trace.lap("dissect")
 
-		if packet.fcf_frametype == 2: # ACK
-			return
+		if packet.fcf_frametype == Dot15d4Constants.FRAME_TYPE_ACK:
+			return record, lines, None
 
 		# Tries to match received packet with a known link
 		# configuration
-		matched = False
-		for link in self.link_configs:
-			if packet.dest_panid != link.dest_panid:
-				continue
-			if packet.fcf_srcaddrmode == 3: # Long addressing mode
-				if packet.src_addr != link.source.get_long_address():
-					continue
-				if packet.dest_addr != link.destination.get_long_address():
-					continue
-			else:
-				if packet.src_addr != link.source.get_short_address():
-					continue
-				if packet.dest_addr != link.destination.get_short_address():
-					continue
-				source = link.source
-				destination = link.destination
-				key = link.key
-				matched = True
-
-		if not matched:
+		link = self.links.match(packet)
+		self.trace.lap("match")
+		if link is None and self.keyring is not None:
+			link = self.identify(packet, data)
+			if link is not None and full:
+				lines.append(hue.good("Key found in keyring: {}".format(link.key)))
+			self.trace.lap("keyring")
+		if link:
+			source = link.source
+			destination = link.destination
+			key = link.key
+		else:
 			if packet.fcf_srcaddrmode == 3:
 				source = Rf4ceNode(packet.src_addr, None)
 				destination = Rf4ceNode(packet.dest_addr, None)
@@ -79,42 +182,300 @@ class SnifferProcessor(PacketProcessor):
 
 		# Process RF4CE payload
 		frame = Rf4ceFrame()
+		counter_link = None
 		try:
-			rf4ce_payload = bytes(packet[3].fields["load"])
+			rf4ce_payload = packet.get_payload(data)
+			# Readable even when the frame cannot be deciphered
+			if len(rf4ce_payload) >= 5:
+				record["frame_counter"] = struct.unpack_from("<I", rf4ce_payload, 1)[0]
+				counter_link = self.get_counter_link(packet)
 			frame.parse_from_string(rf4ce_payload, source, destination, key)
 		except Rf4ceException, e:
-			print(hue.bad("Cannot parse RF4CE frame: {}".format(e)))
-			return
-		print("###[ " + hue.bold(hue.yellow("RF4CE")) + " ]###")
-		print(frame)
+			record["error"] = "Cannot parse RF4CE frame: {}".format(e)
+			if full:
+				lines.append(hue.bad(record["error"]))
+			self.trace.error = True
+			return record, lines, counter_link
+		self.trace.lap("rf4ce")
+		if self.structured:
+			record["rf4ce"] = frame.to_dict()
+		if full:
+			lines.append("###[ " + hue.bold(hue.yellow("RF4CE")) + " ]###")
+			lines.append(repr(frame))
+		self.trace.lap("format")
+		return record, lines, counter_link
+
+	def get_counter_link(self, packet):
+		"""Returns the frame counter link of a packet, or None
+
+		Link identifiers are formatted once per link
+		"""
+		if None in (packet.dest_panid, packet.src_addr, packet.dest_addr):
+			return None
+		addresses = (packet.dest_panid, packet.fcf_srcaddrmode, packet.src_addr,
+			packet.fcf_destaddrmode, packet.dest_addr)
+		link = self.counter_links.get(addresses)
+		if link is None:
+			link = link_id(packet.dest_panid,
+				packet.format_address(packet.src_addr, packet.fcf_srcaddrmode),
+				packet.format_address(packet.dest_addr, packet.fcf_destaddrmode))
+			self.counter_links[addresses] = link
+		return link
+
+	def check_counter(self, record, link):
+		"""Checks the frame counter of a packet against its link's
+
+		Returns a warning, or None
+		"""
+		if record["frame_counter"] is None or link is None:
+			return None
+		status, missed = self.counters.update(link, record["frame_counter"], record["timestamp"])
+		record["counter_status"] = status
+		if status == FrameCounterIndex.REPLAY:
+			return "Replayed frame counter"
+		elif status == FrameCounterIndex.STALE:
+			return "Frame counter older than the replay window"
+		elif status == FrameCounterIndex.GAP:
+			return "{} frame counters missed".format(missed)
+		return None
+
+	def summarize(self, record, warning=None):
+		"""Returns a one line description of a packet"""
+		yellow, red = hue.yellow, hue.red
+		if not self.color:
+			yellow = red = lambda text: text
+		line = "{}".format(datetime.fromtimestamp(record["timestamp"]))
+		if record["channel"] is not None:
+			line += " ch{}".format(record["channel"])
+		dot15d4 = record["dot15d4"]
+		if dot15d4 is not None:
+			line += " " + dot15d4["frame_type"]
+			if dot15d4["dest_panid"] is not None:
+				line += " 0x{:04x}".format(dot15d4["dest_panid"])
+			if dot15d4["src_addr"] is not None or dot15d4["dest_addr"] is not None:
+				line += " {} > {}".format(dot15d4["src_addr"] or "-", dot15d4["dest_addr"] or "-")
+		if record["rf4ce"] is not None:
+			line += " " + yellow(record["rf4ce"]["frame_type"] or "reserved")
+			if record["rf4ce"]["ciphered"]:
+				line += " ciphered"
+		if record["frame_counter"] is not None:
+			line += " counter:0x{:08x}".format(record["frame_counter"])
+		if record["error"]:
+			line += " " + red(record["error"])
+		if warning:
+			line += " " + red(warning)
+		return line
+
+	def output(self, result):
+		record, lines, counter_link = result
+		warning = self.check_counter(record, counter_link)
+		self.trace.lap("counters")
+		if self.verbosity == self.FULL:
+			if record["counter_status"] == FrameCounterIndex.GAP:
+				lines.append(hue.info(warning))
+			elif warning:
+				lines.append(hue.bad(warning))
+			print("\n".join(lines))
+		elif self.verbosity == self.SUMMARY:
+			print(self.summarize(record, warning))
+		self.trace.lap("print")
+		for sink in self.sinks:
+			sink.handle(record)
+		self.trace.lap("sinks")
 
 
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("-l", "--link", help="JSON file containing link information")
+	parser.add_argument("-l", "--link", help="JSON file containing link information, can be repeated",
+		action="append")
+	parser.add_argument("-D", "--database", help="SQLite link database, all its links are used")
 	parser.add_argument("-c", "--channel", help="RF4CE channel (default: 15)", type=int,
 		choices=[15, 20, 25], default=15)
+	parser.add_argument("-W", "--wideband", help="Sniff channels 15, 20 and 25 at once, from a 60 MS/s IQ recording",
+		action="store_true")
 	parser.add_argument("-s", "--sdr", help="SDR Device to use (default: pluto-sdr)", 
 		choices=["hackrf", "pluto-sdr"], default="pluto-sdr")
+	parser.add_argument("-d", "--dissect", help="Show a full scapy dissection of the 802.15.4 packets",
+		action="store_true")
+	parser.add_argument("-v", "--verbosity", help="Print the packets in full, as one line summaries, "
+		"or not at all (default: full)", choices=SnifferProcessor.VERBOSITIES,
+		default=SnifferProcessor.FULL)
+	parser.add_argument("-w", "--workers", help="Number of decoding processes (default: 0, decode in the main process)",
+		type=int, default=0)
+	parser.add_argument("-p", "--pcap", help="Replay a pcap/pcapng capture file instead of using a SDR")
+	parser.add_argument("-i", "--iq-file", help="Decode a 4 MS/s (60 MS/s with --wideband) IQ recording instead of using a SDR")
+	parser.add_argument("--iq-format", help="IQ recording sample format (default: complex64)",
+		choices=["complex64", "int16"], default="complex64")
+	parser.add_argument("--chunk-size", help="Samples read from the IQ recording at once (default: 32768)",
+		type=int, default=0x8000)
+	parser.add_argument("--queue-size", help="Maximum number of queued packets (default: 1024)",
+		type=int, default=1024)
+	parser.add_argument("--queue-policy", help="What to do when the queue is full "
+		"(default: block for files, drop-oldest otherwise)", choices=PacketQueue.POLICIES)
+	parser.add_argument("--batch-size", help="Maximum number of packets processed per wakeup (default: 64)",
+		type=int, default=64)
+	parser.add_argument("--jsonl", help="Also write the decoded packets to a JSON lines file")
+	parser.add_argument("--pcapng", help="Also write the packets to a pcapng file")
+	parser.add_argument("--rotate-size", help="Start a new output file every ROTATE_SIZE MB",
+		type=float, default=0)
+	parser.add_argument("--rotate-time", help="Start a new output file every ROTATE_TIME seconds",
+		type=float, default=0)
+	parser.add_argument("--flush-interval", help="Output files flush interval in seconds (default: 1)",
+		type=float, default=1.0)
+	parser.add_argument("--profile", help="Time each decoding stage, print the statistics on exit",
+		action="store_true")
+	parser.add_argument("--stats-interval", help="Print the processing statistics to stderr every "
+		"STATS_INTERVAL seconds, they are also printed on SIGUSR1", type=float, default=0)
+	parser.add_argument("--counters", help="Frame counters journal file, loaded at start and "
+		"updated while sniffing")
+	parser.add_argument("-k", "--keyring", help="File of keys to try on ciphered packets matching no link, "
+		"can be repeated", action="append")
+	parser.add_argument("--keyring-workers", help="Number of processes trying the keyring keys "
+		"(default: 0, search in the decoding process)", type=int, default=0)
 	args = parser.parse_args()
 
-	if args.link:
+	link_configs = []
+	for link in args.link or []:
 		try:
-			link_config = LinkConfig(args.link)
+			link_configs.append(LinkConfig(link))
 		except:
-			print(hue.bad("Cannot load configuration file"))
+			print(hue.bad("Cannot load configuration file '{}'".format(link)))
+			exit(-1)
+	if args.database:
+		try:
+			store = LinkStore(args.database)
+			link_configs.extend(store.get_all())
+			store.close()
+		except sqlite3.Error as e:
+			print(hue.bad("Cannot load link database: {}".format(e)))
 			exit(-1)
 
-	if args.link:
+	for link_config in link_configs:
 		print(link_config)
-	print(hue.info("Sniffing on channel {}".format(args.channel)))
 
-	if args.link:
-		sniffer_processor = SnifferProcessor([link_config])
+	keyring = None
+	if args.keyring:
+		keyring = Keyring(args.keyring_workers)
+		for filename in args.keyring:
+			try:
+				keyring.load(filename)
+			except (IOError, ValueError) as e:
+				print(hue.bad("Cannot load keyring: {}".format(e)))
+				exit(-1)
+		# Keys without addresses are tried with the known links' addresses
+		for link_config in link_configs:
+			keyring.add_address_pair(link_config.source, link_config.destination)
+		# Workers are forked before any thread starts
+		keyring.start()
+		print(hue.info(repr(keyring)))
+
+	# Recordings can wait for the decoder, a live SDR cannot
+	queue_policy = args.queue_policy
+	if queue_policy is None:
+		if args.pcap or args.iq_file:
+			queue_policy = PacketQueue.BLOCK
+		else:
+			queue_policy = PacketQueue.DROP_OLDEST
+
+	sinks = []
+	for filename, sink_class in ((args.jsonl, JsonLinesSink), (args.pcapng, PcapngSink)):
+		if not filename:
+			continue
+		try:
+			sinks.append(sink_class(filename, int(args.rotate_size * 1e6), args.rotate_time,
+				args.flush_interval))
+		except IOError as e:
+			print(hue.bad("Cannot open output file: {}".format(e)))
+			exit(-1)
+
+	counters = None
+	if args.counters:
+		try:
+			counters = FrameCounterIndex(args.counters)
+		except IOError as e:
+			print(hue.bad("Cannot open frame counters journal: {}".format(e)))
+			exit(-1)
+
+	sniffer_processor = SnifferProcessor(link_configs, args.workers, args.dissect, sinks, keyring,
+		counters, queue_size=args.queue_size, queue_policy=queue_policy, batch_size=args.batch_size,
+		profile=args.profile, stats_interval=args.stats_interval, verbosity=args.verbosity)
+	sniffer_processor.install_signal_handler()
+
+	if args.pcap:
+		print(hue.info("Replaying {}".format(args.pcap)))
+		start = time.time()
+		try:
+			# Invalid packets are dropped by feed(), with or without workers
+			sniffer_processor.start()
+			count = replay(args.pcap, sniffer_processor.feed)
+			sniffer_processor.flush()
+		except (IOError, CaptureException) as e:
+			print(hue.bad("Cannot read capture file: {}".format(e)))
+			exit(-1)
+		finally:
+			sniffer_processor.stop()
+		elapsed = time.time() - start
+		rate = count / elapsed if elapsed else 0
+		print(hue.info("Processed {} packets in {:.3f} s ({:.1f} packets/s)".format(
+			count, elapsed, rate)))
+		print(hue.info("Dropped {} invalid packets".format(sniffer_processor.invalid_packets)))
+		print(hue.info(repr(sniffer_processor.counters)))
+		if args.profile:
+			sniffer_processor.dump_stats(sys.stdout)
+		print(hue.info(repr(sniffer_processor.q)))
+		if keyring is not None and not args.workers:
+			print(hue.info(repr(keyring)))
+		exit(0)
+
+	from rf4ce.radio import RxFlow, WidebandRxFlow
+
+	if args.iq_file:
+		print(hue.info("Decoding {}".format(args.iq_file)))
+		try:
+			if args.wideband:
+				tb = WidebandRxFlow(sniffer_processor, "file", args.iq_file,
+					args.iq_format, args.chunk_size)
+			else:
+				tb = RxFlow(args.channel, sniffer_processor, "file", args.iq_file,
+					args.iq_format, args.chunk_size)
+		except (IOError, ValueError) as e:
+			print(hue.bad("Cannot read IQ file: {}".format(e)))
+			exit(-1)
+
+		sniffer_processor.start()
+		start = time.time()
+		try:
+			tb.run()
+			sniffer_processor.flush()
+		except KeyboardInterrupt:
+			tb.stop()
+			tb.wait()
+		elapsed = time.time() - start
+		sniffer_processor.stop()
+
+		duration = tb.sdr_source.offset / tb.sample_rate
+		print(hue.info("Decoded {:.1f} s of recording in {:.1f} s ({:.1f}x real time)".format(
+			duration, elapsed, duration / elapsed if elapsed else 0)))
+		print(hue.info("Dropped {} invalid packets".format(sniffer_processor.invalid_packets)))
+		print(hue.info(repr(sniffer_processor.counters)))
+		if args.profile:
+			sniffer_processor.dump_stats(sys.stdout)
+		print(hue.info(repr(sniffer_processor.q)))
+		if keyring is not None and not args.workers:
+			print(hue.info(repr(keyring)))
+		exit(0)
+
+	if args.wideband:
+		print(hue.info("Sniffing on channels 15, 20 and 25"))
+		try:
+			tb = WidebandRxFlow(sniffer_processor, args.sdr)
+		except ValueError as e:
+			print(hue.bad(e))
+			exit(-1)
 	else:
-		sniffer_processor = SnifferProcessor([])
-	tb = RxFlow(args.channel, sniffer_processor, args.sdr)
+		print(hue.info("Sniffing on channel {}".format(args.channel)))
+		tb = RxFlow(args.channel, sniffer_processor, args.sdr)
 	
 	sniffer_processor.start()
 	tb.start()
@@ -129,3 +490,10 @@ if __name__ == '__main__':
 	tb.stop()
 	tb.wait()
 	sniffer_processor.stop()
+	print(hue.info("Dropped {} invalid packets".format(sniffer_processor.invalid_packets)))
+	print(hue.info(repr(sniffer_processor.counters)))
+	if args.profile:
+		sniffer_processor.dump_stats(sys.stdout)
+	print(hue.info(repr(sniffer_processor.q)))
+	if keyring is not None and not args.workers:
+		print(hue.info(repr(keyring)))
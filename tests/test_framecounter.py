@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the frame counters replay window and journal.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from rf4ce.framecounter import FrameCounterIndex, link_id
+
+
+LINK = link_id(0x1234, "0x0001", "0x0002")
+OTHER_LINK = link_id(0x1234, "0x0003", "0x0004")
+
+
+class FrameCounterWindowTest(unittest.TestCase):
+
+	def setUp(self):
+		self.counters = FrameCounterIndex()
+
+	def update(self, counter):
+		return self.counters.update(LINK, counter)
+
+	def test_in_order(self):
+		self.assertEqual(self.update(10), (FrameCounterIndex.NEW, 0))
+		self.assertEqual(self.update(11), (FrameCounterIndex.NEW, 0))
+		self.assertEqual(self.counters.get_highest(LINK), 11)
+
+	def test_gap(self):
+		self.update(10)
+		self.assertEqual(self.update(14), (FrameCounterIndex.GAP, 3))
+		stats = self.counters.get_stats()
+		self.assertEqual(stats["gaps"], 1)
+		self.assertEqual(stats["missed"], 3)
+
+	def test_late(self):
+		self.update(10)
+		self.update(14)
+		self.assertEqual(self.update(12), (FrameCounterIndex.LATE, 0))
+		self.assertEqual(self.update(12), (FrameCounterIndex.REPLAY, 0))
+
+	def test_replay(self):
+		self.update(10)
+		self.update(11)
+		self.assertEqual(self.update(10), (FrameCounterIndex.REPLAY, 0))
+		self.assertEqual(self.update(11), (FrameCounterIndex.REPLAY, 0))
+		self.assertEqual(self.counters.get_stats()["replays"], 2)
+
+	def test_window_edges(self):
+		window = FrameCounterIndex.WINDOW
+		self.update(1000)
+		self.assertEqual(self.update(1000 - window + 1), (FrameCounterIndex.LATE, 0))
+		self.assertEqual(self.update(1000 - window), (FrameCounterIndex.STALE, 0))
+
+	def test_large_jump(self):
+		window = FrameCounterIndex.WINDOW
+		self.update(10)
+		self.update(10 + 2 * window)
+		self.assertEqual(self.update(10), (FrameCounterIndex.STALE, 0))
+		self.assertEqual(self.update(11 + window), (FrameCounterIndex.LATE, 0))
+
+	def test_links_are_separate(self):
+		self.update(10)
+		self.assertEqual(self.counters.update(OTHER_LINK, 10), (FrameCounterIndex.NEW, 0))
+		self.assertEqual(len(self.counters), 2)
+		self.assertEqual(self.counters.get_highest(link_id(0x1234, "0x0005", "0x0006")), None)
+
+
+class FrameCounterJournalTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "counters.txt")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def read_lines(self):
+		with open(self.filename) as f:
+			return f.read().splitlines()
+
+	def test_reload(self):
+		counters = FrameCounterIndex(self.filename)
+		counters.update(LINK, 10)
+		counters.update(LINK, 20)
+		counters.update(OTHER_LINK, 5)
+		counters.close()
+
+		counters = FrameCounterIndex(self.filename)
+		self.assertEqual(counters.get_highest(LINK), 20)
+		self.assertEqual(counters.get_highest(OTHER_LINK), 5)
+		counters.close()
+
+	def test_highest_line_wins(self):
+		with open(self.filename, "w") as f:
+			f.write("0x1234 0x0001 0x0002 30\n")
+			f.write("0x1234 0x0001 0x0002 20\n")
+			f.write("0x1234 0x0001 0x0002 garbage\n")
+			f.write("0x1234 0x0001")
+		counters = FrameCounterIndex(self.filename)
+		self.assertEqual(counters.get_highest(LINK), 30)
+		self.assertEqual(len(counters), 1)
+		counters.close()
+
+	def test_checkpoint_interval(self):
+		counters = FrameCounterIndex(self.filename, checkpoint_interval=10)
+		counters.update(LINK, 1, now=counters.last_checkpoint + 1)
+		self.assertEqual(self.read_lines(), [])
+		counters.update(LINK, 2, now=counters.last_checkpoint + 10)
+		self.assertEqual(self.read_lines(), ["0x1234 0x0001 0x0002 2"])
+		counters.close()
+
+	def test_only_changed_links(self):
+		counters = FrameCounterIndex(self.filename)
+		counters.update(LINK, 1)
+		counters.update(OTHER_LINK, 1)
+		counters.checkpoint()
+		counters.update(LINK, 2)
+		counters.update(OTHER_LINK, 1)
+		counters.checkpoint()
+		self.assertEqual(self.read_lines()[2:], ["0x1234 0x0001 0x0002 2"])
+		counters.close()
+
+	def test_compaction(self):
+		counters = FrameCounterIndex(self.filename)
+		counters.update(OTHER_LINK, 1)
+		for counter in range(1, 4 * FrameCounterIndex.COMPACT_RATIO):
+			counters.update(LINK, counter)
+			counters.checkpoint()
+			self.assertTrue(len(self.read_lines()) <= 2 * FrameCounterIndex.COMPACT_RATIO)
+		counters.close()
+		self.assertFalse(os.path.exists(self.filename + ".tmp"))
+
+		counters = FrameCounterIndex(self.filename)
+		self.assertEqual(counters.get_highest(LINK), 4 * FrameCounterIndex.COMPACT_RATIO - 1)
+		self.assertEqual(counters.get_highest(OTHER_LINK), 1)
+		counters.close()
+
+	def test_read_only(self):
+		with open(self.filename, "w") as f:
+			f.write("0x1234 0x0001 0x0002 30\n")
+		counters = FrameCounterIndex(self.filename, read_only=True)
+		counters.update(LINK, 40)
+		counters.checkpoint()
+		counters.close()
+		self.assertEqual(self.read_lines(), ["0x1234 0x0001 0x0002 30"])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the SQLite link database.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from rf4ce import LinkConfig, LinkStore, Rf4ceNode
+
+
+def make_link(frame_counter=10, short=True):
+	link_config = LinkConfig()
+	link_config.dest_panid = 0x0001
+	if short:
+		link_config.source = Rf4ceNode("00:11:22:33:44:55:66:77", 0x0001)
+		link_config.destination = Rf4ceNode("00:11:22:33:44:55:66:88", 0x0002)
+	else:
+		link_config.source = Rf4ceNode("00:11:22:33:44:55:66:77", None)
+		link_config.destination = Rf4ceNode("00:11:22:33:44:55:66:88", None)
+	link_config.key = "00112233445566778899aabbccddeeff"
+	link_config.frame_counter = frame_counter
+	return link_config
+
+
+class LinkStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.store = LinkStore(os.path.join(self.directory, "links.sqlite"))
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.directory)
+
+	def test_add_and_get(self):
+		name = self.store.add(make_link())
+		self.assertEqual(name, "0001-0001-0002")
+		link_config = self.store.get(name)
+		self.assertEqual(link_config.source.get_short_address(), 0x0001)
+		self.assertEqual(link_config.destination.get_long_address(), "00:11:22:33:44:55:66:88")
+		self.assertEqual(link_config.key, "00112233445566778899aabbccddeeff")
+		self.assertEqual(link_config.frame_counter, 10)
+		self.assertEqual(self.store.get("missing"), None)
+
+	def test_add_again_keeps_id(self):
+		first = make_link()
+		self.store.add(first)
+		second = make_link(frame_counter=20)
+		self.store.add(second)
+		self.assertEqual(len(self.store), 1)
+		self.assertEqual(second.store_id, first.store_id)
+
+		# Links loaded before are still saved
+		first.frame_counter = 30
+		first.save()
+		self.assertEqual(self.store.get(first.name).frame_counter, 30)
+
+	def test_add_never_lowers_counter(self):
+		self.store.add(make_link(frame_counter=20))
+		link_config = make_link(frame_counter=5)
+		self.store.add(link_config)
+		self.assertEqual(link_config.frame_counter, 20)
+		self.assertEqual(self.store.get(link_config.name).frame_counter, 20)
+
+	def test_save_never_lowers_counter(self):
+		self.store.add(make_link())
+		link_config = self.store.get("0001-0001-0002")
+		other = self.store.get("0001-0001-0002")
+		link_config.frame_counter = 50
+		link_config.save()
+		other.frame_counter = 40
+		other.save()
+		self.assertEqual(self.store.get("0001-0001-0002").frame_counter, 50)
+
+	def test_update_frame_counter(self):
+		link_config = make_link()
+		self.store.add(link_config)
+		self.store.update_frame_counter(link_config, 15)
+		self.store.update_frame_counter(link_config, 12)
+		self.assertEqual(self.store.get(link_config.name).frame_counter, 15)
+
+	def test_long_addresses_only(self):
+		name = self.store.add(make_link(short=False))
+		self.assertEqual(name, "0001-0011223344556677-0011223344556688")
+		link_config = self.store.get(name)
+		self.assertEqual(link_config.source.get_short_address(), None)
+		self.assertEqual(link_config.source.get_long_address(), "00:11:22:33:44:55:66:77")
+
+	def test_find(self):
+		self.store.add(make_link())
+		self.store.add(make_link(short=False))
+		self.assertEqual(len(self.store.find(dest_panid=0x0001)), 2)
+		self.assertEqual(len(self.store.find(source=0x0001, destination=0x0002)), 1)
+		self.assertEqual(len(self.store.find(source="00:11:22:33:44:55:66:77")), 2)
+		self.assertEqual(self.store.find(dest_panid=0x0002), [])
+
+	def test_import_export(self):
+		filename = os.path.join(self.directory, "remote.json")
+		with open(filename, "w") as f:
+			json.dump({"dest_panid": "0x1", "full_source": "00:11:22:33:44:55:66:77",
+				"full_destination": "00:11:22:33:44:55:66:88", "frame_counter": 7}, f)
+		self.assertEqual(self.store.import_json([filename]), ["remote"])
+		self.assertEqual(self.store.get("remote").frame_counter, 7)
+
+		export_directory = os.path.join(self.directory, "export")
+		os.mkdir(export_directory)
+		filenames = self.store.export_json(export_directory)
+		self.assertEqual(filenames, [os.path.join(export_directory, "remote.json")])
+		link_config = LinkConfig(filenames[0])
+		self.assertEqual(link_config.destination.get_short_address(), None)
+		self.assertEqual(link_config.frame_counter, 7)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the bounded packet queue.
+"""
+
+import time
+import threading
+import unittest
+
+from rf4ce.packetprocessor import PacketQueue
+
+
+class PacketQueueTest(unittest.TestCase):
+
+	def fill(self, policy, count, max_size=2):
+		q = PacketQueue(max_size, policy)
+		accepted = [q.put(i) for i in range(count)]
+		return q, accepted
+
+	def test_unknown_policy(self):
+		self.assertRaises(ValueError, PacketQueue, 2, "drop-all")
+
+	def test_drop_oldest(self):
+		q, accepted = self.fill(PacketQueue.DROP_OLDEST, 3)
+		self.assertEqual(accepted, [True, True, False])
+		self.assertEqual(q.get_batch(10), [1, 2])
+		self.assertEqual(q.get_stats()["enqueued"], 3)
+		self.assertEqual(q.get_stats()["dropped"], 1)
+
+	def test_drop_newest(self):
+		q, accepted = self.fill(PacketQueue.DROP_NEWEST, 3)
+		self.assertEqual(accepted, [True, True, False])
+		self.assertEqual(q.get_batch(10), [0, 1])
+		self.assertEqual(q.get_stats()["enqueued"], 2)
+		self.assertEqual(q.get_stats()["dropped"], 1)
+
+	def test_block(self):
+		q, accepted = self.fill(PacketQueue.BLOCK, 2)
+		producer = threading.Thread(target=q.put, args=(2,))
+		producer.start()
+		time.sleep(0.05)
+		self.assertTrue(producer.is_alive())
+		self.assertEqual(q.get_batch(1), [0])
+		producer.join(1)
+		self.assertFalse(producer.is_alive())
+		self.assertEqual(q.get_batch(10), [1, 2])
+		self.assertEqual(q.get_stats()["dropped"], 0)
+
+	def test_batches(self):
+		q, accepted = self.fill(PacketQueue.DROP_OLDEST, 5, max_size=10)
+		self.assertEqual(q.get_batch(2), [0, 1])
+		self.assertEqual(q.get_batch(10), [2, 3, 4])
+		self.assertEqual(q.get_stats()["high_water_mark"], 5)
+
+	def test_join(self):
+		q, accepted = self.fill(PacketQueue.DROP_OLDEST, 2)
+		waiter = threading.Thread(target=q.join)
+		waiter.start()
+		batch = q.get_batch(10)
+		time.sleep(0.05)
+		self.assertTrue(waiter.is_alive())
+		q.task_done(len(batch))
+		waiter.join(1)
+		self.assertFalse(waiter.is_alive())
+
+	def test_close_wakes_consumer(self):
+		q = PacketQueue(2, PacketQueue.BLOCK)
+		batches = []
+		consumer = threading.Thread(target=lambda: batches.append(q.get_batch(10)))
+		consumer.start()
+		time.sleep(0.05)
+		q.close()
+		consumer.join(1)
+		self.assertFalse(consumer.is_alive())
+		self.assertEqual(batches, [[]])
+
+	def test_close_wakes_blocked_producer(self):
+		q, accepted = self.fill(PacketQueue.BLOCK, 2)
+		results = []
+		producer = threading.Thread(target=lambda: results.append(q.put(2)))
+		producer.start()
+		time.sleep(0.05)
+		q.close()
+		producer.join(1)
+		self.assertFalse(producer.is_alive())
+		self.assertEqual(results, [False])
+		self.assertEqual(len(q), 2)
+		self.assertEqual(q.get_stats()["dropped"], 1)
+
+	def test_put_after_close(self):
+		q = PacketQueue(2, PacketQueue.DROP_OLDEST)
+		q.close()
+		self.assertFalse(q.put(0))
+		self.assertEqual(len(q), 0)
+		self.assertEqual(q.get_stats()["enqueued"], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the pairing tracker.
+"""
+
+import unittest
+
+from rf4ce import LinkConfig
+from rf4ce.pairing import PairingTracker, KEY_SEED_COUNT, KEY_SEED_SIZE, KEY_SIZE
+
+
+INDEX = (0x1234, 1, 2)
+OTHER_INDEX = (0x1234, 3, 4)
+
+
+def seed(value):
+	return bytearray([value]) * KEY_SEED_SIZE
+
+
+class PairingTrackerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tracker = PairingTracker(timeout=60.0)
+
+	def test_key(self):
+		self.tracker.start(INDEX, LinkConfig(), 0)
+		for i in range(KEY_SEED_COUNT):
+			session, added = self.tracker.add_seed(INDEX, i, seed(i), i, 1)
+			self.assertTrue(added)
+		self.assertTrue(session.is_complete())
+		self.assertEqual(session.link_config.frame_counter, KEY_SEED_COUNT - 1)
+
+		# Each byte of the key is the XOR of all the seeds, 5 times
+		value = 0
+		for i in range(KEY_SEED_COUNT):
+			value ^= i
+		self.assertEqual(session.get_key(), bytes(bytearray([value]) * KEY_SIZE))
+		self.assertEqual(self.tracker.get_stats()["completed"], 1)
+
+	def test_duplicates_and_unknown(self):
+		self.tracker.start(INDEX, LinkConfig(), 0)
+		self.assertEqual(self.tracker.add_seed(INDEX, 0, seed(1), 1, 1)[1], True)
+		self.assertEqual(self.tracker.add_seed(INDEX, 0, seed(1), 1, 1)[1], False)
+		self.assertEqual(self.tracker.add_seed(OTHER_INDEX, 0, seed(1), 1, 1), (None, False))
+		self.assertEqual(self.tracker.add_seed(INDEX, KEY_SEED_COUNT, seed(1), 1, 1), (None, False))
+		stats = self.tracker.get_stats()
+		self.assertEqual(stats["duplicates"], 1)
+		self.assertEqual(stats["ignored"], 2)
+
+	def test_timeout(self):
+		self.tracker.start(INDEX, LinkConfig(), 100)
+		self.tracker.start(OTHER_INDEX, LinkConfig(), 100)
+		self.tracker.add_seed(OTHER_INDEX, 0, seed(1), 1, 150)
+		self.assertEqual(self.tracker.expire(160), [])
+		expired = self.tracker.expire(161)
+		self.assertEqual(len(expired), 1)
+		self.assertEqual(expired[0].remaining, KEY_SEED_COUNT)
+		self.assertEqual(self.tracker.get_active(), 1)
+		self.assertEqual(len(self.tracker.expire(211)), 1)
+		self.assertEqual(self.tracker.get_stats()["expired"], 2)
+
+	def test_completed_sessions_are_not_reported(self):
+		self.tracker.start(INDEX, LinkConfig(), 0)
+		for i in range(KEY_SEED_COUNT):
+			self.tracker.add_seed(INDEX, i, seed(i), i, 1)
+		self.assertEqual(self.tracker.expire(1000), [])
+		self.assertEqual(self.tracker.get_stats()["expired"], 0)
+
+	def test_no_timeout(self):
+		self.tracker.timeout = None
+		self.tracker.start(INDEX, LinkConfig(), 0)
+		self.assertEqual(self.tracker.expire(1e9), [])
+		self.assertEqual(self.tracker.expire(), [])
+		self.assertEqual(self.tracker.get_active(), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
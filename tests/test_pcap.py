@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Tests the pcap and pcapng capture readers.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from rf4ce.fcs import make_fcs
+from rf4ce.pcap import CaptureReader, CaptureException, replay
+from rf4ce.pcap import PCAP_MAGIC, PCAP_MAGIC_NS, PCAPNG_SHB, PCAPNG_IDB, PCAPNG_EPB, PCAPNG_SPB
+from rf4ce.pcap import PCAPNG_BYTE_ORDER_MAGIC, PCAPNG_OPT_IF_TSRESOL
+from rf4ce.pcap import LINKTYPE_IEEE802_15_4_WITHFCS, LINKTYPE_IEEE802_15_4_NOFCS
+from rf4ce.pcap import LINKTYPE_IEEE802_15_4_NONASK_PHY
+
+
+FRAME = b'\x41\x88\x01\x34\x12\x02\x00\x01\x00\x01\x02\x03'
+PSDU = FRAME + make_fcs(FRAME)
+OTHER_PSDU = PSDU[:-3] + b'\x04' + make_fcs(PSDU[:-3] + b'\x04')
+
+
+def pcap_file(linktype, records, endian="<", magic=PCAP_MAGIC):
+	data = struct.pack(endian + "IHHiIII", magic, 2, 4, 0, 0, 0xffff, linktype)
+	for ts_sec, ts_frac, frame in records:
+		data += struct.pack(endian + "IIII", ts_sec, ts_frac, len(frame), len(frame)) + frame
+	return data
+
+
+def pcapng_block(block_type, body, endian="<"):
+	body += b'\x00' * (-len(body) % 4)
+	length = 12 + len(body)
+	return (struct.pack(endian + "II", block_type, length) + body +
+		struct.pack(endian + "I", length))
+
+
+def pcapng_shb(endian="<"):
+	return pcapng_block(PCAPNG_SHB, struct.pack(endian + "IHHq", PCAPNG_BYTE_ORDER_MAGIC,
+		1, 0, -1), endian)
+
+
+def pcapng_idb(linktype, tsresol=None, endian="<"):
+	body = struct.pack(endian + "HHI", linktype, 0, 0)
+	if tsresol is not None:
+		body += struct.pack(endian + "HHB3x", PCAPNG_OPT_IF_TSRESOL, 1, tsresol)
+		body += struct.pack(endian + "HH", 0, 0)
+	return pcapng_block(PCAPNG_IDB, body, endian)
+
+
+def pcapng_epb(timestamp, frame, endian="<"):
+	return pcapng_block(PCAPNG_EPB, struct.pack(endian + "IIIII", 0, timestamp >> 32,
+		timestamp & 0xffffffff, len(frame), len(frame)) + frame, endian)
+
+
+def pcapng_spb(frame, endian="<"):
+	return pcapng_block(PCAPNG_SPB, struct.pack(endian + "I", len(frame)) + frame, endian)
+
+
+class CaptureReaderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "capture")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def read(self, data):
+		with open(self.filename, "wb") as f:
+			f.write(data)
+		reader = CaptureReader(self.filename)
+		try:
+			return list(reader)
+		finally:
+			reader.close()
+
+	def test_pcap(self):
+		frames = self.read(pcap_file(LINKTYPE_IEEE802_15_4_WITHFCS,
+			[(10, 500000, PSDU), (11, 0, OTHER_PSDU)]))
+		self.assertEqual(frames, [(10.5, PSDU), (11.0, OTHER_PSDU)])
+
+	def test_pcap_big_endian_nanoseconds(self):
+		frames = self.read(pcap_file(LINKTYPE_IEEE802_15_4_WITHFCS, [(10, 250000000, PSDU)],
+			">", PCAP_MAGIC_NS))
+		self.assertEqual(frames, [(10.25, PSDU)])
+
+	def test_pcap_nofcs(self):
+		frames = self.read(pcap_file(LINKTYPE_IEEE802_15_4_NOFCS, [(10, 0, FRAME)]))
+		self.assertEqual(frames, [(10.0, PSDU)])
+
+	def test_pcap_nonask_phy(self):
+		phy_header = b'\x00\x00\x00\x00\xa7' + struct.pack("B", len(PSDU))
+		frames = self.read(pcap_file(LINKTYPE_IEEE802_15_4_NONASK_PHY,
+			[(10, 0, phy_header + PSDU)]))
+		self.assertEqual(frames, [(10.0, PSDU)])
+
+	def test_pcap_truncated_record(self):
+		data = pcap_file(LINKTYPE_IEEE802_15_4_WITHFCS, [(10, 0, PSDU), (11, 0, OTHER_PSDU)])
+		self.assertEqual(self.read(data[:-4]), [(10.0, PSDU)])
+
+	def test_unsupported(self):
+		self.assertRaises(CaptureException, self.read, pcap_file(1, []))
+		self.assertRaises(CaptureException, self.read, b'\x00' * 24)
+		self.assertRaises(CaptureException, self.read, b'')
+
+	def test_pcapng(self):
+		frames = self.read(pcapng_shb() + pcapng_idb(LINKTYPE_IEEE802_15_4_WITHFCS) +
+			pcapng_epb(1500000, PSDU) + pcapng_epb(2000000, OTHER_PSDU))
+		self.assertEqual(frames, [(1.5, PSDU), (2.0, OTHER_PSDU)])
+
+	def test_pcapng_big_endian_tsresol(self):
+		frames = self.read(pcapng_shb(">") + pcapng_idb(LINKTYPE_IEEE802_15_4_NOFCS, 3, ">") +
+			pcapng_epb(1500, FRAME, ">"))
+		self.assertEqual(frames, [(1.5, PSDU)])
+
+	def test_pcapng_skips_other_interfaces(self):
+		frames = self.read(pcapng_shb() + pcapng_idb(1) + pcapng_epb(1000000, b'\x00' * 14))
+		self.assertEqual(frames, [])
+
+	def test_pcapng_simple_packet_blocks(self):
+		frames = self.read(pcapng_shb() + pcapng_idb(LINKTYPE_IEEE802_15_4_WITHFCS) +
+			pcapng_spb(PSDU) + pcapng_epb(2000000, OTHER_PSDU) + pcapng_spb(PSDU))
+		self.assertEqual(frames, [(None, PSDU), (2.0, OTHER_PSDU), (None, PSDU)])
+
+	def test_replay(self):
+		with open(self.filename, "wb") as f:
+			f.write(pcapng_shb() + pcapng_idb(LINKTYPE_IEEE802_15_4_WITHFCS) +
+				pcapng_spb(PSDU) + pcapng_epb(2000000, OTHER_PSDU) + pcapng_spb(PSDU))
+		frames = []
+		self.assertEqual(replay(self.filename, frames.append), 3)
+		self.assertEqual(frames, [PSDU, OTHER_PSDU, PSDU])
+
+		# Simple packet blocks get the time of the previous frame
+		frames = []
+		replay(self.filename, lambda data, timestamp: frames.append(timestamp), timestamps=True)
+		self.assertEqual(frames, [None, 2.0, 2.0])
+
+
+if __name__ == '__main__':
+	unittest.main()